@@ -3,7 +3,7 @@ import jwt, time
 import logging
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from repositories import repo
+from repositories import repo, history_buffer
 import os
 from dotenv import load_dotenv
 load_dotenv() 
@@ -13,9 +13,14 @@ logger = logging.getLogger(__name__)
 SECRET_KEY = os.environ["SECRET_KEY"]
 ALGORITHM = "HS256"
 TOKEN_EXP_SECONDS = int(os.environ["TOKEN_EXP_SECONDS"])
+# How long a role/username lookup is trusted before hitting the repository again
+PRINCIPAL_TTL_SECONDS = int(os.environ.get("PRINCIPAL_TTL_SECONDS", 30))
 
 security = HTTPBearer()
 
+# user_id -> (expires_at, {"id", "username", "role"})
+_principal_cache = {}
+
 def create_token(user):
     payload = {
         "sub": str(user["id"]),
@@ -26,6 +31,25 @@ def create_token(user):
 
 
 
+def get_principal(user_id: str):
+    now = time.monotonic()
+    cached = _principal_cache.get(user_id)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    principal = repo.get_user_principal(user_id)
+    if principal:
+        _principal_cache[user_id] = (now + PRINCIPAL_TTL_SECONDS, principal)
+    else:
+        _principal_cache.pop(user_id, None)
+    return principal
+
+
+def invalidate_principal(user_id):
+    """Drop the cached principal after a role/username change or account deletion."""
+    _principal_cache.pop(str(user_id), None)
+
+
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         payload = jwt.decode(
@@ -39,7 +63,7 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
             logger.warning("Token verification failed: 'sub' missing from payload")
             raise HTTPException(401, "Invalid token")
 
-        user = repo.get_user_by_id(str(user_id))
+        user = get_principal(str(user_id))
         if not user:
             logger.warning(f"Token verification failed: User ID {user_id} not found in repository")
             raise HTTPException(401, "User not found")
@@ -54,3 +78,11 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
         raise HTTPException(401, "Invalid token")
 
 
+def load_user_likes(user=Depends(verify_token)):
+    return repo.get_user_likes(user["id"])
+
+
+def load_user_history(user=Depends(verify_token)):
+    # Plays still buffered for this user are written first
+    history_buffer.flush(user["id"])
+    return repo.get_user_history(user["id"])
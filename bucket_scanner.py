@@ -2,8 +2,18 @@
 import boto3
 from mutagen.flac import FLAC, Picture
 from mutagen import File
-from io import BytesIO
+from mutagen.id3 import ID3
+from mutagen.mp4 import MP4Tags
+from mutagen.asf import ASFTags
+from io import BytesIO, RawIOBase
 from botocore.config import Config
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import threading
+import queue
+import tempfile
+import fastparquet
 import base64
 import json
 from PIL import Image
@@ -26,6 +36,18 @@ COVER_PATH_PREFIX = "public/covers/"
 
 AUDIO_EXTENSIONS = [".flac", ".mp3", ".wav", ".m4a", ".aac", ".ogg", ".aiff", ".wma"]
 
+# Lecture des métadonnées par requêtes Range
+RANGE_CHUNK_SIZE = int(os.environ.get("SCAN_RANGE_CHUNK_SIZE", 64 * 1024))
+HEAD_CHUNKS = int(os.environ.get("SCAN_HEAD_CHUNKS", 4)) # first request: 4 x 64 KiB, enough for most tag blocks
+SCAN_WORKERS = int(os.environ.get("SCAN_WORKERS", 16))
+SCAN_BUCKET_CONCURRENCY = int(os.environ.get("SCAN_BUCKET_CONCURRENCY", 8))
+
+# Pipeline de scan
+SCAN_QUEUE_SIZE = int(os.environ.get("SCAN_QUEUE_SIZE", 2000)) # listed objects buffered ahead of the metadata workers
+SCAN_BATCH_SIZE = int(os.environ.get("SCAN_BATCH_SIZE", 5000)) # rows per batch handed to the DB ingestion
+COVER_WORKERS = int(os.environ.get("SCAN_COVER_WORKERS", 4))
+COVER_PROCESSES = int(os.environ.get("SCAN_COVER_PROCESSES", os.cpu_count() or 1))
+
 # =====================
 # UTILITAIRES
 # =====================
@@ -46,69 +68,295 @@ def extract_cover_image(audio):
         if name == "MP3" and audio.tags:
             for tag in audio.tags.values():
                 if getattr(tag, "FrameID", None) == "APIC":
-                    return base64.b64encode(tag.data).decode()
+                    return tag.data
 
         if name == "FLAC" and audio.pictures:
-            return base64.b64encode(audio.pictures[0].data).decode()
+            return audio.pictures[0].data
 
         if name == "MP4" and audio.tags:
             covr = audio.tags.get("covr")
             if covr:
-                return base64.b64encode(covr[0]).decode()
+                return bytes(covr[0])
 
         if audio.tags and "metadata_block_picture" in audio.tags:
             raw = base64.b64decode(audio.tags["metadata_block_picture"][0])
             pic = Picture(raw)
-            return base64.b64encode(pic.data).decode()
+            return pic.data
     except Exception as e:
         logger.warning(f"Could not extract cover image: {e}")
         pass
 
     return None
 
-def list_s3_music_files(s3_client, bucket):
+def iter_s3_music_objects(s3_client, bucket):
+    """Audio objects of the bucket, page by page, with the fields used by the incremental manifest (Key, ETag, Size, LastModified)."""
     logger.info(f"Listing music files in bucket: {bucket}")
     paginator = s3_client.get_paginator("list_objects_v2")
-    out = []
+    found = 0
     try:
         for page in paginator.paginate(Bucket=bucket):
             for obj in page.get("Contents", []):
                 key = obj["Key"]
                 if any(key.lower().endswith(ext) for ext in AUDIO_EXTENSIONS):
-                    out.append(key)
-        logger.info(f"Found {len(out)} music files.")
+                    found += 1
+                    yield obj
+        logger.info(f"Found {found} music files.")
     except Exception as e:
         logger.error(f"Error listing S3 files in {bucket}: {e}")
-    return out
 
-def read_audio_metadata_s3(s3_client, bucket, key):
-    logger.debug(f"Reading metadata for: {key}")
+def list_s3_music_objects(s3_client, bucket):
+    return list(iter_s3_music_objects(s3_client, bucket))
+
+def list_s3_music_files(s3_client, bucket):
+    return [obj["Key"] for obj in list_s3_music_objects(s3_client, bucket)]
+
+def load_latest_snapshot(s3_client, bucket, columns=None):
+    """Latest data/*.parquet snapshot written by a previous scan, or None.
+
+    columns limits the read to those columns (the ones missing from older snapshots are skipped).
+    """
+    paginator = s3_client.get_paginator("list_objects_v2")
+    parquet_files = []
+    for page in paginator.paginate(Bucket=bucket, Prefix="data/"):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(".parquet"):
+                parquet_files.append(obj)
+    if not parquet_files:
+        return None
+    latest_parquet = max(parquet_files, key=lambda x: x["LastModified"])
+    logger.info(f"Loading metadata from: {latest_parquet['Key']}")
+    obj = s3_client.get_object(Bucket=bucket, Key=latest_parquet["Key"])
+    pf = fastparquet.ParquetFile(BytesIO(obj["Body"].read()))
+    if columns is not None:
+        columns = [c for c in columns if c in pf.columns]
+    return pf.to_pandas(columns=columns)
+
+def load_manifest(s3_client, bucket):
+    """path -> snapshot row of the previous scan, for rows recorded with their ETag and size."""
     try:
-        obj = s3_client.get_object(Bucket=bucket, Key=key)
+        df = load_latest_snapshot(s3_client, bucket)
+    except Exception as e:
+        logger.warning(f"Could not load previous snapshot for {bucket}: {e}")
+        return {}
+    if df is None or not {"etag", "size"}.issubset(df.columns):
+        return {}
+    return {row["path"]: row for row in df.to_dict("records")}
+
+def carried_metadata(row, bucket):
+    """Metadata of an unchanged object, taken from the previous snapshot instead of re-reading the file."""
+    genres = row.get("genres") or ""
+    return {
+        "title": row.get("title") or "Unknown",
+        "artist": row.get("artist") or "Unknown",
+        "album": row.get("album") or "Unknown",
+        "genre": [g.strip() for g in genres.split(",") if g.strip()],
+        "duration": row.get("duration") or "00:00",
+        "track": int(row["albumTrack"]) if row.get("albumTrack") else None,
+        "disc": int(row["discNumber"]) if row.get("discNumber") else None,
+        "cover_data": None,
+        "cover": row.get("cover") or "",
+        "coverSmall": row.get("coverSmall") or "",
+        "path": row["path"],
+        "bucket": row.get("bucket") or bucket
+    }
+
+class S3RangeReader(RawIOBase):
+    """Seekable read-only view of an S3 object that downloads only the chunks mutagen actually reads.
+
+    The first request fetches the head of the object (tag blocks: ID3v2, FLAC metadata, leading MP4
+    atoms); later reads, e.g. ID3v1/APE tags at the tail or a trailing moov atom, trigger extra Range GETs.
+    """
+
+    def __init__(self, s3_client, bucket, key):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.size = None
+        self.bytes_fetched = 0
+        self.requests = 0
+        self._chunks = {} # chunk index -> bytes
+        self._pos = 0
+        self._fetch(0, HEAD_CHUNKS)
+
+    def _fetch(self, first, count):
+        start = first * RANGE_CHUNK_SIZE
+        end = (first + count) * RANGE_CHUNK_SIZE - 1
+        if self.size is not None:
+            end = min(end, self.size - 1)
+            if start > end:
+                return
+        obj = self.s3_client.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end}")
         data = obj["Body"].read()
+        self.requests += 1
+        self.bytes_fetched += len(data)
+        content_range = obj.get("ContentRange") # "bytes 0-262143/123456789"
+        if content_range and "/" in content_range:
+            self.size = int(content_range.rsplit("/", 1)[1])
+        elif self.size is None:
+            self.size = len(data) # objet plus petit que la plage demandée, renvoyé en entier
+        for i in range(0, len(data), RANGE_CHUNK_SIZE):
+            self._chunks[first + i // RANGE_CHUNK_SIZE] = data[i:i + RANGE_CHUNK_SIZE]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self._pos = offset
+        elif whence == 1:
+            self._pos += offset
+        else:
+            self._pos = self.size + offset
+        self._pos = max(self._pos, 0)
+        return self._pos
+
+    def readinto(self, buffer):
+        if self._pos >= self.size:
+            return 0
+        n = min(len(buffer), self.size - self._pos)
+        first = self._pos // RANGE_CHUNK_SIZE
+        last = (self._pos + n - 1) // RANGE_CHUNK_SIZE
+        missing = [i for i in range(first, last + 1) if i not in self._chunks]
+        if missing:
+            last_chunk = (self.size - 1) // RANGE_CHUNK_SIZE
+            if missing[0] >= last_chunk - 1:
+                # Lecture en fin de fichier (ID3v1, APE) : on prend la queue d'un coup
+                self._fetch(missing[0], last_chunk - missing[0] + 1)
+            else:
+                self._fetch(missing[0], missing[-1] - missing[0] + 1)
+        written = 0
+        while written < n:
+            chunk = self._chunks[(self._pos + written) // RANGE_CHUNK_SIZE]
+            offset = (self._pos + written) % RANGE_CHUNK_SIZE
+            piece = chunk[offset:offset + n - written]
+            if not piece:
+                break
+            buffer[written:written + len(piece)] = piece
+            written += len(piece)
+        self._pos += written
+        return written
+
+
+_bucket_slots = {}
+_bucket_slots_lock = threading.Lock()
+
+def bucket_slot(bucket):
+    """Semaphore limiting concurrent metadata reads against one bucket."""
+    with _bucket_slots_lock:
+        if bucket not in _bucket_slots:
+            _bucket_slots[bucket] = threading.BoundedSemaphore(SCAN_BUCKET_CONCURRENCY)
+        return _bucket_slots[bucket]
+
+def parallel_map_ordered(fn, items, workers=SCAN_WORKERS):
+    """Like executor.map, but keeps at most a few batches in flight so memory stays bounded."""
+    window = workers * 4
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Consumer gone (cancelled scan): drop what has not started yet
+            for future in pending:
+                future.cancel()
+
+# Champ -> clé de tag selon le format (ID3 frame, commentaire Vorbis, atome MP4, attribut ASF)
+ID3_FIELDS = {"title": "TIT2", "artist": "TPE1", "album": "TALB", "genre": "TCON", "track": "TRCK", "disc": "TPOS"}
+VORBIS_FIELDS = {"title": "title", "artist": "artist", "album": "album", "genre": "genre", "track": "tracknumber", "disc": "discnumber"}
+MP4_FIELDS = {"title": "\xa9nam", "artist": "\xa9ART", "album": "\xa9alb", "genre": "\xa9gen", "track": "trkn", "disc": "disk"}
+ASF_FIELDS = {"title": "Title", "artist": "Author", "album": "WM/AlbumTitle", "genre": "WM/Genre", "track": "WM/TrackNumber", "disc": "WM/PartOfSet"}
+
+def read_tags(audio):
+    """title/artist/album/genre/track/disc of a parsed (non-easy) mutagen file, each as a list of strings."""
+    fields = {name: [] for name in ID3_FIELDS}
+    tags = getattr(audio, "tags", None)
+    if not tags:
+        return fields
+
+    if isinstance(tags, ID3):
+        for name, frame_id in ID3_FIELDS.items():
+            frame = tags.get(frame_id)
+            if frame is not None:
+                fields[name] = list(frame.genres if frame_id == "TCON" else frame.text)
+    elif isinstance(tags, MP4Tags):
+        for name, atom in MP4_FIELDS.items():
+            values = tags.get(atom, [])
+            if name in ("track", "disc"):
+                # trkn/disk : liste de tuples (numéro, total)
+                fields[name] = [str(v[0]) for v in values if v and v[0]]
+            else:
+                fields[name] = [str(v) for v in values]
+    else:
+        names = ASF_FIELDS if isinstance(tags, ASFTags) else VORBIS_FIELDS
+        for name, tag_key in names.items():
+            try:
+                fields[name] = [str(v) for v in tags.get(tag_key, [])]
+            except (KeyError, ValueError):
+                pass
+    return fields
+
+def parse_tag_number(values):
+    """Number of a track/disc tag ("3", "3/12"), or None."""
+    for value in values:
+        try:
+            number = int(str(value).split("/")[0].strip())
+        except ValueError:
+            continue
+        if number > 0:
+            return number
+    return None
 
-        audio_easy = File(BytesIO(data), easy=True)
-        audio_full = File(BytesIO(data), easy=False)
+def read_audio_metadata_s3(s3_client, bucket, key, want_cover=None):
+    """Tags and duration of an audio object.
+
+    The embedded picture is only extracted (as raw bytes in cover_data) when want_cover(artist, album)
+    returns True, or when no want_cover is given.
+    """
+    logger.debug(f"Reading metadata for: {key}")
+    try:
+        with bucket_slot(bucket):
+            data = S3RangeReader(s3_client, bucket, key)
+            audio = File(data)
+        logger.debug(f"{key}: {data.bytes_fetched} of {data.size} bytes in {data.requests} requests")
 
         duration = "00:00"
-        if audio_full and hasattr(audio_full.info, "length"):
-            m = int(audio_full.info.length // 60)
-            s = int(audio_full.info.length % 60)
+        if audio and hasattr(audio.info, "length"):
+            m = int(audio.info.length // 60)
+            s = int(audio.info.length % 60)
             duration = f"{m:02d}:{s:02d}"
 
-        raw_genres = audio_easy.get("genre", []) if audio_easy else []
+        tags = read_tags(audio)
         genres = []
-        for g in raw_genres:
+        for g in tags["genre"]:
             parts = [p.strip() for p in g.split(",") if p.strip()]
             genres.extend(parts)
 
+        artist = get_first_artist(tags["artist"])
+        album = tags["album"][0] if tags["album"] else "Unknown"
+        cover_data = None
+        if want_cover is None or want_cover(artist, album):
+            cover_data = extract_cover_image(audio)
+
         return {
-            "title": audio_easy.get("title", ["Unknown"])[0] if audio_easy else "Unknown",
-            "artist": get_first_artist(audio_easy.get("artist")) if audio_easy else "Unknown",
-            "album": audio_easy.get("album", ["Unknown"])[0] if audio_easy else "Unknown",
+            "bytes_fetched": data.bytes_fetched,
+            "title": tags["title"][0] if tags["title"] else "Unknown",
+            "artist": artist,
+            "album": album,
             "genre": genres,
             "duration": duration,
-            "cover_base64": extract_cover_image(audio_full),
+            "track": parse_tag_number(tags["track"]),
+            "disc": parse_tag_number(tags["disc"]),
+            "cover_data": cover_data,
             "path": key,
             "bucket": bucket
         }
@@ -121,276 +369,451 @@ def read_audio_metadata_s3(s3_client, bucket, key):
         "album": "Unknown",
         "genre": [],
         "duration": "00:00",
-        "cover_base64": None,
+        "track": None,
+        "disc": None,
+        "cover_data": None,
         "path": key,
         "bucket": bucket
     }
 
-def upload_cover_s3(s3_client, base64_cover, filename, bucket, size=None):
-    if not base64_cover:
-        return ""
-
-    try:
-        image_data = base64.b64decode(base64_cover)
-        img = Image.open(BytesIO(image_data))
-
-        if size:
-            img = img.resize(size, Image.Resampling.LANCZOS)
-
-        buffer = BytesIO()
-        img.save(buffer, format="WEBP")
-        buffer.seek(0)
-
-        safe_filename = "".join(e for e in filename if e.isalnum() or e in (' ', '.', '_')).rstrip()
-        key = f"{COVER_PATH_PREFIX}{safe_filename}.webp"
-
-        s3_client.put_object(
-            Bucket=bucket,
-            Key=key,
-            Body=buffer,
-            ContentType="image/webp"
-        )
-        return key
-    except Exception as e:
-        logger.error(f"Error uploading cover {filename}: {e}")
-        return ""
-
-def scan_bucket_for_music_metadata(endpoint, access_key, secret_key, bucket_name, mode="full", existing_paths=None):
-    s3_client = boto3.client(
+def render_cover(image_data, size=None):
+    """Decode an embedded picture and re-encode it as WEBP, resized when size is given."""
+    img = Image.open(BytesIO(image_data))
+    if size:
+        img = img.resize(size, Image.Resampling.LANCZOS)
+    buffer = BytesIO()
+    img.save(buffer, format="WEBP")
+    return buffer.getvalue()
+
+def render_album_covers(image_data):
+    # Exécuté dans le pool de processus : une seule décompression pour les deux tailles
+    return render_cover(image_data), render_cover(image_data, size=(40, 40))
+
+_cover_processes = None
+_cover_processes_lock = threading.Lock()
+
+def cover_process_pool():
+    """Process pool shared by all scans for the CPU-bound PIL work."""
+    global _cover_processes
+    with _cover_processes_lock:
+        if _cover_processes is None:
+            _cover_processes = ProcessPoolExecutor(max_workers=COVER_PROCESSES)
+        return _cover_processes
+
+class CoverStore:
+    """Content-addressed covers of a bucket: public/covers/<sha256>.webp and <sha256>_small.webp.
+
+    The hashes already stored are indexed from one listing of the cover prefix, so artwork shared
+    by several albums (or already uploaded by a previous scan) is rendered and uploaded only once.
+    """
+
+    def __init__(self, s3_client, bucket):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self._lock = threading.Lock()
+        self._inflight = {} # digest -> Future of the keys, for covers being rendered
+        self._known = self._load_index()
+
+    def _load_index(self):
+        names = set()
+        try:
+            paginator = self.s3_client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=COVER_PATH_PREFIX):
+                for obj in page.get("Contents", []):
+                    names.add(obj["Key"][len(COVER_PATH_PREFIX):])
+        except Exception as e:
+            logger.warning(f"Could not list existing covers in {self.bucket}: {e}")
+        return {name[:-len(".webp")] for name in names if name.endswith(".webp") and name.replace(".webp", "_small.webp") in names}
+
+    @staticmethod
+    def keys(digest):
+        return f"{COVER_PATH_PREFIX}{digest}.webp", f"{COVER_PATH_PREFIX}{digest}_small.webp"
+
+    def store(self, image_data):
+        """Keys (cover, coverSmall) for the picture, rendering and uploading it only if its hash is new."""
+        if not image_data:
+            return "", ""
+        digest = hashlib.sha256(image_data).hexdigest()
+        with self._lock:
+            if digest in self._known:
+                return self.keys(digest)
+            future = self._inflight.get(digest)
+            owner = future is None
+            if owner:
+                future = self._inflight[digest] = Future()
+        if not owner:
+            return future.result()
+
+        result = ("", "")
+        try:
+            full, small = cover_process_pool().submit(render_album_covers, image_data).result()
+            cover_key, small_key = self.keys(digest)
+            for key, body in ((cover_key, full), (small_key, small)):
+                self.s3_client.put_object(
+                    Bucket=self.bucket,
+                    Key=key,
+                    Body=BytesIO(body),
+                    ContentType="image/webp"
+                )
+            result = (cover_key, small_key)
+        except Exception as e:
+            logger.error(f"Error uploading cover {digest}: {e}")
+        with self._lock:
+            if result[0]:
+                self._known.add(digest)
+            del self._inflight[digest]
+        future.set_result(result)
+        return result
+
+SNAPSHOT_COLUMNS = [
+    "title", "artist", "artist_image", "album", "duration", "path", "albumTrack", "discNumber", "genres",
+    "cover", "coverSmall", "coverBucket", "bucket", "etag", "size", "last_modified"
+]
+
+def make_s3_client(endpoint, access_key, secret_key):
+    return boto3.client(
         "s3",
         endpoint_url=endpoint,
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_key,
-        config=Config(signature_version="s3v4", s3={"addressing_style": "path"}),
+        config=Config(signature_version="s3v4", s3={"addressing_style": "path"}, max_pool_connections=SCAN_WORKERS * 2),
         region_name="us-east-1"
     )
-    
-    if existing_paths is None:
-        existing_paths = []
 
-    processed_data = {"artists": {}, "albums": {}, "tracks": {}, "genres": {}}
-    artist_map = {}
-    album_map = {}
-    genre_map = {}
-    current_artist_id = 1
-    current_album_id = 1
-    current_track_id = 1
-    current_genre_id = 1
+def prefetch(iterable, maxsize=SCAN_QUEUE_SIZE):
+    """Run an iterator in its own thread, at most maxsize items ahead of the consumer."""
+    q = queue.Queue(maxsize=maxsize)
+    done = object()
+    stop = threading.Event()
+
+    def send(item):
+        # Bounded waits: the producer gives up as soon as the consumer is gone
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        it = iter(iterable)
+        try:
+            for item in it:
+                if not send(item):
+                    return
+            send(done)
+        except BaseException as e:
+            send(e)
+        finally:
+            if stop.is_set():
+                # Consumer abandoned: release the upstream generator (and the S3 listing it holds)
+                close = getattr(it, "close", None)
+                if close is not None:
+                    close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+class SnapshotWriter:
+    """Appends row batches to a local parquet file, uploaded to data/<date>/scan_metadata.parquet at the end."""
+
+    def __init__(self):
+        self.file = tempfile.NamedTemporaryFile(suffix=".parquet", delete=False)
+        self.file.close()
+        self.rows = 0
+
+    def append(self, df):
+        df["albumTrack"] = df["albumTrack"].astype("int64")
+        df["discNumber"] = df["discNumber"].astype("Int64")
+        df["size"] = df["size"].astype("Int64")
+        df["last_modified"] = pd.to_datetime(df["last_modified"], utc=True)
+        fastparquet.write(self.file.name, df, append=self.rows > 0, object_encoding="utf8")
+        self.rows += len(df)
+
+    def discard(self):
+        os.unlink(self.file.name)
+
+    def upload(self, s3_client, bucket):
+        try:
+            if self.rows:
+                date_str = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+                parquet_key = f"data/{date_str}/scan_metadata.parquet"
+                with open(self.file.name, "rb") as f:
+                    s3_client.put_object(
+                        Bucket=bucket,
+                        Key=parquet_key,
+                        Body=f,
+                        ContentType="application/vnd.apache.parquet"
+                    )
+                logger.info(f"Parquet metadata uploaded to {bucket}/{parquet_key}")
+        except Exception as e:
+            logger.error(f"Failed to generate/upload parquet metadata: {e}")
+        finally:
+            os.unlink(self.file.name)
+
+def normalize_snapshot(df, bucket_name):
+    """Snapshot frame reduced to SNAPSHOT_COLUMNS, with the defaults of the scan rows filled in column-wise."""
+    df = df.reindex(columns=SNAPSHOT_COLUMNS)
+    for col, default in (("artist", "Unknown"), ("album", "Unknown"), ("title", "Unknown"), ("duration", "00:00"),
+                         ("bucket", bucket_name), ("coverBucket", bucket_name)):
+        df[col] = df[col].where(df[col].notna() & (df[col] != ""), default)
+    track = pd.to_numeric(df["albumTrack"], errors="coerce").fillna(1).astype("int64")
+    df["albumTrack"] = track.where(track > 0, 1)
+    return df
+
+def iter_snapshot_batches(df, batch_size, as_frames=False):
+    """Slices of a normalized snapshot, in the same flat shape as the scan pipeline output."""
+    for start in range(0, len(df), batch_size):
+        chunk = df.iloc[start:start + batch_size]
+        if as_frames:
+            yield chunk
+        else:
+            yield chunk.astype(object).where(chunk.notna(), None).to_dict("records")
+
+STAGING_COLUMNS = ["artist", "album", "genres", "title", "duration", "albumTrack", "path", "bucket", "cover", "coverSmall", "coverBucket"]
+
+def staging_frame(df, library_id):
+    """Scan rows as the columns of tracks_staging, ready for to_csv + COPY."""
+    out = df.reindex(columns=STAGING_COLUMNS).copy()
+    out["genres"] = out["genres"].fillna("").str.replace(r"\s*,\s*", ",", regex=True).str.strip(",")
+    out.insert(len(out.columns), "date", None)
+    out.insert(len(out.columns), "library_id", library_id)
+    return out
+
+class ScanCancelled(Exception):
+    pass
+
+def iter_scan_batches(endpoint, access_key, secret_key, bucket_name, mode="full", batch_size=SCAN_BATCH_SIZE, stats=None, as_frames=False, cancel=None):
+    """Scan pipeline yielding batches of flat track rows (the parquet snapshot columns).
+
+    listing pages (own thread) -> metadata workers -> cover workers -> batches for the caller to ingest.
+    Every stage is bounded, so memory depends on the batch and window sizes, not on the bucket size.
+    stats, when given, is a dict updated with listed/read/carried/bytes_fetched/artists/albums/tracks
+    counters while the scan runs (listing_done once every key is listed).
+    as_frames yields DataFrames instead of lists of dicts; parquet mode then never builds per-row objects.
+    cancel is an optional threading.Event: once set, the scan stops with ScanCancelled.
+    """
+    s3_client = make_s3_client(endpoint, access_key, secret_key)
+    if stats is None:
+        stats = {}
+    stats.update(listed=0, listing_done=False, read=0, carried=0, bytes_fetched=0, artists=0, albums=0, tracks=0)
+    stats_lock = threading.Lock()
 
     if mode == "parquet":
         logger.info(f"Mode: Parquet Scan - Looking for metadata in {bucket_name}/data/")
         try:
-            paginator = s3_client.get_paginator("list_objects_v2")
-            parquet_files = []
-            for page in paginator.paginate(Bucket=bucket_name, Prefix="data/"):
-                for obj in page.get("Contents", []):
-                    if obj["Key"].endswith(".parquet"):
-                        parquet_files.append(obj)
-            
-            if not parquet_files:
-                logger.warning("No parquet metadata found. Falling back to full scan.")
-                mode = "full"
-            else:
-                # Get the latest one
-                latest_parquet = max(parquet_files, key=lambda x: x["LastModified"])
-                logger.info(f"Loading metadata from: {latest_parquet['Key']}")
-                obj = s3_client.get_object(Bucket=bucket_name, Key=latest_parquet["Key"])
-                df = pd.read_parquet(BytesIO(obj["Body"].read()))
-                
-                # Reconstruct processed_data from DF
-                for _, row in df.iterrows():
-                    # Artist
-                    art_name = row.get("artist", "Unknown")
-                    if art_name not in artist_map:
-                        a_id_str = str(current_artist_id)
-                        artist_map[art_name] = a_id_str
-                        processed_data["artists"][a_id_str] = {"id": current_artist_id, "name": art_name, "image": row.get("artist_image", ""), "listAlbums": []}
-                        current_artist_id += 1
-                    a_id_str = artist_map[art_name]
-
-                    # Album
-                    alb_name = row.get("album", "Unknown")
-                    alb_key = f"{art_name} - {alb_name}"
-                    if alb_key not in album_map:
-                        al_id_str = str(current_album_id)
-                        album_map[alb_key] = al_id_str
-                        processed_data["albums"][al_id_str] = {
-                            "id": current_album_id,
-                            "name": alb_name,
-                            "artistId": [int(a_id_str)],
-                            "genreIds": [],
-                            "cover": row.get("cover", ""),
-                            "coverSmall": row.get("coverSmall", ""),
-                            "coverBucket": row.get("coverBucket", bucket_name),
-                            "listMusique": []
-                        }
-                        processed_data["artists"][a_id_str]["listAlbums"].append(current_album_id)
-                        current_album_id += 1
-                    al_id_str = album_map[alb_key]
-
-                    # Genres
-                    row_genres = row.get("genres", "")
-                    if isinstance(row_genres, str) and row_genres:
-                        g_names = [g.strip() for g in row_genres.split(",")]
-                        for gn in g_names:
-                            if gn not in genre_map:
-                                gn_id_str = str(current_genre_id)
-                                genre_map[gn] = gn_id_str
-                                processed_data["genres"][gn_id_str] = {"id": current_genre_id, "name": gn}
-                                current_genre_id += 1
-                            
-                            gid = int(genre_map[gn])
-                            if gid not in processed_data["albums"][al_id_str]["genreIds"]:
-                                processed_data["albums"][al_id_str]["genreIds"].append(gid)
-
-                    # Track
-                    t_id_str = str(current_track_id)
-                    processed_data["tracks"][t_id_str] = {
-                        "id": current_track_id,
-                        "title": row.get("title", "Unknown"),
-                        "duration": row.get("duration", "00:00"),
-                        "artistId": int(a_id_str),
-                        "albumId": int(al_id_str),
-                        "albumTrack": row.get("albumTrack", 1),
-                        "path": row.get("path"),
-                        "bucket": row.get("bucket", bucket_name)
-                    }
-                    processed_data["albums"][al_id_str]["listMusique"].append(current_track_id)
-                    current_track_id += 1
-                
-                return processed_data
-
+            df = load_latest_snapshot(s3_client, bucket_name, columns=SNAPSHOT_COLUMNS)
         except Exception as e:
             logger.error(f"Error in parquet mode: {e}")
+            df = None
+        if df is None:
+            logger.warning("No parquet metadata found. Falling back to full scan.")
             mode = "full"
+        else:
+            df = normalize_snapshot(df, bucket_name)
+            stats.update(listed=len(df), listing_done=True, artists=int(df["artist"].nunique()), albums=int(df[["artist", "album"]].drop_duplicates().shape[0]), tracks=len(df))
+            yield from iter_snapshot_batches(df, batch_size, as_frames)
+            return
+
+    # Incremental : seuls les objets nouveaux ou modifiés (ETag/taille) sont relus
+    previous = load_manifest(s3_client, bucket_name) if mode == "incremental" else {}
+
+    covers = CoverStore(s3_client, bucket_name)
+    cover_pool = ThreadPoolExecutor(max_workers=COVER_WORKERS)
+    album_covers = {} # "artist - album" -> Future of (cover, coverSmall), claimed by the first reader finding a picture
+    album_covers_lock = threading.Lock()
+
+    def claim_cover(album_key, keys=None):
+        """True if this call is the first for the album; keys resolves the claim right away (carried or missing covers)."""
+        with album_covers_lock:
+            if album_key in album_covers:
+                return False
+            future = album_covers[album_key] = Future()
+        if keys is not None:
+            future.set_result(keys)
+        return True
+
+    def object_metadata(obj):
+        row = previous.get(obj["Key"])
+        if row is not None and row.get("etag") == obj.get("ETag") and row.get("size") == obj.get("Size"):
+            meta = carried_metadata(row, bucket_name)
+            if meta["cover"]:
+                claim_cover(f"{meta['artist']} - {meta['album']}", (meta["cover"], meta["coverSmall"]))
+            return obj, meta
+
+        # La pochette n'est extraite que tant que l'album n'en a pas
+        meta = read_audio_metadata_s3(
+            s3_client, bucket_name, obj["Key"],
+            want_cover=lambda artist, album: f"{artist} - {album}" not in album_covers
+        )
+        with stats_lock:
+            stats["bytes_fetched"] += meta.pop("bytes_fetched", 0)
+        cover_data = meta.pop("cover_data")
+        album_key = f"{meta['artist']} - {meta['album']}"
+        if cover_data and claim_cover(album_key):
+            future = album_covers[album_key]
+            cover_pool.submit(covers.store, cover_data).add_done_callback(lambda f: future.set_result(f.result()))
+        return obj, meta
+
+    artists = set()
+    albums = {} # "artist - album" -> {"cover", "coverSmall", "future", "genres", "tracks"}
+    pending = deque() # (row, album) waiting for the album cover
+    batch = []
+    snapshot = SnapshotWriter()
+    window = SCAN_WORKERS * 4
+
+    def emit():
+        nonlocal batch
+        out, batch = batch, []
+        stats.update(artists=len(artists), albums=len(albums), tracks=stats["tracks"] + len(out))
+        frame = pd.DataFrame(out, columns=SNAPSHOT_COLUMNS)
+        snapshot.append(frame)
+        return frame if as_frames else out
+
+    def finish(row, album):
+        if album["future"] is not None:
+            album["cover"], album["coverSmall"] = album["future"].result()
+            album["future"] = None
+        row["cover"], row["coverSmall"] = album["cover"], album["coverSmall"]
+        batch.append(row)
 
-    music_files_keys = list_s3_music_files(s3_client, bucket_name)
-    
-    for key in tqdm(music_files_keys, desc=f"Scanning {bucket_name} ({mode})"):
-        # Incremental skip
-        if mode == "incremental" and key in existing_paths:
-            # We still need to know about it to keep it in the DB, 
-            # but maybe we don't need to read its metadata again if we trust the DB.
-            # HOWEVER, for simplicity of the trigger_bucket_scan logic in main.py,
-            # it's better if we return the full list of what should be in the DB.
-            # So if it's already in existing_paths, we might want to "know" it's there.
-            # Wait, if we skip it here, it won't be in the returned processed_data.
-            # So let's re-read it only if it's new, OR if it's a full scan.
-            
-            # If we want to be REALLY fast in incremental mode, we need to fetch info from DB.
-            # But the scanner doesn't have access to the DB.
-            # Let's just do a full scan for now but prepare for optimization.
-            # User said "ajoute les nouvelle musique et eleve les musique qui ne sont plus disponible"
-            # Reading metadata is the slow part.
-            pass
-
-        meta = read_audio_metadata_s3(s3_client, bucket_name, key)
-        artist_name = meta["artist"]
-        album_name = meta["album"]
-        genre_names = meta["genre"]
-
-        if artist_name not in artist_map:
-            artist_id_str = str(current_artist_id)
-            artist_map[artist_name] = artist_id_str
-            processed_data["artists"][artist_id_str] = {"id": current_artist_id, "name": artist_name, "image": "", "listAlbums": []}
-            current_artist_id += 1
-        artist_id_str = artist_map[artist_name]
-
-        album_key = f"{artist_name} - {album_name}"
-        if album_key not in album_map:
-            album_id_str = str(current_album_id)
-            album_map[album_key] = album_id_str
-            
-            cover_full_key = ""
-            cover_small_key = ""
-            if meta["cover_base64"]:
-                cover_full_key = upload_cover_s3(s3_client, meta["cover_base64"], f"{album_name}_cover", bucket_name)
-                cover_small_key = upload_cover_s3(s3_client, meta["cover_base64"], f"{album_name}_cover_small", bucket_name, size=(40, 40))
-
-            processed_data["albums"][album_id_str] = {
-                "id": current_album_id,
-                "name": album_name,
-                "artistId": [int(artist_id_str)],
-                "genreIds": [],
-                "cover": cover_full_key,
-                "coverSmall": cover_small_key,
-                "coverBucket": bucket_name,
-                "listMusique": []
+    try:
+        with cover_pool:
+            def listed_objects():
+                for obj in iter_s3_music_objects(s3_client, bucket_name):
+                    stats["listed"] += 1
+                    yield obj
+                stats["listing_done"] = True
+
+            objects = prefetch(listed_objects())
+            metas = parallel_map_ordered(object_metadata, objects)
+
+            for obj, meta in tqdm(metas, desc=f"Scanning {bucket_name} ({mode})"):
+                if cancel is not None and cancel.is_set():
+                    raise ScanCancelled(bucket_name)
+                stats["carried" if "cover" in meta else "read"] += 1
+                artist_name = meta["artist"]
+                album_name = meta["album"]
+                artists.add(artist_name)
+
+                album_key = f"{artist_name} - {album_name}"
+                album = albums.get(album_key)
+                if album is None:
+                    claim_cover(album_key, ("", "")) # no picture found so far: the album stays without cover
+                    album = {"cover": "", "coverSmall": "", "future": album_covers[album_key], "genres": [], "tracks": 0}
+                    albums[album_key] = album
+
+                for gname in meta["genre"]:
+                    if gname not in album["genres"]:
+                        album["genres"].append(gname)
+                album["tracks"] += 1
+
+                pending.append(({
+                    "title": meta["title"],
+                    "artist": artist_name,
+                    "artist_image": "",
+                    "album": album_name,
+                    "duration": meta["duration"],
+                    "path": meta["path"],
+                    # Numéro de piste du tag, sinon position dans l'ordre du scan
+                    "albumTrack": meta.get("track") or album["tracks"],
+                    "discNumber": meta.get("disc"),
+                    "genres": ", ".join(album["genres"]),
+                    "cover": "",
+                    "coverSmall": "",
+                    "coverBucket": bucket_name,
+                    "bucket": bucket_name,
+                    # Manifest de l'objet pour le prochain scan incrémental
+                    "etag": obj.get("ETag"),
+                    "size": obj.get("Size"),
+                    "last_modified": obj.get("LastModified")
+                }, album))
+
+                # Les lignes sortent dans l'ordre, dès que la pochette de leur album est prête
+                while pending and (len(pending) > window or pending[0][1]["future"] is None or pending[0][1]["future"].done()):
+                    finish(*pending.popleft())
+                    if len(batch) >= batch_size:
+                        yield emit()
+
+            while pending:
+                finish(*pending.popleft())
+                if len(batch) >= batch_size:
+                    yield emit()
+
+        if batch:
+            yield emit()
+        stats.update(artists=len(artists), albums=len(albums))
+        if mode == "incremental":
+            logger.info(f"Incremental scan of {bucket_name}: {stats['carried']} unchanged, {stats['read']} read.")
+    except BaseException:
+        # Scan interrompu (erreur, annulation) : pas de snapshot partiel
+        snapshot.discard()
+        raise
+    snapshot.upload(s3_client, bucket_name)
+
+def scan_bucket_for_music_metadata(endpoint, access_key, secret_key, bucket_name, mode="full", existing_paths=None):
+    """Whole scan as the nested artists/albums/tracks/genres dicts used by the row-by-row ingestion."""
+    processed_data = {"artists": {}, "albums": {}, "tracks": {}, "genres": {}}
+    artist_map = {}
+    album_map = {}
+    genre_map = {}
+
+    for batch in iter_scan_batches(endpoint, access_key, secret_key, bucket_name, mode=mode):
+        for row in batch:
+            art_name = row["artist"]
+            if art_name not in artist_map:
+                a_id = len(artist_map) + 1
+                artist_map[art_name] = a_id
+                processed_data["artists"][str(a_id)] = {"id": a_id, "name": art_name, "image": row.get("artist_image") or "", "listAlbums": []}
+            a_id = artist_map[art_name]
+
+            alb_key = f"{art_name} - {row['album']}"
+            if alb_key not in album_map:
+                al_id = len(album_map) + 1
+                album_map[alb_key] = al_id
+                processed_data["albums"][str(al_id)] = {
+                    "id": al_id,
+                    "name": row["album"],
+                    "artistId": [a_id],
+                    "genreIds": [],
+                    "cover": row.get("cover") or "",
+                    "coverSmall": row.get("coverSmall") or "",
+                    "coverBucket": row.get("coverBucket") or bucket_name,
+                    "listMusique": []
+                }
+                processed_data["artists"][str(a_id)]["listAlbums"].append(al_id)
+            album = processed_data["albums"][str(album_map[alb_key])]
+
+            for gn in [g.strip() for g in (row.get("genres") or "").split(",") if g.strip()]:
+                if gn not in genre_map:
+                    genre_map[gn] = len(genre_map) + 1
+                    processed_data["genres"][str(genre_map[gn])] = {"id": genre_map[gn], "name": gn}
+                if genre_map[gn] not in album["genreIds"]:
+                    album["genreIds"].append(genre_map[gn])
+
+            t_id = len(processed_data["tracks"]) + 1
+            processed_data["tracks"][str(t_id)] = {
+                "id": t_id,
+                "title": row["title"],
+                "duration": row["duration"],
+                "artistId": a_id,
+                "albumId": album["id"],
+                "albumTrack": row["albumTrack"],
+                "path": row["path"],
+                "bucket": row["bucket"]
             }
-            processed_data["artists"][artist_id_str]["listAlbums"].append(current_album_id)
-            current_album_id += 1
-        album_id_str = album_map[album_key]
-
-        for gname in genre_names:
-            if gname not in genre_map:
-                genre_id_str = str(current_genre_id)
-                genre_map[gname] = genre_id_str
-                processed_data["genres"][genre_id_str] = {"id": current_genre_id, "name": gname}
-                current_genre_id += 1
-            
-            gid = int(genre_map[gname])
-            if gid not in processed_data["albums"][album_id_str]["genreIds"]:
-                processed_data["albums"][album_id_str]["genreIds"].append(gid)
-
-        track_id_str = str(current_track_id)
-        processed_data["tracks"][track_id_str] = {
-            "id": current_track_id,
-            "title": meta["title"],
-            "duration": meta["duration"],
-            "artistId": int(artist_id_str),
-            "albumId": int(album_id_str),
-            "albumTrack": len(processed_data["albums"][album_id_str]["listMusique"]) + 1,
-            "path": meta["path"],
-            "bucket": bucket_name
-        }
-        processed_data["albums"][album_id_str]["listMusique"].append(current_track_id)
-        current_track_id += 1
-
-    # Format the data into a flat list for pandas
-    flat_data = []
-    for t_id, track in processed_data["tracks"].items():
-        album = processed_data["albums"][str(track["albumId"])]
-        artist = processed_data["artists"][str(track["artistId"])]
-        
-        # Collect genre names
-        g_names = []
-        for gid in album.get("genreIds", []):
-            g_names.append(processed_data["genres"][str(gid)]["name"])
-        
-        flat_data.append({
-            "title": track["title"],
-            "artist": artist["name"],
-            "artist_image": artist.get("image", ""),
-            "album": album["name"],
-            "duration": track["duration"],
-            "path": track["path"],
-            "albumTrack": track["albumTrack"],
-            "genres": ", ".join(g_names),
-            "cover": album.get("cover", ""),
-            "coverSmall": album.get("coverSmall", ""),
-            "coverBucket": album.get("coverBucket", bucket_name),
-            "bucket": track["bucket"]
-        })
-    
-    if flat_data:
-        try:
-            df = pd.DataFrame(flat_data)
-            buffer = BytesIO()
-            df.to_parquet(buffer, index=False)
-            buffer.seek(0)
-
-            date_str = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-            parquet_key = f"data/{date_str}/scan_metadata.parquet"
-            
-            s3_client.put_object(
-                Bucket=bucket_name,
-                Key=parquet_key,
-                Body=buffer,
-                ContentType="application/vnd.apache.parquet"
-            )
-            logger.info(f"Parquet metadata uploaded to {bucket_name}/{parquet_key}")
-        except Exception as e:
-            logger.error(f"Failed to generate/upload parquet metadata: {e}")
+            album["listMusique"].append(t_id)
 
     return processed_data
 
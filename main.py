@@ -1,21 +1,25 @@
 
-from fastapi import FastAPI, Depends, HTTPException, Body
+from fastapi import FastAPI, Depends, HTTPException, Body, Query, Request
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Literal, Dict, Any
 import os
 from passlib.context import CryptContext
-from auth import verify_token, create_token
-from repositories import repo, bucketS3
+from auth import verify_token, create_token, invalidate_principal, load_user_likes, load_user_history
+from repositories import repo, bucketS3, genre_index, history_buffer
 from dotenv import load_dotenv
 import logging
 import uuid
+import json
+import base64
 from datetime import datetime, timedelta
 import smtplib
 from email.mime.text import MIMEText
 
 # Import the bucket scanner
-from bucket_scanner import scan_bucket_for_music_metadata
+from bucket_scanner import iter_scan_batches, staging_frame, ScanCancelled
+from scan_jobs import ScanJobManager, ScanConflict
 from artist_image_scanner import scan_artists_for_images
 
 import asyncio
@@ -25,6 +29,8 @@ load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+TRACK_URL_BATCH_MAX = int(os.getenv("TRACK_URL_BATCH_MAX", 200))
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 def get_password_hash(password):
@@ -43,11 +49,30 @@ async def top_genres_job():
         # Sleep for 24 hours (24 * 60 * 60 seconds)
         await asyncio.sleep(24 * 60 * 60)
 
+def rebuild_genre_index():
+    try:
+        genre_index.rebuild()
+    except Exception as e:
+        logger.error(f"Error rebuilding genre index: {e}")
+
+def log_task_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task {task.get_name()} failed: {task.exception()!r}")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Run the job immediately on startup
-    asyncio.create_task(top_genres_job())
+    # La boucle ne garde qu'une référence faible : les tâches restent sur app.state
+    app.state.background_tasks = [
+        asyncio.create_task(top_genres_job(), name="top_genres_job"),
+        asyncio.create_task(asyncio.to_thread(rebuild_genre_index), name="rebuild_genre_index")
+    ]
+    for task in app.state.background_tasks:
+        task.add_done_callback(log_task_failure)
+    # Politique publique des buckets vérifiée hors du démarrage, une fois par configuration
+    bucketS3.schedule_policy_verification()
     yield
+    await asyncio.to_thread(history_buffer.flush)
 
 app = FastAPI(lifespan=lifespan)
 app.add_middleware(
@@ -61,33 +86,8 @@ app.add_middleware(
 
 
 def get_base_url_for_bucket(identifier: int | str | None = None) -> str | None:
-    libraries = repo.get_libraries()
-    if not libraries:
-        return None
-    target = None
-    if isinstance(identifier, int):
-        for lib in libraries:
-            if lib.get("id") == identifier:
-                target = lib
-                break
-    elif isinstance(identifier, str):
-        for lib in libraries:
-            if lib.get("identifiers", {}).get("bucket_name") == identifier:
-                target = lib
-                break
-            if identifier in lib.get("url", ""):
-                target = lib
-                break
-    if not target:
-        target = libraries[0]
-    
-    if target:
-        url = target.get("url", "").rstrip("/")
-        bucket_name = target.get("identifiers", {}).get("bucket_name")
-        if bucket_name:
-            return f"{url}/{bucket_name}/"
-        return f"{url}/"
-    return None
+    # Served from the library index kept by bucketS3, rebuilt on refresh_configs()
+    return bucketS3.get_base_url(identifier)
 # ======================
 # AUTH
 # ======================
@@ -142,58 +142,17 @@ def login(payload: LoginPayload):
 def get_fresh_user(user):
     return repo.get_user_by_id(user["id"])
 
-def build_album(album_id: int, user):
-    album = repo.get_album(album_id)
+def build_album(album_id: int, likes):
+    album = repo.get_album_detail(album_id)
     if not album:
         return None
 
-    current_user = repo.get_user_by_id(user["id"])
-    liked_tracks = set(current_user.get("like", {}).get("track", []))
-    liked_albums = set(current_user.get("like", {}).get("album", []))
-
-    album_artist_ids = album.get("artistId", [])
-    album_artists = []
-    for aid in album_artist_ids:
-        artist = repo.get_artist(aid)
-        if artist:
-            album_artists.append({
-                "id": artist["id"],
-                "name": artist["name"]
-            })
-
-    genre_data = []
-    for gid in album.get("genreIds", []):
-        genre = repo.get_genre(gid)
-        if genre:
-            genre_data.append({
-                "id": genre["id"],
-                "name": genre["name"]
-            })
+    liked_tracks = likes.get("track", [])
+    liked_albums = likes.get("album", [])
 
-    tracks = []
-    for tid in album.get("listMusique", []):
-        t = repo.get_track(tid)
-        if not t:
-            continue
-
-        track_artist = repo.get_artist(t.get("artistId"))
-        track_artist_name = track_artist["name"] if track_artist else None
-
-        tracks.append({
-            "id": t["id"],
-            "title": t["title"],
-            "duration": t.get("duration"),
-            "albumName": album.get("name"),
-            "artistName": track_artist_name,
-            "artistId": t.get("artistId"),
-            "albumId": t.get("albumId"),
-            "albumTrack": t.get("albumTrack"),
-            "like": t["id"] in liked_tracks,
-            "coverSmall": (get_base_url_for_bucket(album.get("coverBucket") or 1) + album.get("coverSmall")) if album and album.get("coverSmall") else None,
-            "path": None # URL fetched on demand
-        })
-
-    tracks.sort(key=lambda x: x["albumTrack"])
+    album_artists = album.get("artists", [])
+    cover_fields = {"albumName": album.get("name"), "coverSmall": album.get("coverSmall"), "coverBucket": album.get("coverBucket")}
+    tracks = [format_track({**t, **cover_fields}, liked_tracks) for t in album.get("tracks", [])]
 
     return {
         "id": album["id"],
@@ -201,43 +160,99 @@ def build_album(album_id: int, user):
         "artist": album_artists,
         "artistName": album_artists[0]["name"] if album_artists else None, 
         "artistId": album_artists[0]["id"] if album_artists else None,
-        "genres": genre_data,
-        "cover": (get_base_url_for_bucket(album.get("coverBucket") or 1) + album.get("cover")) if album and album.get("cover") else None,
+        "genres": album.get("genres", []),
+        "cover": (get_base_url_for_bucket(album.get("coverBucket") or 1) + album.get("cover")) if album.get("cover") else None,
         "like": album["id"] in liked_albums,
         "listMusique": tracks
     }
 
 
-def build_playlist(pid: int, user):
+def format_track(t, liked_tracks):
+    """Shape a row from repo.get_tracks_enriched for the frontend."""
+    return {
+        "id": t["id"],
+        "title": t["title"],
+        "duration": t.get("duration"),
+        "albumName": t.get("albumName"),
+        "artistName": t.get("artistName"),
+        "artistId": t.get("artistId"),
+        "albumId": t.get("albumId"),
+        "albumTrack": t.get("albumTrack"),
+        "like": t["id"] in liked_tracks,
+        "coverSmall": (get_base_url_for_bucket(t.get("coverBucket") or 1) + t.get("coverSmall")) if t.get("coverSmall") else None,
+        "path": None # URL fetched on demand
+    }
+
+
+def format_album_row(a, liked_albums):
+    """Shape a row from repo.albums_page for the frontend."""
+    base_url = get_base_url_for_bucket(a.get("coverBucket") or 1)
+    return {
+        "id": a["id"],
+        "name": a.get("name"),
+        "like": a["id"] in liked_albums,
+        "artistName": a.get("artistName"),
+        "artistId": a.get("artistId"),
+        "cover": (base_url + a.get("cover")) if base_url and a.get("cover") else None,
+    }
+
+
+def format_artist_row(a, liked_artists):
+    return {
+        "id": a["id"],
+        "name": a["name"],
+        "like": a["id"] in liked_artists,
+        "image": get_base_url_for_bucket(a.get("bucket") or 1) + a.get("image") if a.get("image") else None,
+    }
+
+
+def encode_cursor(row):
+    return base64.urlsafe_b64encode(json.dumps([row.get("name"), row["id"]]).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        name, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return (name or "", int(last_id))
+    except (ValueError, TypeError):
+        raise HTTPException(400, "Invalid cursor")
+
+
+def paginate(fetch_page, count, limit, cursor, with_total, formatter):
+    """Keyset pagination: without limit the whole list is returned, as before."""
+    if not limit:
+        return [formatter(r) for r in fetch_page(None, None)]
+    rows = fetch_page(limit, decode_cursor(cursor) if cursor else None)
+    return {
+        "items": [formatter(r) for r in rows],
+        "next_cursor": encode_cursor(rows[-1]) if len(rows) == limit else None,
+        "total": count() if with_total else None
+    }
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def ndjson_response(rows):
+    """Stream rows one JSON document per line, as the repository iterator yields them."""
+    def lines():
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False, default=lambda o: o.isoformat() if hasattr(o, "isoformat") else str(o)) + "\n"
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
+
+
+def build_playlist(pid: int, likes):
     playlist = repo.get_playlist(pid)
     if not playlist:
         return None
 
-    current_user = repo.get_user_by_id(user["id"])
-    liked_tracks = set(current_user.get("like", {}).get("track", []))
-
-    tracks = []
-    for tid in playlist.get("listMusique", []):
-        t = repo.get_track(tid)
-        if not t:
-            continue
-
-        album = repo.get_album(t["albumId"])
-        artist = repo.get_artist(t["artistId"])
-
-        tracks.append({
-            "id": t["id"],
-            "title": t["title"],
-            "duration": t.get("duration"),
-            "albumName": album.get("name") if album else None,
-            "artistName": artist.get("name") if artist else None,
-            "artistId": t.get("artistId"),
-            "albumId": t.get("albumId"),
-            "albumTrack": t.get("albumTrack"),
-            "like": t["id"] in liked_tracks,
-            "coverSmall": (get_base_url_for_bucket(album.get("coverBucket") or 1) + album.get("coverSmall")) if album and album.get("coverSmall") else None,
-            "path": None # URL fetched on demand
-        })
+    liked_tracks = likes.get("track", [])
+
+    tracks = [format_track(t, liked_tracks) for t in repo.get_tracks_enriched(playlist.get("listMusique", []))]
 
     return {
         "id": playlist["id"],
@@ -258,11 +273,9 @@ class ChangeUsernamePayload(BaseModel):
 
 @app.post("/user/username")
 def change_username(payload: ChangeUsernamePayload, user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
     try:
         repo.set_username(user["id"], payload.username)
+        invalidate_principal(user["id"])
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -275,9 +288,6 @@ class ChangePasswordPayload(BaseModel):
 
 @app.post("/user/password")
 def change_password(payload: ChangePasswordPayload, user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
     try:
         repo.set_user_password(user["id"], get_password_hash(payload.password))
     except Exception as e:
@@ -292,14 +302,14 @@ class SetRolePayload(BaseModel):
 
 @app.post("/admin/user/role")
 def set_role(payload: SetRolePayload = Body(...), user=Depends(verify_token)):
-    current = repo.get_user_by_id(user["id"])
-    if not current or current.get("role") != "admin":
+    if user.get("role") != "admin":
         raise HTTPException(403, "ADMIN_REQUIRED")
 
     # Handle alias or direct field
     uid = payload.user_id
     try:
         repo.set_user_role(uid, payload.role)
+        invalidate_principal(uid)
     except Exception as e:
         raise HTTPException(400, str(e))
 
@@ -308,10 +318,11 @@ def set_role(payload: SetRolePayload = Body(...), user=Depends(verify_token)):
         "role": payload.role
     }
 @app.post("/admin/user/listUser")
-def list_users(user=Depends(verify_token)): # Renamed to list_users for clarity
-    current = repo.get_user_by_id(user["id"])
-    if not current or current.get("role") != "admin":
+def list_users(request: Request, user=Depends(verify_token)): # Renamed to list_users for clarity
+    if user.get("role") != "admin":
         raise HTTPException(403, "ADMIN_REQUIRED")
+    if wants_ndjson(request):
+        return ndjson_response(repo.iter_users())
     try:
         users = repo.get_user_all()
     except Exception as e:
@@ -328,8 +339,7 @@ class CreateUserPayload(BaseModel):
 
 @app.post("/admin/user/create")
 def create_user(payload: CreateUserPayload, user=Depends(verify_token)):
-    current = repo.get_user_by_id(user["id"])
-    if not current or current.get("role") != "admin":
+    if user.get("role") != "admin":
         raise HTTPException(403, "ADMIN_REQUIRED")
 
     try:
@@ -384,25 +394,25 @@ def register(payload: RegisterPayload):
 def delete_self(user=Depends(verify_token)):
     try:
         repo.delete_user(user["id"])
+        invalidate_principal(user["id"])
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
     return {"message": "Account deleted successfully"}
 
 @app.delete("/admin/user/{user_id}")
 def delete_user_admin(user_id: int, user=Depends(verify_token)):
-    current = repo.get_user_by_id(user["id"])
-    if not current or current.get("role") != "admin":
+    if user.get("role") != "admin":
         raise HTTPException(403, "ADMIN_REQUIRED")
     try:
         repo.delete_user(user_id)
+        invalidate_principal(user_id)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
     return {"message": f"User {user_id} deleted successfully"}
 
 @app.post("/admin/generateToken")
 def generate_token(user=Depends(verify_token)):
-    current = repo.get_user_by_id(user["id"])
-    if not current or current.get("role") != "admin":
+    if user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="ADMIN_REQUIRED")
 
     token = repo.create_registration_token()
@@ -418,8 +428,7 @@ class LibraryPayload(BaseModel):
 
 @app.get("/admin/libraries")
 def get_libraries(user=Depends(verify_token)):
-    current = repo.get_user_by_id(user["id"])
-    if not current or current.get("role") != "admin":
+    if user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="ADMIN_REQUIRED")
     
     raw_libraries = repo.get_libraries() 
@@ -456,8 +465,7 @@ def get_libraries(user=Depends(verify_token)):
 
 @app.post("/admin/libraries")
 def create_library(payload: LibraryPayload, user=Depends(verify_token)):
-    current = repo.get_user_by_id(user["id"])
-    if not current or current.get("role") != "admin":
+    if user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="ADMIN_REQUIRED")
     
     try:
@@ -482,6 +490,7 @@ def create_library(payload: LibraryPayload, user=Depends(verify_token)):
         new_lib = repo.add_library(library_data_for_db)
         # Refresh S3 client configurations after adding a new one
         bucketS3.refresh_configs() 
+        bucketS3.schedule_policy_verification()
         logger.info(f"Library '{payload.name}' created successfully.")
         return new_lib
     except Exception as e:
@@ -490,8 +499,7 @@ def create_library(payload: LibraryPayload, user=Depends(verify_token)):
 
 @app.put("/admin/libraries/{index}")
 def update_library(index: int, payload: LibraryPayload, user=Depends(verify_token)):
-    current = repo.get_user_by_id(user["id"])
-    if not current or current.get("role") != "admin":
+    if user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="ADMIN_REQUIRED")
     
     try:
@@ -515,6 +523,7 @@ def update_library(index: int, payload: LibraryPayload, user=Depends(verify_toke
         updated = repo.update_library(index, library_data_for_db)
         # Refresh S3 client configurations after updating one
         bucketS3.refresh_configs()
+        bucketS3.schedule_policy_verification()
         logger.info(f"Library {index} updated successfully.")
         return updated
     except IndexError:
@@ -526,14 +535,14 @@ def update_library(index: int, payload: LibraryPayload, user=Depends(verify_toke
 
 @app.delete("/admin/libraries/{library_id}")
 def delete_library_endpoint(library_id: int, user=Depends(verify_token)):
-    current = repo.get_user_by_id(user["id"])
-    if not current or current.get("role") != "admin":
+    if user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="ADMIN_REQUIRED")
     
     try:
         success = repo.delete_library(library_id)
         if success:
             bucketS3.refresh_configs()
+            rebuild_genre_index()
             logger.info(f"Library {library_id} deleted successfully.")
             return {"message": "Library deleted successfully."}
     except KeyError:
@@ -548,32 +557,16 @@ class ScanRequest(BaseModel):
     mode: Literal["parquet", "incremental", "full"] = "incremental"
 
 import io
-import csv
 
-# --- New endpoint for scanning bucket ---
-@app.post("/admin/scan-bucket")
-def trigger_bucket_scan(req: ScanRequest = Body(default=ScanRequest()), user=Depends(verify_token)):
-    current = repo.get_user_by_id(user["id"])
-    if not current or current.get("role") != "admin":
-        raise HTTPException(status_code=403, detail="ADMIN_REQUIRED")
+scan_jobs = ScanJobManager()
 
+def run_scan_job(job, libraries, mode):
+    """Body of a scan job (worker thread): scan each library into staging, import it, then remove stale tracks."""
+    total_scanned = {"artists_scanned": 0, "albums_scanned": 0, "tracks_scanned": 0, "tracks_removed": 0}
     try:
-        logger.info(f"Received request to scan. Mode: {req.mode}, Body library_id: {req.library_id}")
-        all_libraries = repo.get_libraries()
-        
-        libraries_to_scan = []
-        if req.library_id:
-            libraries_to_scan = [lib for lib in all_libraries if lib.get("id") == req.library_id]
-            if not libraries_to_scan:
-                raise HTTPException(status_code=404, detail=f"Library with ID {req.library_id} not found.")
-        else:
-            libraries_to_scan = all_libraries
-
-        total_scanned = {"artists_scanned": 0, "albums_scanned": 0, "tracks_scanned": 0, "tracks_removed": 0}
-        
-        is_postgres = hasattr(repo, 'copy_to_staging')
-
-        for lib in libraries_to_scan:
+        for lib in libraries:
+            if job.cancel_event.is_set():
+                break
             url = lib.get("url")
             ids = lib.get("identifiers", {})
             lib_id = lib.get("id")
@@ -593,155 +586,114 @@ def trigger_bucket_scan(req: ScanRequest = Body(default=ScanRequest()), user=Dep
             if bucket_name in url:
                 endpoint_url = url.split(bucket_name)[0]
 
-            logger.info(f"Scanning library: {lib.get('name')} (Bucket: {bucket_name}) - Mode: {req.mode}")
-            
-            # Fetch existing paths for incremental scan or cleanup
-            existing_paths = repo.get_track_paths_by_library(lib_id)
+            logger.info(f"Scanning library: {lib.get('name')} (Bucket: {bucket_name}) - Mode: {mode}")
+            job.start_library(lib_id)
             
-            scanned_data = scan_bucket_for_music_metadata(
+            scan_args = dict(
                 endpoint=endpoint_url,
                 access_key=ids.get("aws_access_key_id"),
                 secret_key=ids.get("aws_secret_access_key"),
                 bucket_name=bucket_name,
-                mode=req.mode,
-                existing_paths=existing_paths
+                mode=mode
             )
 
             # Keep track of paths found in this scan
             scanned_paths = set()
-            for s_trk in scanned_data["tracks"].values():
-                scanned_paths.add(s_trk["path"])
-
-            if is_postgres:
-                # Optimized PostgreSQL Bulk Load
-                output = io.StringIO()
-                writer = csv.writer(output, delimiter='\t')
-                
-                for s_trk_id, s_trk in scanned_data["tracks"].items():
-                    art_name = scanned_data["artists"][str(s_trk["artistId"])]["name"]
-                    alb_obj = scanned_data["albums"][str(s_trk["albumId"])]
-                    alb_name = alb_obj["name"]
-                    
-                    # Genres for this album
-                    genre_names = []
-                    for gid in alb_obj.get("genreIds", []):
-                        genre_names.append(scanned_data["genres"][str(gid)]["name"])
-                    
-                    writer.writerow([
-                        art_name,
-                        alb_name,
-                        ",".join(genre_names),
-                        s_trk["title"],
-                        s_trk["duration"],
-                        s_trk.get("albumTrack", 0),
-                        s_trk["path"],
-                        s_trk["bucket"],
-                        alb_obj.get("cover"),
-                        alb_obj.get("coverSmall"),
-                        alb_obj.get("coverBucket"),
-                        alb_obj.get("date"),
-                        lib_id
-                    ])
-                
-                output.seek(0)
-                repo.copy_to_staging(output)
-                repo.bulk_import_from_staging()
-                
-                total_scanned["artists_scanned"] += len(scanned_data["artists"])
-                total_scanned["albums_scanned"] += len(scanned_data["albums"])
-                total_scanned["tracks_scanned"] += len(scanned_data["tracks"])
-            else:
-                # Standard row-by-row load (SQLite)
-                # Process Scanned Genres
-                genre_map = {} # local name -> id map for this scan
-                for s_gen_id, s_gen in scanned_data.get("genres", {}).items():
-                    name = s_gen["name"]
-                    db_gid = repo.ensure_genre(name)
-                    genre_map[name] = db_gid
-
-                # Process Scanned Artists
-                artist_map = {} # local name -> id map
-                for s_art_id, s_art in scanned_data["artists"].items():
-                    name = s_art["name"]
-                    db_aid = repo.ensure_artist(name, image=s_art["image"], library_id=lib_id)
-                    artist_map[name] = db_aid
-                    total_scanned["artists_scanned"] += 1
-
-                # Process Scanned Albums
-                album_map = {} # local "artist - album" -> id map
-                for s_alb_id, s_alb in scanned_data["albums"].items():
-                    art_name = scanned_data["artists"][str(s_alb["artistId"][0])]["name"]
-                    art_id = artist_map.get(art_name)
-                    
-                    # Get genre IDs for this album
-                    s_genre_ids = s_alb.get("genreIds", [])
-                    db_genre_ids = []
-                    for sgid in s_genre_ids:
-                        gname = scanned_data["genres"][str(sgid)]["name"]
-                        if gname in genre_map:
-                            db_genre_ids.append(genre_map[gname])
-
-                    db_albid = repo.ensure_album(
-                        name=s_alb["name"],
-                        artist_id=art_id,
-                        genre_ids=db_genre_ids,
-                        cover=s_alb["cover"],
-                        coverSmall=s_alb["coverSmall"],
-                        coverBucket=s_alb["coverBucket"],
-                        library_id=lib_id
-                    )
-                    album_map[f"{art_name} - {s_alb['name']}"] = db_albid
-                    total_scanned["albums_scanned"] += 1
-
-                # Process Scanned Tracks
-                for s_trk_id, s_trk in scanned_data["tracks"].items():
-                    art_name = scanned_data["artists"][str(s_trk["artistId"])]["name"]
-                    alb_name = scanned_data["albums"][str(s_trk["albumId"])]["name"]
-                    alb_id = album_map.get(f"{art_name} - {alb_name}")
-                    art_id = artist_map.get(art_name)
-                    
-                    if alb_id and art_id:
-                        repo.add_track(
-                            title=s_trk["title"],
-                            duration=s_trk["duration"],
-                            artist_id=art_id,
-                            album_id=alb_id,
-                            album_track=s_trk.get("albumTrack", 0),
-                            path=s_trk["path"],
-                            bucket=s_trk["bucket"],
-                            library_id=lib_id
-                        )
-                        total_scanned["tracks_scanned"] += 1
+
+            # Bulk load: each batch is copied to staging while the scan goes on
+            first_batch = True
+            try:
+                for frame in iter_scan_batches(**scan_args, stats=job.scan_stats, as_frames=True, cancel=job.cancel_event):
+                    scanned_paths.update(frame["path"])
+                    output = io.StringIO()
+                    staging_frame(frame, lib_id).to_csv(output, sep='\t', header=False, index=False)
+                    output.seek(0)
+                    repo.copy_to_staging(output, truncate=first_batch)
+                    first_batch = False
+                    job.rows_ingested += len(frame)
+            except ScanCancelled:
+                # Scan incomplet : ni import ni nettoyage pour cette bibliothèque
+                logger.info(f"Scan of library {lib_id} cancelled.")
+                break
+            if first_batch:
+                repo.copy_to_staging(io.StringIO(), truncate=True)
+            repo.bulk_import_from_staging()
+            
+            total_scanned["artists_scanned"] += job.scan_stats.get("artists", 0)
+            total_scanned["albums_scanned"] += job.scan_stats.get("albums", 0)
+            total_scanned["tracks_scanned"] += job.scan_stats.get("tracks", 0)
 
             # CLEANUP: Remove tracks that are in DB but NOT in scanned_paths
-            if req.mode in ["full", "incremental", "parquet"]:
-                paths_to_remove = set(existing_paths) - scanned_paths
-                for path in paths_to_remove:
-                    repo.delete_track_by_path(path, lib_id)
-                    total_scanned["tracks_removed"] += 1
+            if mode in ["full", "incremental", "parquet"]:
+                total_scanned["tracks_removed"] += repo.delete_tracks_not_in(lib_id, scanned_paths)
+            job.finish_library()
+    finally:
+        if job.libraries_done:
+            bucketS3.refresh_configs()
+            rebuild_genre_index()
 
-        bucketS3.refresh_configs()
-        
-        message = "Scan completed."
-        if req.mode == "parquet":
-            message = "Scan completed from Parquet metadata."
-        
-        return {
-            "message": message,
-            "artists_scanned": total_scanned["artists_scanned"],
-            "albums_scanned": total_scanned["albums_scanned"],
-            "tracks_scanned": total_scanned["tracks_scanned"],
-            "tracks_removed": total_scanned["tracks_removed"]
-        }
-    except Exception as e:
-        logger.exception("Scan failed")
-        raise HTTPException(status_code=500, detail=str(e))
+    message = "Scan completed."
+    if job.cancel_event.is_set():
+        message = "Scan cancelled."
+    elif mode == "parquet":
+        message = "Scan completed from Parquet metadata."
+    return {"message": message, **total_scanned}
+
+# --- Scan jobs: the scan runs in the background, progress is polled on /admin/scan-jobs/{job_id} ---
+@app.post("/admin/scan-bucket", status_code=202)
+def trigger_bucket_scan(req: ScanRequest = Body(default=ScanRequest()), user=Depends(verify_token)):
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="ADMIN_REQUIRED")
+
+    logger.info(f"Received request to scan. Mode: {req.mode}, Body library_id: {req.library_id}")
+    all_libraries = repo.get_libraries()
+    
+    libraries_to_scan = []
+    if req.library_id:
+        libraries_to_scan = [lib for lib in all_libraries if lib.get("id") == req.library_id]
+        if not libraries_to_scan:
+            raise HTTPException(status_code=404, detail=f"Library with ID {req.library_id} not found.")
+    else:
+        libraries_to_scan = all_libraries
+
+    try:
+        job = scan_jobs.submit(
+            [lib.get("id") for lib in libraries_to_scan],
+            req.mode,
+            lambda job: run_scan_job(job, libraries_to_scan, req.mode)
+        )
+    except ScanConflict as e:
+        raise HTTPException(status_code=409, detail=f"Library already being scanned: {e}")
+    return job.to_dict()
+
+@app.get("/admin/scan-jobs")
+def list_scan_jobs(user=Depends(verify_token)):
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="ADMIN_REQUIRED")
+    return [job.to_dict() for job in scan_jobs.list()]
+
+@app.get("/admin/scan-jobs/{job_id}")
+def get_scan_job(job_id: str, user=Depends(verify_token)):
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="ADMIN_REQUIRED")
+    job = scan_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Scan job not found.")
+    return job.to_dict()
+
+@app.post("/admin/scan-jobs/{job_id}/cancel")
+def cancel_scan_job(job_id: str, user=Depends(verify_token)):
+    if user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="ADMIN_REQUIRED")
+    job = scan_jobs.cancel(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Scan job not found.")
+    return job.to_dict()
 
 
 @app.post("/admin/scan-artist-images")
 def trigger_artist_image_scan(user=Depends(verify_token)):
-    current = repo.get_user_by_id(user["id"])
-    if not current or current.get("role") != "admin":
+    if user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="ADMIN_REQUIRED")
 
     try:
@@ -760,8 +712,8 @@ def get_track_url(track_id: int, user=Depends(verify_token)):
     if not t:
         raise HTTPException(404, "Track not found")
     
-    # Add to history
-    repo.add_track_to_history(user["id"], track_id)
+    # Written in batches by the history buffer, off the request path
+    history_buffer.record(user["id"], track_id)
     
     album = repo.get_album(t["albumId"])
     track_bucket_name = t.get("bucket")
@@ -778,76 +730,30 @@ def get_track_url(track_id: int, user=Depends(verify_token)):
         logger.error(f"Could not get temporary link for track {track_id}: {e}")
         return {"url": None}
 
+@app.post("/tracks/urls")
+def get_track_urls(ids: List[int] = Body(...), user=Depends(verify_token)):
+    # Préchargement de la file de lecture : pas d'historique ici, il est enregistré à la lecture réelle
+    if len(ids) > TRACK_URL_BATCH_MAX:
+        raise HTTPException(400, f"At most {TRACK_URL_BATCH_MAX} track ids per request")
+
+    locations = repo.get_track_locations(ids)
+    urls = bucketS3.get_temporary_links(locations)
+    return {"urls": [{"id": loc["id"], "url": url} for loc, url in zip(locations, urls)]}
+
 @app.get("/user/history")
-def get_user_history(user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
-    
-    history_ids = current_user.get("history", [])
-    
-    # We can reuse track_by_list_id logic but we want to maintain history order
-    user_likes = set(current_user.get("like", {}).get("track", []))
-    out = []
-    for tid in history_ids:
-        t = repo.get_track(tid)
-        if not t:
-            continue
-        album = repo.get_album(t["albumId"])
-        artist = repo.get_artist(t["artistId"])
-        
-        out.append({
-            "id": t["id"],
-            "title": t["title"],
-            "duration": t.get("duration"),
-            "albumName": album.get("name") if album else None,
-            "artistName": artist.get("name") if artist else None,
-            "artistId": t.get("artistId"),
-            "albumId": t.get("albumId"),
-            "albumTrack": t.get("albumTrack"),
-            "like": t["id"] in user_likes,
-            "coverSmall": (get_base_url_for_bucket(album.get("coverBucket") or 1) + album.get("coverSmall")) if album and album.get("coverSmall") else None,
-            "path": None 
-        })
-    return out
+def get_user_history(history_ids=Depends(load_user_history), likes=Depends(load_user_likes)):
+    # Same shape as track_by_list_id, get_tracks_enriched keeps the history order
+    user_likes = likes.get("track", [])
+    return [format_track(t, user_likes) for t in repo.get_tracks_enriched(history_ids)]
 
 @app.post("/trackByListID")
-def track_by_list_id(ids: List[int] = Body(...), user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
-        
-    user_likes = set(current_user.get("like", {}).get("track", []))
-    out = []
-    for tid in ids:
-        t = repo.get_track(tid)
-        if not t:
-            continue
-        album = repo.get_album(t["albumId"])
-        artist = repo.get_artist(t["artistId"])
-        
-        out.append({
-            "id": t["id"],
-            "title": t["title"],
-            "duration": t.get("duration"),
-            "albumName": album.get("name") if album else None,
-            "artistName": artist.get("name") if artist else None,
-            "artistId": t.get("artistId"),
-            "albumId": t.get("albumId"),
-            "albumTrack": t.get("albumTrack"),
-            "like": t["id"] in user_likes,
-            "coverSmall": (get_base_url_for_bucket(album.get("coverBucket") or 1) + album.get("coverSmall")) if album and album.get("coverSmall") else None,
-            "path": None # URL will be fetched on demand
-        })
-    return out
+def track_by_list_id(ids: List[int] = Body(...), likes=Depends(load_user_likes)):
+    user_likes = likes.get("track", [])
+    return [format_track(t, user_likes) for t in repo.get_tracks_enriched(ids)]
 
 @app.get("/albumLike")
-def album_like(user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
-        
-    liked_albums = set(current_user.get("like", {}).get("album", []))
+def album_like(likes=Depends(load_user_likes)):
+    liked_albums = likes.get("album", [])
 
     result = []
     for a in repo.all_albums():
@@ -872,81 +778,46 @@ class AlbumRequest(BaseModel):
     album_id: int
 
 @app.post("/get_album")
-def get_album(req: AlbumRequest, user=Depends(verify_token)):
-    album = build_album(req.album_id, user=user)
+def get_album(req: AlbumRequest, likes=Depends(load_user_likes)):
+    album = build_album(req.album_id, likes)
     if not album:
         raise HTTPException(404)
     return album
 
 
 @app.get("/allAlbum")
-def all_album(user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
-        
-    liked_albums = set(current_user.get("like", {}).get("album", []))
-
-    result = []
-    for a in repo.all_albums():
-        primary_artist_id = a.get("artistId", [None])[0]
-        main_artist = repo.get_artist(primary_artist_id) if primary_artist_id else None
-
-        result.append({
-            "id": a["id"],
-            "name": a.get("name"),
-            "like": a["id"] in liked_albums,
-            "artistName": main_artist["name"] if main_artist else None,
-            "artistId": main_artist["id"] if main_artist else None,
-            "cover": (get_base_url_for_bucket(a.get("coverBucket") or 1) + a.get("cover")) if get_base_url_for_bucket(a.get("coverBucket") or 1) and a and a.get("cover") else None,
-        })
-    return result
+def all_album(
+    request: Request,
+    limit: int | None = Query(None, ge=1, le=500),
+    cursor: str | None = None,
+    with_total: bool = False,
+    likes=Depends(load_user_likes)
+):
+    liked_albums = likes.get("album", [])
+    if wants_ndjson(request):
+        after = decode_cursor(cursor) if cursor else None
+        return ndjson_response(format_album_row(a, liked_albums) for a in repo.iter_albums(after))
+    return paginate(repo.albums_page, repo.count_albums, limit, cursor, with_total,
+                    lambda a: format_album_row(a, liked_albums))
 
 
 @app.get("/trackLike")
-def track_like(user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
-        
-    user_likes = current_user.get("like", {}).get("track", [])
-    out = []
-    for tid in user_likes:
-        t = repo.get_track(tid)
-        if not t:
-            continue
-        album = repo.get_album(t["albumId"])
-        artist = repo.get_artist(t["artistId"])
-        
-        out.append({
-            "id": t["id"],
-            "title": t["title"],
-            "duration": t.get("duration"),
-            "albumName": album.get("name") if album else None,
-            "artistName": artist.get("name") if artist else None,
-            "artistId": t.get("artistId"),
-            "albumId": t.get("albumId"),
-            "albumTrack": t.get("albumTrack"),
-            "like": True,
-            "coverSmall": (get_base_url_for_bucket(album.get("coverBucket") or 1) + album.get("coverSmall")) if album and album.get("coverSmall") else None,
-            "path": None # URL will be fetched on demand
-        })
+def track_like(likes=Depends(load_user_likes)):
+    user_likes = likes.get("track", [])
+    out = [format_track(t, user_likes) for t in repo.get_tracks_enriched(user_likes)]
     return {"listMusique": out}
 
 class ArtistID(BaseModel):
     artist_id: int
 
 @app.post("/albumByArtistID")
-def album_by_artist(payload: ArtistID, user=Depends(verify_token)):
+def album_by_artist(payload: ArtistID, likes=Depends(load_user_likes)):
     artist = repo.get_artist(payload.artist_id)
     if not artist:
         raise HTTPException(404)
 
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
         
-    liked_albums = set(current_user.get("like", {}).get("album", []))
+    liked_albums = likes.get("album", [])
 
     albums = []
     for aid in artist.get("listAlbums", []):
@@ -974,44 +845,10 @@ class AlbumListRequest(BaseModel):
     album_ids: List[int]
 
 @app.post("/albumByListId")
-def album_by_list_id(req: AlbumListRequest, user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
-        
-    liked_albums = set(current_user.get("like", {}).get("album", []))
+def album_by_list_id(req: AlbumListRequest, likes=Depends(load_user_likes)):
+    liked_albums = likes.get("album", [])
     album_list = []
 
-    # Define get_base_url_for_bucket locally to ensure it's in scope
-    def get_base_url_for_bucket(identifier: int | str | None = None) -> str | None:
-        libraries = repo.get_libraries()
-        if not libraries:
-            return None
-        target = None
-        if isinstance(identifier, int):
-            for lib in libraries:
-                if lib.get("id") == identifier:
-                    target = lib
-                    break
-        elif isinstance(identifier, str):
-            for lib in libraries:
-                if lib.get("identifiers", {}).get("bucket_name") == identifier:
-                    target = lib
-                    break
-                if identifier in lib.get("url", ""):
-                    target = lib
-                    break
-        if not target:
-            target = libraries[0]
-        
-        if target:
-            url = target.get("url", "").rstrip("/")
-            bucket_name = target.get("identifiers", {}).get("bucket_name")
-            if bucket_name:
-                return f"{url}/{bucket_name}/"
-            return f"{url}/"
-        return None
-
     for aid in req.album_ids:
         a = repo.get_album(aid)
         if a:
@@ -1032,12 +869,8 @@ def album_by_list_id(req: AlbumListRequest, user=Depends(verify_token)):
 # Artist
 
 @app.get("/artistLike")
-def artist_like(user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
-        
-    liked_ids = set(current_user.get("like", {}).get("artist", []))
+def artist_like(likes=Depends(load_user_likes)):
+    liked_ids = likes.get("artist", [])
     
     artist_list = []
     for aid in liked_ids:
@@ -1060,12 +893,8 @@ class GenresRequest(BaseModel):
     genre_names: List[str]
 
 @app.post("/tracksByGenres")
-def get_tracks_by_genres(payload: GenresRequest, user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
-    
-    user_likes = set(current_user.get("like", {}).get("track", []))
+def get_tracks_by_genres(payload: GenresRequest, likes=Depends(load_user_likes)):
+    user_likes = likes.get("track", [])
     
     all_genres = {g["name"].lower(): g["id"] for g in repo.all_genres()}
     target_genre_ids = [all_genres.get(name.lower()) for name in payload.genre_names if all_genres.get(name.lower())]
@@ -1076,98 +905,38 @@ def get_tracks_by_genres(payload: GenresRequest, user=Depends(verify_token)):
     final_tracks = []
     
     # Étape 1 : Essayer l'intersection (Albums qui possèdent TOUS les genres demandés)
-    matching_albums_and = []
-    for album in repo.all_albums():
-        album_genre_ids = set(album.get("genreIds", []))
-        if all(gid in album_genre_ids for gid in target_genre_ids):
-            matching_albums_and.append(album)
+    matching_albums_and = genre_index.albums_by_genre(target_genre_ids, mode="all", random=False)
 
     if matching_albums_and:
-        for alb in matching_albums_and:
-            t_ids = alb.get("listMusique", [])
-            if t_ids:
-                random_tid = random.choice(t_ids)
-                t = repo.get_track(random_tid)
-                if t:
-                    final_tracks.append(t)
+        final_tracks = repo.random_track_per_album(matching_albums_and)
     else:
         # Étape 2 : Fallback (Intersection vide -> On prend des morceaux de chaque genre)
         seen_album_ids = set()
-        temp_tracks = []
         for gid in target_genre_ids:
-            # Pour chaque genre, on récupère les albums correspondants
-            genre_albums = [alb for alb in repo.all_albums() if gid in alb.get("genreIds", [])]
-            # Mélanger pour avoir de la variété si on limite
-            random.shuffle(genre_albums)
-            
-            # On prend un échantillon d'albums pour ce genre (ex: max 20 par genre pour éviter une liste géante)
-            count = 0
-            for alb in genre_albums:
-                if alb["id"] in seen_album_ids:
-                    continue
-                seen_album_ids.add(alb["id"])
-                
-                t_ids = alb.get("listMusique", [])
-                if t_ids:
-                    random_tid = random.choice(t_ids)
-                    t = repo.get_track(random_tid)
-                    if t:
-                        temp_tracks.append(t)
-                        count += 1
-                if count >= 20: # Limite par genre dans le fallback
-                    break
+            # On prend un échantillon aléatoire d'albums pour ce genre (max 20 par genre pour éviter une liste géante)
+            picks = genre_index.albums_by_genre([gid], limit=20, exclude=seen_album_ids)
+            seen_album_ids.update(picks)
         
-        final_tracks = temp_tracks
+        final_tracks = repo.random_track_per_album(list(seen_album_ids))
         # On mélange le tout pour que les genres soient entremêlés
         random.shuffle(final_tracks)
 
     # Formater pour le frontend
-    out = []
-    for t in final_tracks:
-        album = repo.get_album(t["albumId"])
-        artist = repo.get_artist(t["artistId"])
-        out.append({
-            "id": t["id"],
-            "title": t["title"],
-            "duration": t.get("duration"),
-            "albumName": album.get("name") if album else None,
-            "artistName": artist.get("name") if artist else None,
-            "artistId": t.get("artistId"),
-            "albumId": t.get("albumId"),
-            "albumTrack": t.get("albumTrack"),
-            "like": t["id"] in user_likes,
-            "coverSmall": (get_base_url_for_bucket(album.get("coverBucket") or 1) + album.get("coverSmall")) if album and album.get("coverSmall") else None,
-            "path": None 
-        })
-    
-    return out
+    return [format_track(t, user_likes) for t in repo.get_tracks_enriched(final_tracks)]
 
 class GenreID(BaseModel):
     genre_id: int
 
 @app.post("/albumByGenreID")
-def album_by_genre(payload: GenreID, user=Depends(verify_token)):
+def album_by_genre(payload: GenreID, likes=Depends(load_user_likes)):
     genre = repo.get_genre(payload.genre_id)
     if not genre:
         raise HTTPException(404, "Genre not found")
 
-    current_user = repo.get_user_by_id(user["id"])
-    liked_albums = set(current_user.get("like", {}).get("album", []))
+    liked_albums = likes.get("album", [])
 
-    albums = []
-    for a in repo.all_albums():
-        if payload.genre_id in a.get("genreIds", []):
-            primary_artist_id = a.get("artistId", [None])[0]
-            main_artist = repo.get_artist(primary_artist_id) if primary_artist_id else None
-            
-            albums.append({
-                "id": a["id"],
-                "name": a.get("name"),
-                "like": a["id"] in liked_albums,
-                "artistName": main_artist["name"] if main_artist else None,
-                "artistId": main_artist["id"] if main_artist else None,
-                "cover": (get_base_url_for_bucket(a.get("coverBucket") or 1) + a.get("cover")) if get_base_url_for_bucket(a.get("coverBucket") or 1) and a and a.get("cover") else None,
-            })
+    album_ids = genre_index.albums_by_genre([payload.genre_id], random=False)
+    albums = [format_album_row(a, liked_albums) for a in repo.albums_by_ids(album_ids)]
 
     return {
         "id": genre["id"],
@@ -1178,13 +947,9 @@ def album_by_genre(payload: GenreID, user=Depends(verify_token)):
 import random
 
 @app.get("/recommend/albums")
-def recommend_albums(user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
-    
-    liked_album_ids = current_user.get("like", {}).get("album", [])
-    top_genres = current_user.get("top_genres", [])
+def recommend_albums(user=Depends(verify_token), likes=Depends(load_user_likes)):
+    liked_album_ids = likes.get("album", [])
+    top_genres = repo.get_user_top_genres(user["id"])
     top_genre_ids = [g["id"] for g in top_genres]
     
     recommendations = []
@@ -1202,123 +967,66 @@ def recommend_albums(user=Depends(verify_token)):
 
     # 3. Compléter jusqu'à 5 avec des albums aléatoires liés aux genres
     needed = 5 - len(recommendations)
+    if needed > 0 and top_genre_ids:
+        recommendations.extend(genre_index.sample_albums(
+            needed, include_genres=top_genre_ids,
+            exclude_ids=set(recommendations) | set(liked_album_ids)
+        ))
+
+    # Si toujours pas assez, compléter avec n'importe quel album non liké
+    needed = 5 - len(recommendations)
     if needed > 0:
-        genre_candidates = [
-            a["id"] for a in repo.all_albums()
-            if a["id"] not in recommendations
-            and a["id"] not in liked_album_ids
-            and any(gid in top_genre_ids for gid in a.get("genreIds", []))
-        ]
-
-        if genre_candidates:
-            picks = random.sample(genre_candidates, min(needed, len(genre_candidates)))
-            recommendations.extend(picks)
-
-        # Si toujours pas assez, compléter avec n'importe quel album non liké
-        needed = 5 - len(recommendations)
-        if needed > 0:
-            fallback = [
-                a["id"] for a in repo.all_albums()
-                if a["id"] not in recommendations
-                and a["id"] not in liked_album_ids
-            ]
-            if fallback:
-                picks = random.sample(fallback, min(needed, len(fallback)))
-                recommendations.extend(picks)
+        recommendations.extend(genre_index.sample_albums(
+            needed, exclude_ids=set(recommendations) | set(liked_album_ids)
+        ))
 
     # Convertir en objets album complets
-    liked_set = set(liked_album_ids)
-    result = []
-    for aid in recommendations:
-        a = repo.get_album(aid)
-        if a:
-            primary_artist_id = a.get("artistId", [None])[0]
-            main_artist = repo.get_artist(primary_artist_id) if primary_artist_id else None
-            result.append({
-                "id": a["id"],
-                "name": a.get("name"),
-                "like": a["id"] in liked_set,
-                "artistName": main_artist["name"] if main_artist else None,
-                "artistId": main_artist["id"] if main_artist else None,
-                "cover": (get_base_url_for_bucket(a.get("coverBucket") or 1) + a.get("cover"))
-                         if get_base_url_for_bucket(a.get("coverBucket") or 1) and a.get("cover") else None,
-            })
-
-    return result
+    return [format_album_row(a, liked_album_ids) for a in repo.albums_by_ids(recommendations)]
 
 @app.get("/recommend/genres-albums")
-def recommend_genres_albums(user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
-    
-    top_genres = current_user.get("top_genres", [])
+def recommend_genres_albums(user=Depends(verify_token), likes=Depends(load_user_likes)):
+    top_genres = repo.get_user_top_genres(user["id"])
     if not top_genres:
         return []
 
-    result = []
-    all_albums = list(repo.all_albums())
-    liked_album_ids = set(current_user.get("like", {}).get("album", []))
-    recommended_ids = set()
+    liked_album_ids = likes.get("album", [])
+    recommended = [] # (album_id, genre name)
 
     for g in top_genres:
-        gid = g["id"]
-        candidates = [a for a in all_albums if gid in a.get("genreIds", []) and a["id"] not in recommended_ids]
-        if candidates:
-            chosen = random.choice(candidates)
-            recommended_ids.add(chosen["id"])
-            primary_artist_id = chosen.get("artistId", [None])[0]
-            main_artist = repo.get_artist(primary_artist_id) if primary_artist_id else None
-            
-            result.append({
-                "id": chosen["id"],
-                "name": chosen.get("name"),
-                "like": chosen["id"] in liked_album_ids,
-                "artistName": main_artist["name"] if main_artist else None,
-                "artistId": main_artist["id"] if main_artist else None,
-                "cover": (get_base_url_for_bucket(chosen.get("coverBucket") or 1) + chosen.get("cover"))
-                         if get_base_url_for_bucket(chosen.get("coverBucket") or 1) and chosen.get("cover") else None,
-                "based_on_genre": g["name"]
-            })
-            
-    return result
+        picks = genre_index.sample_albums(1, include_genres=[g["id"]], exclude_ids=[aid for aid, _ in recommended])
+        if picks:
+            recommended.append((picks[0], g["name"]))
+
+    based_on = dict(recommended)
+    return [
+        {**format_album_row(a, liked_album_ids), "based_on_genre": based_on[a["id"]]}
+        for a in repo.albums_by_ids([aid for aid, _ in recommended])
+    ]
 
 @app.post("/allArtist")
-def all_artist(user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
-        
-    liked_ids = set(current_user.get("like", {}).get("artist", []))
-    
-    artist_list = []
-    for a in repo.all_artists():
-        artist_list.append({
-            "id": a["id"],
-            "name": a["name"],
-            "like": a["id"] in liked_ids,
-            "image": get_base_url_for_bucket(a.get("bucket") or 1) + a.get("image") if a.get("image") else None,
-        })
-    return artist_list
+def all_artist(
+    request: Request,
+    limit: int | None = Query(None, ge=1, le=500),
+    cursor: str | None = None,
+    with_total: bool = False,
+    likes=Depends(load_user_likes)
+):
+    liked_ids = likes.get("artist", [])
+    if wants_ndjson(request):
+        after = decode_cursor(cursor) if cursor else None
+        return ndjson_response(format_artist_row(a, liked_ids) for a in repo.iter_artists(after))
+    return paginate(repo.artists_page, repo.count_artists, limit, cursor, with_total,
+                    lambda a: format_artist_row(a, liked_ids))
 
 @app.post("/artistByListId")
-def artist_by_list_id(ids: List[int], user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
-        
-    liked_ids = set(current_user.get("like", {}).get("artist", []))
+def artist_by_list_id(ids: List[int], likes=Depends(load_user_likes)):
+    liked_ids = likes.get("artist", [])
     
     artist_list = []
     for aid in ids:
         a = repo.get_artist(aid)
         if a:
-            artist_list.append({
-                "id": a["id"],
-                "name": a["name"],
-                "like": a["id"] in liked_ids,
-                "image": get_base_url_for_bucket(a.get("bucket") or 1) + a.get("image") if a.get("image") else None,
-            })
+            artist_list.append(format_artist_row(a, liked_ids))
     return artist_list
 
 
@@ -1329,8 +1037,8 @@ class PlaylistRequest(BaseModel):
     playlist_id: int
 
 @app.post("/get_playlist")
-def get_playlist(req: PlaylistRequest, user=Depends(verify_token)):
-    playlist = build_playlist(req.playlist_id, user)
+def get_playlist(req: PlaylistRequest, likes=Depends(load_user_likes)):
+    playlist = build_playlist(req.playlist_id, likes)
     if not playlist:
         raise HTTPException(404)
     return playlist
@@ -1338,12 +1046,8 @@ def get_playlist(req: PlaylistRequest, user=Depends(verify_token)):
 
 
 @app.get("/listplaylists")
-def list_playlists(user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
-        
-    playlist_ids = set(current_user.get("like", {}).get("playlist", []))
+def list_playlists(likes=Depends(load_user_likes)):
+    playlist_ids = likes.get("playlist", [])
 
     return [
         {"id": p["id"], "name": p["name"]}
@@ -1410,10 +1114,6 @@ class LikeUpdate(BaseModel):
 
 @app.post("/updateLike")
 def update_like(payload: LikeUpdate, user=Depends(verify_token)):
-    current_user = repo.get_user_by_id(user["id"])
-    if not current_user:
-        raise HTTPException(401, "USER_NOT_FOUND")
-        
     repo.update_user_like(
         user_id=user["id"],
         obj_type=payload.type,
@@ -1512,3 +1212,10 @@ def get_active_resets(user_data: dict = Depends(verify_token)):
         raise HTTPException(status_code=403, detail="Réservé aux admins")
     
     return {"active_resets": repo.get_all_active_reset_tokens()}
+
+@app.get("/admin/url-cache")
+def get_url_cache_stats(user_data: dict = Depends(verify_token)):
+    if user_data.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Réservé aux admins")
+
+    return bucketS3.url_cache.stats()
@@ -2,6 +2,8 @@ import os
 from repositories.sqlite_repo import SqliteRepository
 from repositories.postgres_repo import PostgresRepository
 from repositories.bucket_repo import S3ContactRepository
+from repositories.genre_index import GenreIndex
+from repositories.history_buffer import HistoryBuffer
 
 db_type = os.getenv("DATABASE_TYPE", "sqlite").lower()
 
@@ -17,3 +19,9 @@ else:
     repo = SqliteRepository()
 
 bucketS3 = S3ContactRepository(repo=repo)
+genre_index = GenreIndex(repo)
+history_buffer = HistoryBuffer(
+    repo,
+    interval=float(os.getenv("HISTORY_FLUSH_INTERVAL", 2)),
+    max_pending=int(os.getenv("HISTORY_FLUSH_MAX_PENDING", 1000))
+)
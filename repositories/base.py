@@ -1,12 +1,22 @@
 # /repositories/base.py
 from abc import ABC, abstractmethod
-from typing import List
+from typing import List, Iterator
 from datetime import datetime
 
 class BaseRepository(ABC):
 
     @abstractmethod
     def get_user_by_id(self, user_id: str): ...
+    @abstractmethod
+    def get_user_principal(self, user_id: str): ...
+    @abstractmethod
+    def get_user_likes(self, user_id: str) -> dict: ...
+    @abstractmethod
+    def get_user_history(self, user_id: str) -> List[int]: ...
+    @abstractmethod
+    def add_tracks_to_history(self, events) -> None: ...
+    @abstractmethod
+    def get_user_top_genres(self, user_id: str) -> List[dict]: ...
 
     @abstractmethod
     def get_album(self, album_id: int): ...
@@ -16,6 +26,12 @@ class BaseRepository(ABC):
     def get_artist(self, artist_id: int): ...
     @abstractmethod
     def get_playlist(self, playlist_id: int): ...
+    @abstractmethod
+    def get_album_detail(self, album_id: int) -> dict: ...
+    @abstractmethod
+    def get_tracks_enriched(self, track_ids: List[int]) -> List[dict]: ...
+    @abstractmethod
+    def get_track_locations(self, track_ids: List[int]) -> List[dict]: ...
 
     @abstractmethod
     def all_albums(self): ...
@@ -26,6 +42,31 @@ class BaseRepository(ABC):
     @abstractmethod
     def all_playlists(self): ...
 
+    @abstractmethod
+    def albums_page(self, limit: int = None, after: tuple = None) -> List[dict]: ...
+    @abstractmethod
+    def artists_page(self, limit: int = None, after: tuple = None) -> List[dict]: ...
+    @abstractmethod
+    def iter_albums(self, after: tuple = None) -> Iterator[dict]: ...
+    @abstractmethod
+    def iter_artists(self, after: tuple = None) -> Iterator[dict]: ...
+    @abstractmethod
+    def iter_users(self) -> Iterator[dict]: ...
+    @abstractmethod
+    def albums_by_ids(self, album_ids: List[int]) -> List[dict]: ...
+    @abstractmethod
+    def albums_by_genre(self, genre_ids: List[int], mode: str = "all", limit: int = None, random: bool = True) -> List[int]: ...
+    @abstractmethod
+    def album_genre_pairs(self) -> Iterator[tuple]: ...
+    @abstractmethod
+    def sample_albums(self, n: int, include_genres: List[int] = None, exclude_ids=()) -> List[int]: ...
+    @abstractmethod
+    def random_track_per_album(self, album_ids: List[int]) -> List[int]: ...
+    @abstractmethod
+    def count_albums(self) -> int: ...
+    @abstractmethod
+    def count_artists(self) -> int: ...
+
     @abstractmethod
     def create_playlist(self, user_id: str, name: str) -> int: ...
     @abstractmethod
@@ -56,6 +97,14 @@ class BaseRepository(ABC):
     @abstractmethod
     def delete_library(self, library_id: int): ...
 
+    @abstractmethod
+    def get_bucket_policy_checks(self) -> dict: ...
+    @abstractmethod
+    def save_bucket_policy_check(self, library_id: int, config_hash: str, status: str): ...
+
+    @abstractmethod
+    def delete_tracks_not_in(self, library_id: int, scanned_paths): ...
+
 
     @abstractmethod
     def update_user_top_genres(self): ...
@@ -1,10 +1,13 @@
 import boto3
+import hashlib
 import json
 from botocore.exceptions import ClientError
 from botocore.config import Config
 import os
+import threading
 from dotenv import load_dotenv
 import logging
+from repositories.url_cache import PresignedUrlCache
 load_dotenv() 
 
 logger = logging.getLogger(__name__)
@@ -15,10 +18,30 @@ class S3ContactRepository:
         self.bucket_configs = {} # Keyed by library_id
         self.active_config = None
         self.active_s3_client = None
+        # boto3 clients keyed by library_id, rebuilt by refresh_configs (clients are thread-safe once built)
+        self.s3_clients = {}
+        self._clients_by_credentials = {} # (endpoint, access_key, secret_key) -> client, reused across refreshes
+        self._client_lock = threading.Lock()
+        # Public base URLs of the libraries, rebuilt by refresh_configs
+        self.base_urls_by_id = {}
+        self.base_urls_by_bucket = {}
+        self.base_urls_by_url = []
+        self.default_base_url = None
+        # Presigned URLs reused until shortly before expiry, flushed when a library's credentials change
+        self.url_cache = PresignedUrlCache(
+            max_entries=int(os.environ.get("PRESIGNED_URL_CACHE_SIZE", 20000)),
+            margin=int(os.environ.get("PRESIGNED_URL_MARGIN", 300))
+        )
+        self._signing_fingerprint = None
+        # Public policy checks run on a background thread (schedule_policy_verification), never from refresh_configs
+        self._policy_lock = threading.Lock()
+        self._policy_thread = None
+        self._policy_rerun = False
         self.refresh_configs()
     
     def refresh_configs(self):
         self.bucket_configs = {} 
+        libraries = []
         
         if self.repo:
             libraries = self.repo.get_libraries()
@@ -56,11 +79,92 @@ class S3ContactRepository:
                 "library_id": 0
             }
         
+        self._index_base_urls(libraries)
+        self._build_clients()
+
+        fingerprint = {
+            lib_id: (self._client_endpoint(c), c.get("access_key"), c.get("secret_key"), c["bucket_name"], c.get("url_expiration"))
+            for lib_id, c in self.bucket_configs.items()
+        }
+        if fingerprint != self._signing_fingerprint:
+            self.url_cache.clear()
+            self._signing_fingerprint = fingerprint
+
         if self.bucket_configs:
             self.set_active_by_id(list(self.bucket_configs.keys())[0])
 
+    @staticmethod
+    def _client_endpoint(config):
+        # Clean endpoint: remove bucket from path and handle trailing slashes
+        endpoint = (config.get("endpoint_url") or "").rstrip('/')
+        bucket_name = config["bucket_name"].rstrip("/")
+        if bucket_name and endpoint.endswith(f"/{bucket_name}"):
+            endpoint = endpoint[:-(len(bucket_name)+1)]
+        return endpoint
+
+    def _client_for(self, config):
+        """Client for a library config, created once per endpoint/credentials."""
+        key = (self._client_endpoint(config), config.get("access_key"), config.get("secret_key"))
+        with self._client_lock:
+            client = self._clients_by_credentials.get(key)
+            if client is None:
+                # boto3.client() uses the default session, which is not thread-safe: creation stays under the lock
+                client = boto3.client(
+                    's3',
+                    endpoint_url=key[0],
+                    aws_access_key_id=key[1],
+                    aws_secret_access_key=key[2],
+                    config=Config(signature_version="s3v4", s3={"addressing_style": "path"}),
+                    region_name="us-east-1"
+                )
+                self._clients_by_credentials[key] = client
+            return client
+
+    def _build_clients(self):
+        clients = {lib_id: self._client_for(config) for lib_id, config in self.bucket_configs.items()}
+        in_use = {id(c) for c in clients.values()}
+        with self._client_lock:
+            # Clients of removed libraries or old credentials are dropped
+            self._clients_by_credentials = {k: c for k, c in self._clients_by_credentials.items() if id(c) in in_use}
+        self.s3_clients = clients
+
+    def _index_base_urls(self, libraries):
+        by_id = {}
+        by_bucket = {}
+        by_url = []
+        for lib in libraries:
+            url = (lib.get("url") or "").rstrip("/")
+            bucket_name = (lib.get("identifiers") or {}).get("bucket_name")
+            base_url = f"{url}/{bucket_name}/" if bucket_name else f"{url}/"
+            by_id.setdefault(lib.get("id"), base_url)
+            if bucket_name:
+                by_bucket.setdefault(bucket_name, base_url)
+            by_url.append((lib.get("url") or "", base_url))
+
+        # Swap the whole index at once so readers never see a partial rebuild
+        self.base_urls_by_id = by_id
+        self.base_urls_by_bucket = by_bucket
+        self.base_urls_by_url = by_url
+        self.default_base_url = by_url[0][1] if by_url else None
+
+    def get_base_url(self, identifier=None):
+        """Base URL of a library, looked up by library id or bucket name; falls back to the first library."""
+        if isinstance(identifier, int):
+            return self.base_urls_by_id.get(identifier, self.default_base_url)
+        if isinstance(identifier, str):
+            base_url = self.base_urls_by_bucket.get(identifier)
+            if base_url:
+                return base_url
+            for url, base_url in self.base_urls_by_url:
+                if identifier in url:
+                    return base_url
+        return self.default_base_url
+
     def ensure_public_policy(self, client, bucket_name):
-        """Vérifie et applique la politique d'accès public pour le préfixe 'public/'."""
+        """Vérifie et applique la politique d'accès public pour le préfixe 'public/'.
+
+        Retourne "configured" (déjà en place), "applied" ou "failed".
+        """
         import json
         
         target_resource = f"arn:aws:s3:::{bucket_name}/public/*"
@@ -93,7 +197,7 @@ class S3ContactRepository:
                 
                 if is_configured:
                     logger.info(f"Public policy already configured for bucket {bucket_name}")
-                    return
+                    return "configured"
                 
                 # Si une politique existe mais n'a pas notre statement, on l'ajoute
                 current_policy['Statement'].append(policy['Statement'][0])
@@ -108,9 +212,52 @@ class S3ContactRepository:
                 Policy=json.dumps(policy_to_apply)
             )
             logger.info(f"Successfully applied public read policy to {bucket_name}/public/*")
+            return "applied"
             
         except Exception as e:
             logger.warning(f"Could not ensure bucket policy for {bucket_name}: {e}")
+            return "failed"
+
+    @staticmethod
+    def _policy_config_hash(config):
+        # Everything that decides which bucket is reached and with which rights
+        fields = [S3ContactRepository._client_endpoint(config), config["bucket_name"].rstrip("/"),
+                  config.get("access_key"), config.get("secret_key")]
+        return hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+
+    def verify_public_policies(self):
+        """Ensure the public policy of the libraries whose config changed since their last successful check."""
+        checks = self.repo.get_bucket_policy_checks() if self.repo else {}
+        for lib_id, config in list(self.bucket_configs.items()):
+            config_hash = self._policy_config_hash(config)
+            check = checks.get(lib_id)
+            if check and check["config_hash"] == config_hash and check["status"] != "failed":
+                continue
+            client = self.s3_clients.get(lib_id) or self._client_for(config)
+            status = self.ensure_public_policy(client, config["bucket_name"].rstrip("/"))
+            if self.repo:
+                self.repo.save_bucket_policy_check(lib_id, config_hash, status)
+
+    def schedule_policy_verification(self):
+        """Run verify_public_policies on a background thread; a call made while it runs queues one more pass."""
+        with self._policy_lock:
+            if self._policy_thread is not None:
+                self._policy_rerun = True
+                return
+            self._policy_thread = threading.Thread(target=self._verify_policies_loop, name="bucket-policy", daemon=True)
+            self._policy_thread.start()
+
+    def _verify_policies_loop(self):
+        while True:
+            try:
+                self.verify_public_policies()
+            except Exception as e:
+                logger.error(f"Bucket policy verification failed: {e}")
+            with self._policy_lock:
+                if not self._policy_rerun:
+                    self._policy_thread = None
+                    return
+                self._policy_rerun = False
 
     def set_active_by_id(self, lib_id):
         config = self.bucket_configs.get(lib_id)
@@ -119,30 +266,13 @@ class S3ContactRepository:
         
         self.active_config = config
         
-        # Robust endpoint extraction
         url = config.get("endpoint_url", "")
         bucket_name = config["bucket_name"].rstrip("/")
-        
-        # Clean endpoint: remove bucket from path and handle trailing slashes
-        endpoint = url.rstrip('/')
-        if bucket_name and bucket_name in endpoint:
-            # Only remove if it's at the end of the URL
-            if endpoint.endswith(f"/{bucket_name}"):
-                endpoint = endpoint[:-(len(bucket_name)+1)]
+        endpoint = self._client_endpoint(config)
         
         logger.info(f"Setting active S3 client for bucket '{bucket_name}' at endpoint '{endpoint}' (original: '{url}')")
         
-        self.active_s3_client = boto3.client(
-            's3',
-            endpoint_url=endpoint,
-            aws_access_key_id=config.get("access_key"),
-            aws_secret_access_key=config.get("secret_key"),
-            config=Config(signature_version="s3v4", s3={"addressing_style": "path"}),
-            region_name="us-east-1"
-        )
-        
-        # S'assurer que la politique publique est appliquée
-        self.ensure_public_policy(self.active_s3_client, bucket_name)
+        self.active_s3_client = self.s3_clients.get(lib_id) or self._client_for(config)
 
     def check_public_access(self, bucket_name, path, endpoint_url):
         """Tente d'accéder à un fichier sans signature pour voir s'il est public."""
@@ -156,26 +286,46 @@ class S3ContactRepository:
         except:
             return False
 
-    def get_temporary_link(self, path: str, bucket_name: str = None, library_id: int = None):
+    def _resolve_config(self, bucket_name: str = None, library_id: int = None):
         if library_id is not None:
             try: library_id = int(library_id)
             except: pass
 
-        config = None
         if library_id in self.bucket_configs:
-            config = self.bucket_configs[library_id]
-        elif bucket_name:
+            return self.bucket_configs[library_id]
+        if bucket_name:
             for cfg in self.bucket_configs.values():
                 if cfg["bucket_name"] == bucket_name:
-                    config = cfg
-                    break
+                    return cfg
+        return self.active_config
 
+    def get_temporary_links(self, locations):
+        """Presigned URLs for dicts with path/bucket/library_id (see get_track_locations), in the same order."""
+        generation = self.url_cache.generation() # read before the configs, see _link_for
+        configs = {}
+        urls = []
+        for loc in locations:
+            path = loc.get("path")
+            if not path:
+                urls.append(None)
+                continue
+            scope = (loc.get("library_id"), loc.get("bucket"))
+            if scope not in configs:
+                configs[scope] = self._resolve_config(bucket_name=scope[1], library_id=scope[0])
+            config = configs[scope]
+            urls.append(self._link_for(config, path, generation) if config else None)
+        return urls
+
+    def get_temporary_link(self, path: str, bucket_name: str = None, library_id: int = None):
+        generation = self.url_cache.generation() # read before the config, see _link_for
+        config = self._resolve_config(bucket_name=bucket_name, library_id=library_id)
         if not config:
-            if self.active_config:
-                config = self.active_config
-            else:
-                return None
+            return None
+        return self._link_for(config, path, generation)
 
+    def _link_for(self, config, path: str, generation):
+        # generation was read before config was resolved: if refresh_configs cleared the cache since,
+        # this URL may be signed with revoked credentials and is not cached
         # Si un bucket_host (URL publique) est configuré, on vérifie si on peut l'utiliser directement
         bucket_host = config.get("bucket_host")
         if bucket_host:
@@ -183,31 +333,21 @@ class S3ContactRepository:
             # pour éviter de faire un ping HTTP à chaque fois
             return f"{bucket_host.rstrip('/')}/{path.lstrip('/')}"
 
-        try:
-            client = self.active_s3_client
-            if config != self.active_config:
-                # Localized client creation with robust endpoint cleanup
-                url = config.get("endpoint_url", "")
-                b_name = config["bucket_name"]
-                
-                endpoint = url.rstrip('/')
-                if b_name and endpoint.endswith(f"/{b_name}"):
-                    endpoint = endpoint[:-(len(b_name)+1)]
+        cache_key = (config.get("library_id"), config["bucket_name"], path)
+        url = self.url_cache.get(cache_key)
+        if url is not None:
+            return url
 
-                client = boto3.client(
-                    's3',
-                    endpoint_url=endpoint,
-                    aws_access_key_id=config.get("access_key"),
-                    aws_secret_access_key=config.get("secret_key"),
-                    config=Config(signature_version="s3v4", s3={"addressing_style": "path"}),
-                    region_name="us-east-1"
-                )
+        try:
+            client = self.s3_clients.get(config.get("library_id")) or self._client_for(config)
+            expires_in = int(config.get("url_expiration", 3600))
             
             url = client.generate_presigned_url(
                 "get_object",
                 Params={"Bucket": config["bucket_name"], "Key": path},
-                ExpiresIn=int(config.get("url_expiration", 3600)) 
+                ExpiresIn=expires_in
             )
+            self.url_cache.put(cache_key, url, expires_in, generation)
             return url
         except Exception as e:
             logger.error(f"Error generating presigned URL for {path}: {e}")
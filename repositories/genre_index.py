@@ -0,0 +1,124 @@
+# /repositories/genre_index.py
+import heapq
+import logging
+import random
+from array import array
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+
+def _contains(ids, album_id):
+    i = bisect_left(ids, album_id)
+    return i < len(ids) and ids[i] == album_id
+
+
+def _merged(lists):
+    """Sorted, de-duplicated union of sorted id arrays."""
+    last = None
+    for album_id in heapq.merge(*lists):
+        if album_id != last:
+            yield album_id
+            last = album_id
+
+
+def reservoir_sample(ids, k, exclude=()):
+    """One pass over ids keeping k of the non-excluded ones (algorithm R)."""
+    reservoir, seen = [], 0
+    for album_id in ids:
+        if album_id in exclude:
+            continue
+        seen += 1
+        if len(reservoir) < k:
+            reservoir.append(album_id)
+        else:
+            j = random.randrange(seen)
+            if j < k:
+                reservoir[j] = album_id
+    random.shuffle(reservoir)
+    return reservoir
+
+
+def sample_ids(lists, k, exclude=()):
+    """Draw up to k distinct ids from one or more id arrays, skipping excluded ones.
+
+    Random positions are drawn directly, so the cost depends on k rather than on the array sizes;
+    a reservoir pass takes over when exclusions make the draws mostly miss.
+    """
+    lists = [ids for ids in lists if len(ids)]
+    total = sum(len(ids) for ids in lists)
+    if not total or k <= 0:
+        return []
+    picked, seen = [], set()
+    if k * 2 < total:
+        for _ in range(4 * k + 16):
+            if len(picked) >= k:
+                break
+            pos = random.randrange(total)
+            for ids in lists:
+                if pos < len(ids):
+                    album_id = ids[pos]
+                    break
+                pos -= len(ids)
+            if album_id in exclude or album_id in seen:
+                continue
+            seen.add(album_id)
+            picked.append(album_id)
+    if len(picked) < k:
+        picked += reservoir_sample(_merged(lists), k - len(picked), set(exclude) | seen)
+    return picked
+
+
+class GenreIndex:
+    """In-memory inverted index genre id -> sorted album ids, rebuilt from album_genres after each scan.
+
+    Until the first rebuild, lookups are delegated to the repository.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self._albums = None # genre_id -> array('q') of album ids, sorted
+
+    @property
+    def loaded(self):
+        return self._albums is not None
+
+    def rebuild(self):
+        index = {}
+        for genre_id, album_id in self.repo.album_genre_pairs():
+            index.setdefault(int(genre_id), array("q")).append(int(album_id))
+        # Swapped in one assignment: readers keep the previous snapshot meanwhile
+        self._albums = {g: array("q", sorted(ids)) for g, ids in index.items()}
+        logger.info(f"Genre index rebuilt: {len(index)} genres.")
+
+    def albums(self, genre_ids, mode="all"):
+        """Sorted album ids having all (mode="all") or any (mode="any") of the genres."""
+        index = self._albums
+        lists = [index.get(int(g), array("q")) for g in dict.fromkeys(genre_ids)]
+        if not lists:
+            return array("q")
+        if mode == "any":
+            return array("q", _merged(lists))
+        lists.sort(key=len)
+        smallest, others = lists[0], lists[1:]
+        return array("q", (a for a in smallest if all(_contains(ids, a) for ids in others)))
+
+    def albums_by_genre(self, genre_ids, mode="all", limit=None, random=True, exclude=()):
+        exclude = set(exclude)
+        if not self.loaded:
+            ids = self.repo.albums_by_genre(genre_ids, mode=mode, random=random)
+            ids = [i for i in ids if i not in exclude]
+            return ids[:limit] if limit else ids
+        ids = self.albums(genre_ids, mode)
+        if random:
+            return sample_ids([ids], limit or len(ids), exclude)
+        ids = [i for i in ids if i not in exclude]
+        return ids[:limit] if limit else ids
+
+    def sample_albums(self, n, include_genres=None, exclude_ids=()):
+        """Up to n random album ids, restricted to albums having any of include_genres when given."""
+        if not include_genres or not self.loaded:
+            return self.repo.sample_albums(n, include_genres=include_genres, exclude_ids=exclude_ids)
+        index = self._albums
+        lists = [index.get(int(g), array("q")) for g in dict.fromkeys(include_genres)]
+        return sample_ids(lists, n, set(exclude_ids))
@@ -0,0 +1,79 @@
+# /repositories/history_buffer.py
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryBuffer:
+    """Play events waiting to be written to the history, coalesced per user and flushed in batches.
+
+    record() only touches memory. A daemon thread flushes every `interval` seconds, or as soon as
+    `max_pending` plays are waiting; flush(user_id) writes one user's plays before their history is read.
+    """
+
+    def __init__(self, repo, interval=2.0, max_pending=1000):
+        self.repo = repo
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {} # user_id -> {track_id: played_at}, in play order
+        self._count = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() # batches are written one at a time, so a user's plays land in order
+        self._wake = threading.Event()
+        self._thread = None
+
+    def record(self, user_id, track_id):
+        user_id, track_id = int(user_id), int(track_id)
+        with self._lock:
+            plays = self._pending.setdefault(user_id, {})
+            # A replay replaces the pending play of the same track and moves it to the end
+            if plays.pop(track_id, None) is None:
+                self._count += 1
+            plays[track_id] = datetime.utcnow()
+            full = self._count >= self.max_pending
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="history-flush", daemon=True)
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+    def _take(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                pending, self._pending, self._count = self._pending, {}, 0
+            else:
+                plays = self._pending.pop(int(user_id), None)
+                pending = {int(user_id): plays} if plays else {}
+                self._count -= len(plays or ())
+        return [(u, track_id, played_at) for u, plays in pending.items() for track_id, played_at in plays.items()]
+
+    def _restore(self, events):
+        # Put back a failed batch before the plays recorded since, which stay more recent
+        with self._lock:
+            for user_id, track_id, played_at in reversed(events):
+                plays = self._pending.setdefault(user_id, {})
+                if track_id not in plays:
+                    self._pending[user_id] = {track_id: played_at, **plays}
+                    self._count += 1
+
+    def flush(self, user_id=None):
+        """Write the pending plays (of one user only if given); returns the number of plays written."""
+        with self._flush_lock:
+            events = self._take(user_id)
+            if not events:
+                return 0
+            try:
+                self.repo.add_tracks_to_history(events)
+            except Exception as e:
+                logger.error(f"Could not write {len(events)} history events, kept for the next flush: {e}")
+                self._restore(events)
+                return 0
+            return len(events)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
@@ -1,9 +1,11 @@
 # /repositories/json_repo.py
 import logging
 import uuid
-from datetime import date
+from datetime import date, datetime
 import json
+import random as _random
 from repositories.base import BaseRepository
+from repositories.genre_index import sample_ids
 logger = logging.getLogger(__name__)
 class JsonRepository(BaseRepository):
 
@@ -34,12 +36,133 @@ class JsonRepository(BaseRepository):
     def get_playlist(self, playlist_id: int):
         return self.data["playlists"].get(str(playlist_id))
 
+    def get_album_detail(self, album_id: int):
+        album = self.get_album(album_id)
+        if not album:
+            return None
+        artist_ids = album.get("artistId") or []
+        if not isinstance(artist_ids, list):
+            artist_ids = [artist_ids]
+        artists = [self.get_artist(aid) for aid in artist_ids]
+        genres = [self.get_genre(gid) for gid in album.get("genreIds", [])]
+        tracks = []
+        for t in self.get_tracks_enriched(album.get("listMusique", [])):
+            tracks.append({k: t.get(k) for k in ("id", "title", "duration", "artistId", "artistName", "albumId", "albumTrack")})
+        tracks.sort(key=lambda t: (t["albumTrack"] is None, t["albumTrack"] or 0, t["id"]))
+        return {
+            **album,
+            "artists": [{"id": a["id"], "name": a["name"]} for a in artists if a],
+            "genres": [{"id": g["id"], "name": g["name"]} for g in genres if g],
+            "tracks": tracks
+        }
+
+    def get_tracks_enriched(self, track_ids):
+        out = []
+        for tid in track_ids:
+            track = self.data["tracks"].get(str(tid))
+            if not track:
+                continue
+            album = self.data["albums"].get(str(track.get("albumId"))) or {}
+            artist = self.data["artists"].get(str(track.get("artistId"))) or {}
+            out.append({
+                **track,
+                "albumName": album.get("name"),
+                "artistName": artist.get("name"),
+                "cover": album.get("cover"),
+                "coverSmall": album.get("coverSmall"),
+                "coverBucket": album.get("coverBucket")
+            })
+        return out
+
+    def get_track_locations(self, track_ids):
+        out = []
+        for tid in track_ids:
+            track = self.data["tracks"].get(str(tid))
+            if not track:
+                continue
+            album = self.data["albums"].get(str(track.get("albumId"))) or {}
+            out.append({
+                "id": track.get("id"),
+                "path": track.get("path"),
+                "bucket": track.get("bucket"),
+                "library_id": track.get("library_id") or album.get("library_id")
+            })
+        return out
+
     def all_albums(self):
         return self.data["albums"].values()
 
     def all_artists(self):
         return self.data["artists"].values()
 
+    def _page(self, items, limit=None, after=None):
+        items = sorted(items, key=lambda x: (x.get("name") or "", int(x["id"])))
+        if after:
+            key = (after[0], int(after[1]))
+            items = [x for x in items if (x.get("name") or "", int(x["id"])) > key]
+        return items[:limit] if limit else items
+
+    def albums_page(self, limit: int = None, after: tuple = None):
+        out = []
+        for album in self._page(self.data["albums"].values(), limit, after):
+            artist_ids = album.get("artistId") or []
+            artist_id = artist_ids[0] if isinstance(artist_ids, list) and artist_ids else artist_ids or None
+            artist = self.data["artists"].get(str(artist_id)) or {}
+            out.append({**album, "artistId": artist_id, "artistName": artist.get("name")})
+        return out
+
+    def artists_page(self, limit: int = None, after: tuple = None):
+        return self._page(self.data["artists"].values(), limit, after)
+
+    def iter_albums(self, after: tuple = None):
+        yield from self.albums_page(after=after)
+
+    def iter_artists(self, after: tuple = None):
+        yield from self.artists_page(after=after)
+
+    def iter_users(self):
+        yield from self.get_user_all()
+
+    def albums_by_ids(self, album_ids):
+        by_id = {a["id"]: a for a in self.albums_page()}
+        return [by_id[aid] for aid in album_ids if aid in by_id]
+
+    def albums_by_genre(self, genre_ids, mode="all", limit=None, random=True):
+        wanted = set(genre_ids)
+        if not wanted:
+            return []
+        match = wanted.issubset if mode == "all" else wanted.intersection
+        ids = sorted(a["id"] for a in self.data["albums"].values() if match(a.get("genreIds", [])))
+        if random:
+            _random.shuffle(ids)
+        return ids[:limit] if limit else ids
+
+    def album_genre_pairs(self):
+        for album in self.data["albums"].values():
+            for gid in album.get("genreIds", []):
+                yield gid, album["id"]
+
+    def sample_albums(self, n, include_genres=None, exclude_ids=()):
+        if include_genres:
+            ids = self.albums_by_genre(include_genres, mode="any", random=False)
+        else:
+            ids = sorted(int(aid) for aid in self.data["albums"])
+        return sample_ids([ids], n, set(exclude_ids))
+
+    def random_track_per_album(self, album_ids):
+        out = []
+        for aid in album_ids:
+            album = self.data["albums"].get(str(aid)) or {}
+            if album.get("listMusique"):
+                out.append(_random.choice(album["listMusique"]))
+        return out
+
+    def count_albums(self):
+        return len(self.data["albums"])
+
+    def count_artists(self):
+        return len(self.data["artists"])
+
     def all_genres(self):
         return self.data.get("genres", {}).values()
 
@@ -116,6 +239,25 @@ class JsonRepository(BaseRepository):
         return None
     def get_user_by_id(self, user_id: str):
         return self.data.get("users", {}).get(str(user_id))
+
+    def get_user_principal(self, user_id: str):
+        user = self.get_user_by_id(user_id)
+        if not user:
+            return None
+        return {"id": str(user["id"]), "username": user.get("username"), "role": user.get("role")}
+
+    def get_user_likes(self, user_id: str):
+        user = self.get_user_by_id(user_id) or {}
+        likes = user.get("like", {})
+        return {k: list(likes.get(k, [])) for k in ("track", "album", "artist", "playlist")}
+
+    def get_user_history(self, user_id: str):
+        user = self.get_user_by_id(user_id) or {}
+        return list(user.get("history", []))
+
+    def get_user_top_genres(self, user_id: str):
+        user = self.get_user_by_id(user_id) or {}
+        return user.get("top_genres", [])
     def delete_playlist(self, user_id: str, playlist_id: int):
         pid = str(playlist_id)
 
@@ -248,6 +390,18 @@ class JsonRepository(BaseRepository):
         self._save()
         return library_data
 
+    def get_bucket_policy_checks(self):
+        return {int(k): dict(v) for k, v in self.data.get("bucket_policy_checks", {}).items()}
+
+    def save_bucket_policy_check(self, library_id: int, config_hash: str, status: str):
+        self.data.setdefault("bucket_policy_checks", {})[str(library_id)] = {
+            "library_id": library_id,
+            "config_hash": config_hash,
+            "status": status,
+            "checked_at": datetime.utcnow().isoformat()
+        }
+        self._save()
+
     def add_track_to_history(self, user_id: str, track_id: int):
         user = self.data["users"].get(str(user_id))
         if not user:
@@ -268,6 +422,22 @@ class JsonRepository(BaseRepository):
             
         self._save()
 
+    def add_tracks_to_history(self, events):
+        touched = False
+        for user_id, track_id, _ in events:
+            user = self.data["users"].get(str(user_id))
+            if not user:
+                continue
+            history = user.setdefault("history", [])
+            if track_id in history:
+                history.remove(track_id)
+            history.insert(0, track_id)
+            del history[200:]
+            touched = True
+        # Un seul enregistrement du fichier pour tout le lot
+        if touched:
+            self._save()
+
     def update_user_top_genres(self):
         users = self.data.get("users", {})
         tracks_db = self.data.get("tracks", {})
@@ -0,0 +1,127 @@
+# /repositories/like_cache.py
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+LIKE_TYPES = ("track", "album", "artist", "playlist")
+
+
+class LikeSet:
+    """Immutable set of liked ids: like order is kept for iteration, a sorted copy serves membership tests."""
+    __slots__ = ("_ordered", "_sorted")
+
+    def __init__(self, ids=()):
+        self._ordered = array("q", dict.fromkeys(int(i) for i in ids))
+        self._sorted = array("q", sorted(self._ordered))
+
+    def __contains__(self, obj_id):
+        try:
+            obj_id = int(obj_id)
+        except (TypeError, ValueError):
+            return False
+        i = bisect_left(self._sorted, obj_id)
+        return i < len(self._sorted) and self._sorted[i] == obj_id
+
+    def __iter__(self):
+        return iter(self._ordered)
+
+    def __len__(self):
+        return len(self._ordered)
+
+    def __getitem__(self, index):
+        return self._ordered[index]
+
+    def with_id(self, obj_id):
+        if obj_id in self:
+            return self
+        return LikeSet(list(self._ordered) + [obj_id])
+
+    def without_id(self, obj_id):
+        if obj_id not in self:
+            return self
+        obj_id = int(obj_id)
+        return LikeSet(i for i in self._ordered if i != obj_id)
+
+
+class LikeCache:
+    """Per-user like sets kept in sync by the repository write paths (write-through).
+
+    A cache miss reads the database outside the lock: take generation(user_id) before the read and pass it
+    to put(), which does not cache the result if a write for that user (or a global change) happened since.
+    """
+
+    def __init__(self, max_users=10000):
+        self.max_users = max_users
+        self._users = OrderedDict() # user_id -> {obj_type: LikeSet}
+        self._generations = {} # user_id -> writes seen, bumped even when the user is not cached
+        self._epoch = 0 # bumped by drop_object and clear, which touch every user
+        self._lock = threading.Lock()
+
+    def _bump(self, key):
+        self._generations[key] = self._generations.get(key, 0) + 1
+        if len(self._generations) > 2 * self.max_users:
+            # Borne la table : on oublie les utilisateurs hors cache. Leur compteur repart de zéro,
+            # donc on change d'époque pour qu'une lecture en cours ne retombe pas sur la même valeur.
+            self._generations = {k: g for k, g in self._generations.items() if k in self._users}
+            self._epoch += 1
+
+    def generation(self, user_id):
+        key = str(user_id)
+        with self._lock:
+            return (self._epoch, self._generations.get(key, 0))
+
+    def get(self, user_id):
+        key = str(user_id)
+        with self._lock:
+            likes = self._users.get(key)
+            if likes is not None:
+                self._users.move_to_end(key)
+            return likes
+
+    def put(self, user_id, likes: dict, generation=None):
+        entry = {t: LikeSet(likes.get(t, [])) for t in LIKE_TYPES}
+        key = str(user_id)
+        with self._lock:
+            if generation is not None and generation != (self._epoch, self._generations.get(key, 0)):
+                # Lu avant une écriture concurrente : servi tel quel mais pas mis en cache
+                return entry
+            self._users[key] = entry
+            self._users.move_to_end(key)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return entry
+
+    def set_like(self, user_id, obj_type, obj_id, like: bool):
+        key = str(user_id)
+        with self._lock:
+            self._bump(key)
+            likes = self._users.get(key)
+            if likes is None or obj_type not in likes:
+                return
+            # Copy-on-write: readers keep iterating over the previous LikeSet
+            current = likes[obj_type]
+            updated = current.with_id(obj_id) if like else current.without_id(obj_id)
+            if updated is not current:
+                self._users[key] = {**likes, obj_type: updated}
+
+    def drop_user(self, user_id):
+        key = str(user_id)
+        with self._lock:
+            self._bump(key)
+            self._users.pop(key, None)
+
+    def drop_object(self, obj_type, obj_id):
+        """Remove an object (e.g. a deleted playlist) from every cached user."""
+        with self._lock:
+            self._epoch += 1
+            for key, likes in self._users.items():
+                current = likes.get(obj_type)
+                if current is not None and obj_id in current:
+                    self._users[key] = {**likes, obj_type: current.without_id(obj_id)}
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._users.clear()
+            self._generations.clear()
@@ -71,6 +71,12 @@ class UserHistory(Base):
     user = relationship('User', back_populates='history')
     track = relationship('Track')
 
+class UserGenreCount(Base):
+    __tablename__ = 'user_genre_counts'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    genre_id = Column(Integer, ForeignKey('genres.id'), primary_key=True)
+    count = Column(Integer, default=0) # plays of the genre in the user's current history window
+
 class Artist(Base):
     __tablename__ = 'artists'
     id = Column(Integer, primary_key=True)
@@ -140,3 +146,19 @@ class RegistrationToken(Base):
     __tablename__ = 'registration_tokens'
     token = Column(String, primary_key=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+
+class JobWatermark(Base):
+    __tablename__ = 'job_watermarks'
+    name = Column(String, primary_key=True)
+    value = Column(Integer)
+
+class TopGenresDirty(Base):
+    __tablename__ = 'top_genres_dirty'
+    user_id = Column(Integer, primary_key=True) # genre counters changed since the last top_genres refresh
+
+class BucketPolicyCheck(Base):
+    __tablename__ = 'bucket_policy_checks'
+    library_id = Column(Integer, primary_key=True) # 0 for the env var fallback, hence no foreign key
+    config_hash = Column(String)
+    status = Column(String)
+    checked_at = Column(DateTime, default=datetime.utcnow)
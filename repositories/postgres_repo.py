@@ -2,19 +2,27 @@
 import logging
 import uuid
 import json
+import io
+import csv
 import psycopg2
 from psycopg2 import pool, extras
 from datetime import datetime
 from typing import List, Dict, Any
 from repositories.base import BaseRepository
+from repositories.like_cache import LikeCache
 from passlib.context import CryptContext
 
 logger = logging.getLogger(__name__)
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+STREAM_ITERSIZE = 2000 # rows fetched per round trip by the streaming (named) cursors
+HISTORY_LIMIT = 200 # plays kept per user
+
 class PostgresRepository(BaseRepository):
     def __init__(self, dsn: str):
         self.dsn = dsn
+        self.like_cache = LikeCache()
+        self._counts = {} # table -> cached COUNT(*), reset by _invalidate_counts
         try:
             self.pool = pool.SimpleConnectionPool(1, 10, dsn)
             self._initialize_db()
@@ -151,6 +159,29 @@ class PostgresRepository(BaseRepository):
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 );
 
+                CREATE TABLE IF NOT EXISTS user_genre_counts (
+                    user_id INTEGER REFERENCES users(id),
+                    genre_id INTEGER REFERENCES genres(id),
+                    count INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (user_id, genre_id)
+                );
+
+                CREATE TABLE IF NOT EXISTS job_watermarks (
+                    name TEXT PRIMARY KEY,
+                    value BIGINT
+                );
+
+                CREATE TABLE IF NOT EXISTS top_genres_dirty (
+                    user_id INTEGER PRIMARY KEY
+                );
+
+                CREATE TABLE IF NOT EXISTS bucket_policy_checks (
+                    library_id INTEGER PRIMARY KEY,
+                    config_hash TEXT,
+                    status TEXT,
+                    checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+
                 CREATE UNLOGGED TABLE IF NOT EXISTS tracks_staging (
                     artist_name TEXT,
                     album_name TEXT,
@@ -173,7 +204,21 @@ class PostgresRepository(BaseRepository):
                 CREATE INDEX IF NOT EXISTS idx_artists_name_trgm ON artists USING GIN(name gin_trgm_ops);
                 CREATE INDEX IF NOT EXISTS idx_tracks_album_id ON tracks(album_id);
                 CREATE INDEX IF NOT EXISTS idx_tracks_artist_id ON tracks(artist_id);
+                CREATE INDEX IF NOT EXISTS idx_albums_name_id ON albums(name, id);
+                CREATE INDEX IF NOT EXISTS idx_artists_name_id ON artists(name, id);
+                CREATE INDEX IF NOT EXISTS idx_album_genres_genre_album ON album_genres(genre_id, album_id);
+                CREATE INDEX IF NOT EXISTS idx_user_history_user_timestamp ON user_history(user_id, timestamp DESC);
                 """)
+
+                # One row per (user, track) for the ON CONFLICT of add_tracks_to_history; concurrent plays
+                # could leave duplicates before the index existed, the most recent one is kept
+                cur.execute("SELECT to_regclass('idx_user_history_user_track') IS NULL")
+                if cur.fetchone()[0]:
+                    cur.execute("""
+                        DELETE FROM user_history a USING user_history b
+                        WHERE a.user_id = b.user_id AND a.track_id = b.track_id AND a.id < b.id
+                    """)
+                    cur.execute("CREATE UNIQUE INDEX idx_user_history_user_track ON user_history(user_id, track_id)")
                 
                 # Ensure types are correct if they were created with wrong types before
                 try:
@@ -235,6 +280,60 @@ class PostgresRepository(BaseRepository):
         finally:
             self._put_conn(conn)
 
+    def get_user_principal(self, user_id: str):
+        conn = self._get_conn()
+        try:
+            with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+                cur.execute("SELECT id, username, role FROM users WHERE id = %s", (int(user_id),))
+                user = cur.fetchone()
+                if user:
+                    user['id'] = str(user['id'])
+                return dict(user) if user else None
+        finally:
+            self._put_conn(conn)
+
+    def get_user_likes(self, user_id: str):
+        cached = self.like_cache.get(user_id)
+        if cached is not None:
+            return cached
+        generation = self.like_cache.generation(user_id)
+        conn = self._get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT 'track', track_id FROM user_like_tracks WHERE user_id = %(uid)s
+                    UNION ALL SELECT 'album', album_id FROM user_like_albums WHERE user_id = %(uid)s
+                    UNION ALL SELECT 'artist', artist_id FROM user_like_artists WHERE user_id = %(uid)s
+                    UNION ALL SELECT 'playlist', playlist_id FROM user_like_playlists WHERE user_id = %(uid)s
+                """, {"uid": int(user_id)})
+                likes = {"track": [], "album": [], "artist": [], "playlist": []}
+                for obj_type, obj_id in cur.fetchall():
+                    likes[obj_type].append(obj_id)
+                return self.like_cache.put(user_id, likes, generation)
+        finally:
+            self._put_conn(conn)
+
+    def get_user_history(self, user_id: str):
+        conn = self._get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT track_id FROM user_history WHERE user_id = %s ORDER BY timestamp DESC", (int(user_id),))
+                return [r[0] for r in cur.fetchall()]
+        finally:
+            self._put_conn(conn)
+
+    def get_user_top_genres(self, user_id: str):
+        conn = self._get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT top_genres FROM users WHERE id = %s", (int(user_id),))
+                row = cur.fetchone()
+                if not row or not row[0]:
+                    return []
+                return json.loads(row[0]) if isinstance(row[0], str) else row[0]
+        finally:
+            self._put_conn(conn)
+
     def get_user_all(self):
         conn = self._get_conn()
         try:
@@ -289,6 +388,52 @@ class PostgresRepository(BaseRepository):
         finally:
             self._put_conn(conn)
 
+    def get_album_detail(self, album_id: int):
+        """Album with its artists, genres and ordered tracks (with artist names), aggregated as JSON in one query."""
+        conn = self._get_conn()
+        try:
+            with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT a.id, a.name, a.cover, a.cover_small, a.cover_bucket, a.date, a.library_id,
+                           COALESCE((
+                               SELECT json_agg(json_build_object('id', ar.id, 'name', ar.name) ORDER BY ar.id)
+                               FROM album_artists aa
+                               JOIN artists ar ON ar.id = aa.artist_id
+                               WHERE aa.album_id = a.id
+                           ), '[]') AS artists,
+                           COALESCE((
+                               SELECT json_agg(json_build_object('id', g.id, 'name', g.name) ORDER BY g.id)
+                               FROM album_genres ag
+                               JOIN genres g ON g.id = ag.genre_id
+                               WHERE ag.album_id = a.id
+                           ), '[]') AS genres,
+                           COALESCE((
+                               SELECT json_agg(json_build_object(
+                                   'id', t.id,
+                                   'title', t.title,
+                                   'duration', t.duration,
+                                   'artistId', t.artist_id,
+                                   'artistName', tar.name,
+                                   'albumId', t.album_id,
+                                   'albumTrack', t.album_track
+                               ) ORDER BY t.album_track NULLS LAST, t.id)
+                               FROM tracks t
+                               LEFT JOIN artists tar ON tar.id = t.artist_id
+                               WHERE t.album_id = a.id
+                           ), '[]') AS tracks
+                    FROM albums a
+                    WHERE a.id = %s
+                """, (album_id,))
+                album = cur.fetchone()
+                if not album:
+                    return None
+                album = dict(album)
+                album['coverSmall'] = album.pop('cover_small')
+                album['coverBucket'] = album.pop('cover_bucket')
+                return album
+        finally:
+            self._put_conn(conn)
+
     def get_track(self, track_id: int):
         conn = self._get_conn()
         try:
@@ -349,6 +494,53 @@ class PostgresRepository(BaseRepository):
         finally:
             self._put_conn(conn)
 
+    def get_tracks_enriched(self, track_ids: List[int]):
+        """Tracks joined with their album/artist names and cover fields, in the order of track_ids."""
+        if not track_ids:
+            return []
+        conn = self._get_conn()
+        try:
+            with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT t.*,
+                           al.name AS "albumName",
+                           ar.name AS "artistName",
+                           al.cover, al.cover_small, al.cover_bucket
+                    FROM unnest(%s::bigint[]) WITH ORDINALITY AS ids(id, ord)
+                    JOIN tracks t ON t.id = ids.id
+                    LEFT JOIN albums al ON al.id = t.album_id
+                    LEFT JOIN artists ar ON ar.id = t.artist_id
+                    ORDER BY ids.ord
+                """, ([int(tid) for tid in track_ids],))
+                tracks = cur.fetchall()
+                for t in tracks:
+                    t['artistId'] = t.pop('artist_id')
+                    t['albumId'] = t.pop('album_id')
+                    t['albumTrack'] = t.pop('album_track')
+                    t['coverSmall'] = t.pop('cover_small')
+                    t['coverBucket'] = t.pop('cover_bucket')
+                return [dict(t) for t in tracks]
+        finally:
+            self._put_conn(conn)
+
+    def get_track_locations(self, track_ids: List[int]):
+        """id/path/bucket/library_id of the tracks in the order of track_ids; library_id falls back to the album's."""
+        if not track_ids:
+            return []
+        conn = self._get_conn()
+        try:
+            with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT t.id, t.path, t.bucket, COALESCE(t.library_id, al.library_id) AS library_id
+                    FROM unnest(%s::bigint[]) WITH ORDINALITY AS ids(id, ord)
+                    JOIN tracks t ON t.id = ids.id
+                    LEFT JOIN albums al ON al.id = t.album_id
+                    ORDER BY ids.ord
+                """, ([int(tid) for tid in track_ids],))
+                return [dict(t) for t in cur.fetchall()]
+        finally:
+            self._put_conn(conn)
+
     def all_albums(self):
         conn = self._get_conn()
         try:
@@ -386,6 +578,254 @@ class PostgresRepository(BaseRepository):
         finally:
             self._put_conn(conn)
 
+    ALBUMS_PAGE_SQL = """
+        SELECT a.id, a.name, a.cover, a.cover_small, a.cover_bucket, a.date, a.library_id,
+               pa.artist_id AS "artistId", pa.name AS "artistName"
+        FROM albums a
+        LEFT JOIN LATERAL (
+            SELECT aa.artist_id, ar.name
+            FROM album_artists aa
+            JOIN artists ar ON ar.id = aa.artist_id
+            WHERE aa.album_id = a.id
+            ORDER BY aa.artist_id
+            LIMIT 1
+        ) pa ON TRUE
+        {where}
+        ORDER BY a.name, a.id
+        LIMIT %(limit)s
+    """
+
+    ARTISTS_PAGE_SQL = """
+        SELECT id, name, image, bucket, library_id
+        FROM artists
+        {where}
+        ORDER BY name, id
+        LIMIT %(limit)s
+    """
+
+    def _keyset(self, columns: str, limit, after):
+        params = {"limit": limit}
+        where = ""
+        if after:
+            where = f"WHERE ({columns}) > (%(after_name)s, %(after_id)s)"
+            params.update(after_name=after[0], after_id=int(after[1]))
+        return where, params
+
+    def _album_row(self, a):
+        a = dict(a)
+        a['coverSmall'] = a.pop('cover_small')
+        a['coverBucket'] = a.pop('cover_bucket')
+        return a
+
+    def albums_page(self, limit: int = None, after: tuple = None):
+        """Albums ordered by (name, id), starting after the (name, id) keyset cursor.
+
+        Rows carry the primary artist as scalar artistId/artistName instead of the aggregated lists of all_albums.
+        """
+        where, params = self._keyset("a.name, a.id", limit, after)
+        conn = self._get_conn()
+        try:
+            with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+                cur.execute(self.ALBUMS_PAGE_SQL.format(where=where), params)
+                return [self._album_row(a) for a in cur.fetchall()]
+        finally:
+            self._put_conn(conn)
+
+    def artists_page(self, limit: int = None, after: tuple = None):
+        where, params = self._keyset("name, id", limit, after)
+        conn = self._get_conn()
+        try:
+            with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+                cur.execute(self.ARTISTS_PAGE_SQL.format(where=where), params)
+                return [dict(a) for a in cur.fetchall()]
+        finally:
+            self._put_conn(conn)
+
+    def _stream(self, sql, params=None):
+        """Yield rows from a server-side (named) cursor, fetching STREAM_ITERSIZE rows per round trip."""
+        conn = self._get_conn()
+        try:
+            with conn.cursor(name=f"stream_{uuid.uuid4().hex}", cursor_factory=extras.RealDictCursor) as cur:
+                cur.itersize = STREAM_ITERSIZE
+                cur.execute(sql, params)
+                for row in cur:
+                    yield row
+        finally:
+            # Ferme la transaction ouverte par le curseur nommé avant de rendre la connexion
+            conn.rollback()
+            self._put_conn(conn)
+
+    def iter_albums(self, after: tuple = None):
+        where, params = self._keyset("a.name, a.id", None, after)
+        for a in self._stream(self.ALBUMS_PAGE_SQL.format(where=where), params):
+            yield self._album_row(a)
+
+    def iter_artists(self, after: tuple = None):
+        where, params = self._keyset("name, id", None, after)
+        for a in self._stream(self.ARTISTS_PAGE_SQL.format(where=where), params):
+            yield dict(a)
+
+    def iter_users(self):
+        # Même forme que get_user_all, sans les requêtes par utilisateur
+        for user in self._stream("""
+            SELECT u.*,
+                   ARRAY(SELECT track_id FROM user_like_tracks WHERE user_id = u.id) AS like_track,
+                   ARRAY(SELECT album_id FROM user_like_albums WHERE user_id = u.id) AS like_album,
+                   ARRAY(SELECT artist_id FROM user_like_artists WHERE user_id = u.id) AS like_artist,
+                   ARRAY(SELECT playlist_id FROM user_like_playlists WHERE user_id = u.id) AS like_playlist,
+                   ARRAY(SELECT track_id FROM user_history WHERE user_id = u.id ORDER BY timestamp DESC) AS history
+            FROM users u
+            ORDER BY u.id
+        """):
+            user = dict(user)
+            user['like'] = {t: user.pop(f'like_{t}') or [] for t in ('track', 'album', 'artist', 'playlist')}
+            user['history'] = user['history'] or []
+            if isinstance(user['top_genres'], str):
+                user['top_genres'] = json.loads(user['top_genres'])
+            user['id'] = str(user['id'])
+            yield user
+
+    def albums_by_ids(self, album_ids: List[int]):
+        """Rows shaped like albums_page, in the order of album_ids."""
+        if not album_ids:
+            return []
+        conn = self._get_conn()
+        try:
+            with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT a.id, a.name, a.cover, a.cover_small, a.cover_bucket, a.date, a.library_id,
+                           pa.artist_id AS "artistId", pa.name AS "artistName"
+                    FROM unnest(%s::bigint[]) WITH ORDINALITY AS ids(id, ord)
+                    JOIN albums a ON a.id = ids.id
+                    LEFT JOIN LATERAL (
+                        SELECT aa.artist_id, ar.name
+                        FROM album_artists aa
+                        JOIN artists ar ON ar.id = aa.artist_id
+                        WHERE aa.album_id = a.id
+                        ORDER BY aa.artist_id
+                        LIMIT 1
+                    ) pa ON TRUE
+                    ORDER BY ids.ord
+                """, (list(album_ids),))
+                return [self._album_row(a) for a in cur.fetchall()]
+        finally:
+            self._put_conn(conn)
+
+    def albums_by_genre(self, genre_ids: List[int], mode: str = "all", limit: int = None, random: bool = True):
+        genre_ids = list(dict.fromkeys(int(g) for g in genre_ids))
+        if not genre_ids:
+            return []
+        if mode == "all":
+            matching = "SELECT album_id FROM album_genres WHERE genre_id = ANY(%(ids)s) GROUP BY album_id HAVING COUNT(*) = %(n)s"
+        else:
+            matching = "SELECT DISTINCT album_id FROM album_genres WHERE genre_id = ANY(%(ids)s)"
+        order = "random()" if random else "album_id"
+        conn = self._get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT album_id FROM ({matching}) m ORDER BY {order} LIMIT %(limit)s",
+                            {"ids": genre_ids, "n": len(genre_ids), "limit": limit})
+                return [r[0] for r in cur.fetchall()]
+        finally:
+            self._put_conn(conn)
+
+    def album_genre_pairs(self):
+        for row in self._stream("SELECT genre_id, album_id FROM album_genres ORDER BY genre_id, album_id"):
+            yield row["genre_id"], row["album_id"]
+
+    def sample_albums(self, n: int, include_genres: List[int] = None, exclude_ids=()):
+        """Random album ids through indexed random-offset probes: each draw seeks the first album id
+        at or after a random point of the id range, so the cost depends on n, not on the catalog size.
+        """
+        if n <= 0:
+            return []
+        params = {"draws": n * 3 + 10, "n": n, "exclude": [int(i) for i in exclude_ids]}
+        genre_filter = ""
+        if include_genres:
+            genre_filter = "AND EXISTS (SELECT 1 FROM album_genres ag WHERE ag.album_id = a.id AND ag.genre_id = ANY(%(genres)s))"
+            params["genres"] = [int(g) for g in include_genres]
+        conn = self._get_conn()
+        try:
+            with conn.cursor() as cur:
+                # Cibles tirées une fois par ligne dans une CTE (volatile, donc jamais inlinée) :
+                # le LATERAL reste une recherche indexée sur albums.id
+                cur.execute(f"""
+                    WITH bounds AS (SELECT min(id) AS lo, max(id) AS hi FROM albums),
+                    draws AS (
+                        SELECT lo + floor(random() * (hi - lo + 1))::bigint AS target
+                        FROM bounds, generate_series(1, %(draws)s)
+                    )
+                    SELECT id FROM (
+                        SELECT DISTINCT pick.id
+                        FROM draws r
+                        CROSS JOIN LATERAL (
+                            SELECT a.id FROM albums a
+                            WHERE a.id >= r.target
+                              AND NOT (a.id = ANY(%(exclude)s::bigint[]))
+                              {genre_filter}
+                            ORDER BY a.id
+                            LIMIT 1
+                        ) pick
+                    ) picks
+                    ORDER BY random()
+                    LIMIT %(n)s
+                """, params)
+                picked = [r[0] for r in cur.fetchall()]
+                if len(picked) < n:
+                    # Peu de candidats : on complète par un tirage exhaustif
+                    params.update(n=n - len(picked), exclude=params["exclude"] + picked)
+                    cur.execute(f"""
+                        SELECT a.id FROM albums a
+                        WHERE NOT (a.id = ANY(%(exclude)s::bigint[]))
+                          {genre_filter}
+                        ORDER BY random()
+                        LIMIT %(n)s
+                    """, params)
+                    picked += [r[0] for r in cur.fetchall()]
+                return picked
+        finally:
+            self._put_conn(conn)
+
+    def random_track_per_album(self, album_ids: List[int]):
+        if not album_ids:
+            return []
+        conn = self._get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT t.id
+                    FROM unnest(%s::bigint[]) WITH ORDINALITY AS ids(id, ord)
+                    JOIN LATERAL (
+                        SELECT id FROM tracks WHERE album_id = ids.id ORDER BY random() LIMIT 1
+                    ) t ON TRUE
+                    ORDER BY ids.ord
+                """, (list(album_ids),))
+                return [r[0] for r in cur.fetchall()]
+        finally:
+            self._put_conn(conn)
+
+    def _cached_count(self, table: str):
+        count = self._counts.get(table)
+        if count is None:
+            conn = self._get_conn()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(f"SELECT COUNT(*) FROM {table}")
+                    count = cur.fetchone()[0]
+            finally:
+                self._put_conn(conn)
+            self._counts[table] = count
+        return count
+
+    def _invalidate_counts(self):
+        self._counts = {}
+
+    def count_albums(self):
+        return self._cached_count("albums")
+
+    def count_artists(self):
+        return self._cached_count("artists")
+
     def all_genres(self):
         conn = self._get_conn()
         try:
@@ -478,6 +918,7 @@ class PostgresRepository(BaseRepository):
                 else:
                     cur.execute(f"DELETE FROM {table} WHERE user_id = %s AND {id_col} = %s", (int(user_id), obj_id))
                 conn.commit()
+            self.like_cache.set_like(user_id, obj_type, obj_id, like)
         finally:
             self._put_conn(conn)
 
@@ -498,7 +939,10 @@ class PostgresRepository(BaseRepository):
         try:
             with conn.cursor() as cur:
                 cur.execute("DELETE FROM playlists WHERE id = %s AND owner_id = %s", (playlist_id, int(user_id)))
+                deleted = cur.rowcount > 0
                 conn.commit()
+            if deleted:
+                self.like_cache.drop_object("playlist", playlist_id)
         finally:
             self._put_conn(conn)
 
@@ -544,6 +988,29 @@ class PostgresRepository(BaseRepository):
         finally:
             self._put_conn(conn)
 
+    def get_bucket_policy_checks(self):
+        conn = self._get_conn()
+        try:
+            with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+                cur.execute("SELECT library_id, config_hash, status, checked_at FROM bucket_policy_checks")
+                return {row['library_id']: dict(row) for row in cur.fetchall()}
+        finally:
+            self._put_conn(conn)
+
+    def save_bucket_policy_check(self, library_id: int, config_hash: str, status: str):
+        conn = self._get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO bucket_policy_checks (library_id, config_hash, status, checked_at)
+                    VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
+                    ON CONFLICT (library_id) DO UPDATE
+                    SET config_hash = EXCLUDED.config_hash, status = EXCLUDED.status, checked_at = EXCLUDED.checked_at
+                """, (library_id, config_hash, status))
+                conn.commit()
+        finally:
+            self._put_conn(conn)
+
     def update_library(self, library_id: int, library_data: dict):
         conn = self._get_conn()
         try:
@@ -591,34 +1058,63 @@ class PostgresRepository(BaseRepository):
                 cur.execute("DELETE FROM albums WHERE library_id = %s", (library_id,))
                 cur.execute("DELETE FROM artists WHERE library_id = %s", (library_id,))
                 cur.execute("DELETE FROM libraries WHERE id = %s", (library_id,))
+                cur.execute("DELETE FROM bucket_policy_checks WHERE library_id = %s", (library_id,))
                 conn.commit()
+                self._invalidate_counts()
                 return True
         finally:
             self._put_conn(conn)
 
     def update_user_top_genres(self):
-        # Implementation of top genres update using SQL
+        """Refresh users.top_genres from the user_genre_counts counters.
+
+        Only users queued in top_genres_dirty by the counter writers (history flushes, imports, stale-track
+        cleanup) are recomputed. The first run (no top_genres_backfill marker) rebuilds every counter from
+        the whole history in one INSERT ... SELECT.
+        """
         conn = self._get_conn()
         try:
             with conn.cursor() as cur:
-                cur.execute("SELECT id FROM users")
-                user_ids = [r[0] for r in cur.fetchall()]
-                for uid in user_ids:
+                cur.execute("SELECT 1 FROM job_watermarks WHERE name = 'top_genres_backfill'")
+                backfilled = cur.fetchone() is not None
+
+                if not backfilled:
+                    cur.execute("LOCK TABLE user_genre_counts IN EXCLUSIVE MODE")
+                    cur.execute("DELETE FROM user_genre_counts")
                     cur.execute("""
-                        SELECT g.id, g.name, COUNT(*) as count
+                        INSERT INTO user_genre_counts (user_id, genre_id, count)
+                        SELECT uh.user_id, ag.genre_id, COUNT(*)
                         FROM user_history uh
                         JOIN tracks t ON uh.track_id = t.id
-                        JOIN albums a ON t.album_id = a.id
-                        JOIN album_genres ag ON a.id = ag.album_id
-                        JOIN genres g ON ag.genre_id = g.id
-                        WHERE uh.user_id = %s
-                        GROUP BY g.id, g.name
-                        ORDER BY count DESC
-                        LIMIT 10
-                    """, (uid,))
-                    top_genres = [{"id": r[0], "name": r[1], "count": r[2]} for r in cur.fetchall()]
-                    cur.execute("UPDATE users SET top_genres = %s WHERE id = %s", (json.dumps(top_genres), uid))
+                        JOIN album_genres ag ON t.album_id = ag.album_id
+                        GROUP BY uh.user_id, ag.genre_id
+                    """)
+                    cur.execute("DELETE FROM top_genres_dirty")
+                    cur.execute("INSERT INTO job_watermarks (name, value) VALUES ('top_genres_backfill', 0)")
+                    cur.execute("SELECT id FROM users")
+                else:
+                    # A writer marking a user after this DELETE re-inserts the row: picked up by the next run
+                    cur.execute("DELETE FROM top_genres_dirty RETURNING user_id")
+                user_ids = [r[0] for r in cur.fetchall()]
+
+                if user_ids:
+                    cur.execute("""
+                        UPDATE users u
+                        SET top_genres = COALESCE((
+                            SELECT json_agg(json_build_object('id', g.id, 'name', g.name, 'count', c.count) ORDER BY c.count DESC, g.id)
+                            FROM (
+                                SELECT genre_id, count FROM user_genre_counts
+                                WHERE user_id = u.id AND count > 0
+                                ORDER BY count DESC, genre_id
+                                LIMIT 10
+                            ) c
+                            JOIN genres g ON g.id = c.genre_id
+                        ), '[]')
+                        WHERE u.id = ANY(%s)
+                    """, (user_ids,))
+
                 conn.commit()
+                logger.info(f"Top genres refreshed for {len(user_ids)} users.")
         finally:
             self._put_conn(conn)
 
@@ -661,12 +1157,16 @@ class PostgresRepository(BaseRepository):
                 
                 # 3. Clean up history
                 cur.execute("DELETE FROM user_history WHERE user_id = %s", (uid,))
+                cur.execute("DELETE FROM user_genre_counts WHERE user_id = %s", (uid,))
                 
                 # 4. Finally delete the user
                 cur.execute("DELETE FROM users WHERE id = %s", (uid,))
                 
                 conn.commit()
-                return True
+            self.like_cache.drop_user(uid)
+            for pid in playlist_ids:
+                self.like_cache.drop_object("playlist", pid)
+            return True
         finally:
             self._put_conn(conn)
 
@@ -701,22 +1201,80 @@ class PostgresRepository(BaseRepository):
             self._put_conn(conn)
 
     def add_track_to_history(self, user_id: str, track_id: int):
+        self.add_tracks_to_history([(user_id, track_id, datetime.utcnow())])
+
+    def add_tracks_to_history(self, events):
+        """Write buffered plays, (user_id, track_id, played_at UTC) in play order, in one transaction.
+
+        A replay only moves the row to the front; each user keeps the HISTORY_LIMIT latest plays and the
+        genre counters follow that window. Plays of deleted users or tracks are dropped.
+        """
+        plays = {}
+        for user_id, track_id, played_at in events:
+            key = (int(user_id), int(track_id))
+            plays.pop(key, None)
+            plays[key] = played_at
+        if not plays:
+            return
+        # Ages rather than UTC timestamps: the column default is the session's local time
+        now = datetime.utcnow()
+        user_ids = [u for u, _ in plays]
+        track_ids = [t for _, t in plays]
+        ages = [max((now - at).total_seconds(), 0) for at in plays.values()]
         conn = self._get_conn()
         try:
             with conn.cursor() as cur:
-                cur.execute("DELETE FROM user_history WHERE user_id = %s AND track_id = %s", (int(user_id), track_id))
-                cur.execute("INSERT INTO user_history (user_id, track_id) VALUES (%s, %s)", (int(user_id), track_id))
-                # Cleanup old history
                 cur.execute("""
-                    DELETE FROM user_history 
-                    WHERE id IN (
-                        SELECT id FROM user_history 
-                        WHERE user_id = %s 
-                        ORDER BY timestamp DESC 
-                        OFFSET 200
+                    INSERT INTO user_history (user_id, track_id, timestamp)
+                    SELECT p.user_id, p.track_id, LOCALTIMESTAMP - p.age * INTERVAL '1 second'
+                    FROM unnest(%s::int[], %s::bigint[], %s::float8[]) AS p(user_id, track_id, age)
+                    JOIN users u ON u.id = p.user_id
+                    JOIN tracks t ON t.id = p.track_id
+                    ON CONFLICT (user_id, track_id) DO UPDATE SET timestamp = EXCLUDED.timestamp
+                    RETURNING user_id, track_id, (xmax = 0) AS inserted
+                """, (user_ids, track_ids, ages))
+                added = [(u, t) for u, t, inserted in cur.fetchall() if inserted]
+
+                cur.execute("""
+                    DELETE FROM user_history h
+                    USING (
+                        SELECT id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timestamp DESC) AS rn
+                        FROM user_history
+                        WHERE user_id = ANY(%s)
+                    ) r
+                    WHERE h.id = r.id AND r.rn > %s
+                    RETURNING h.user_id, h.track_id
+                """, (list(set(user_ids)), HISTORY_LIMIT))
+                evicted = cur.fetchall()
+
+                # Counters follow the history window: +1 per genre of a new track, -1 per genre of an evicted one
+                if added or evicted:
+                    cur.execute("""
+                        INSERT INTO user_genre_counts (user_id, genre_id, count)
+                        SELECT c.user_id, ag.genre_id, SUM(c.delta)
+                        FROM (
+                            SELECT *, 1 AS delta FROM unnest(%s::int[], %s::bigint[]) AS a(user_id, track_id)
+                            UNION ALL
+                            SELECT *, -1 FROM unnest(%s::int[], %s::bigint[]) AS e(user_id, track_id)
+                        ) c
+                        JOIN tracks t ON t.id = c.track_id
+                        JOIN album_genres ag ON ag.album_id = t.album_id
+                        GROUP BY c.user_id, ag.genre_id
+                        HAVING SUM(c.delta) <> 0
+                        ON CONFLICT (user_id, genre_id) DO UPDATE SET count = user_genre_counts.count + EXCLUDED.count
+                    """, (
+                        [u for u, _ in added], [t for _, t in added],
+                        [u for u, _ in evicted], [t for _, t in evicted]
+                    ))
+                    cur.execute("DELETE FROM user_genre_counts WHERE user_id = ANY(%s) AND count <= 0", (list(set(user_ids)),))
+                    cur.execute(
+                        "INSERT INTO top_genres_dirty (user_id) SELECT DISTINCT unnest(%s::int[]) ON CONFLICT DO NOTHING",
+                        ([u for u, _ in added] + [u for u, _ in evicted],)
                     )
-                """, (int(user_id),))
                 conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
         finally:
             self._put_conn(conn)
 
@@ -744,6 +1302,7 @@ class PostgresRepository(BaseRepository):
                 """, (name, image, bucket, library_id))
                 aid = cur.fetchone()[0]
                 conn.commit()
+                self._invalidate_counts()
                 return aid
         finally:
             self._put_conn(conn)
@@ -769,6 +1328,7 @@ class PostgresRepository(BaseRepository):
                         cur.execute("INSERT INTO album_genres (album_id, genre_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (albid, gid))
                 
                 conn.commit()
+                self._invalidate_counts()
                 return albid
         finally:
             self._put_conn(conn)
@@ -824,6 +1384,90 @@ class PostgresRepository(BaseRepository):
         finally:
             self._put_conn(conn)
 
+    def delete_tracks_not_in(self, library_id: int, scanned_paths):
+        """Delete the library's tracks missing from scanned_paths in one transaction.
+
+        The paths are COPYed into a temp staging table and the stale tracks found by anti-join; their
+        playlist entries, likes and history rows (with the genre counters) go with them, as do the albums
+        left without tracks. Returns the number of tracks deleted.
+        """
+        conn = self._get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("CREATE TEMP TABLE scan_paths (path TEXT PRIMARY KEY) ON COMMIT DROP")
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                for path in set(scanned_paths):
+                    writer.writerow([path])
+                buffer.seek(0)
+                cur.copy_expert("COPY scan_paths FROM STDIN WITH (FORMAT csv)", buffer)
+                cur.execute("ANALYZE scan_paths")
+
+                cur.execute("""
+                    CREATE TEMP TABLE stale_tracks ON COMMIT DROP AS
+                    SELECT t.id, t.album_id
+                    FROM tracks t
+                    WHERE t.library_id = %s
+                      AND NOT EXISTS (SELECT 1 FROM scan_paths s WHERE s.path = t.path)
+                """, (library_id,))
+                removed = cur.rowcount
+
+                if removed:
+                    # History rows going away no longer count in the genre counters
+                    cur.execute("""
+                        UPDATE user_genre_counts c
+                        SET count = c.count - d.n
+                        FROM (
+                            SELECT uh.user_id, ag.genre_id, COUNT(*) AS n
+                            FROM user_history uh
+                            JOIN stale_tracks st ON st.id = uh.track_id
+                            JOIN album_genres ag ON ag.album_id = st.album_id
+                            GROUP BY uh.user_id, ag.genre_id
+                        ) d
+                        WHERE c.user_id = d.user_id AND c.genre_id = d.genre_id
+                    """)
+                    cur.execute("DELETE FROM user_genre_counts WHERE count <= 0")
+                    cur.execute("""
+                        INSERT INTO top_genres_dirty (user_id)
+                        SELECT DISTINCT uh.user_id FROM user_history uh JOIN stale_tracks st ON st.id = uh.track_id
+                        ON CONFLICT DO NOTHING
+                    """)
+                    cur.execute("DELETE FROM playlist_tracks WHERE track_id IN (SELECT id FROM stale_tracks)")
+                    cur.execute("DELETE FROM user_like_tracks WHERE track_id IN (SELECT id FROM stale_tracks)")
+                    cur.execute("DELETE FROM user_history WHERE track_id IN (SELECT id FROM stale_tracks)")
+                    cur.execute("DELETE FROM tracks WHERE id IN (SELECT id FROM stale_tracks)")
+
+                    cur.execute("""
+                        CREATE TEMP TABLE emptied_albums ON COMMIT DROP AS
+                        SELECT DISTINCT st.album_id AS id
+                        FROM stale_tracks st
+                        WHERE st.album_id IS NOT NULL
+                          AND NOT EXISTS (SELECT 1 FROM tracks t WHERE t.album_id = st.album_id)
+                    """)
+                    cur.execute("DELETE FROM user_like_albums WHERE album_id IN (SELECT id FROM emptied_albums)")
+                    cur.execute("DELETE FROM album_artists WHERE album_id IN (SELECT id FROM emptied_albums)")
+                    cur.execute("DELETE FROM album_genres WHERE album_id IN (SELECT id FROM emptied_albums)")
+                    cur.execute("DELETE FROM albums WHERE id IN (SELECT id FROM emptied_albums)")
+
+                    # Remaining albums: denormalized track_ids without the deleted tracks
+                    cur.execute("""
+                        UPDATE albums a
+                        SET track_ids = COALESCE((
+                            SELECT array_agg(t.id ORDER BY t.album_track) FROM tracks t WHERE t.album_id = a.id
+                        ), '{}')
+                        WHERE a.id IN (SELECT DISTINCT album_id FROM stale_tracks)
+                    """)
+                conn.commit()
+        finally:
+            self._put_conn(conn)
+
+        if removed:
+            self._invalidate_counts()
+            # Likes on deleted tracks/albums: cached sets are reloaded on next access
+            self.like_cache.clear()
+            logger.info(f"Removed {removed} stale tracks from library {library_id}.")
+        return removed
+
     def search(self, query: str):
         conn = self._get_conn()
         q = f"%{query}%"
@@ -855,11 +1499,13 @@ class PostgresRepository(BaseRepository):
             self._put_conn(conn)
 
     # --- PERFORMANCE OPTIMIZED BULK LOAD ---
-    def copy_to_staging(self, file_obj):
+    def copy_to_staging(self, file_obj, truncate=True):
+        """COPY tab-separated rows into tracks_staging; truncate=False appends to the rows already staged."""
         conn = self._get_conn()
         try:
             with conn.cursor() as cur:
-                cur.execute("TRUNCATE tracks_staging")
+                if truncate:
+                    cur.execute("TRUNCATE tracks_staging")
                 cur.copy_expert("COPY tracks_staging FROM STDIN WITH (FORMAT csv, DELIMITER E'\\t')", file_obj)
                 conn.commit()
         finally:
@@ -920,15 +1566,34 @@ class PostgresRepository(BaseRepository):
                     ON CONFLICT DO NOTHING
                 """)
 
-                # 6. Junctions: album_genres
+                # 6. Junctions: album_genres. A genre new to an album already in someone's history
+                # counts for that user's plays of the album, like add_tracks_to_history would have counted it
                 cur.execute("""
-                    INSERT INTO album_genres (album_id, genre_id)
-                    SELECT DISTINCT al.id, g.id
-                    FROM tracks_staging s
-                    JOIN albums al ON al.name = s.album_name AND al.library_id = s.library_id
-                    CROSS JOIN LATERAL unnest(string_to_array(s.genre_names, ',')) AS gn
-                    JOIN genres g ON g.name = gn
-                    ON CONFLICT DO NOTHING
+                    WITH new_pairs AS (
+                        INSERT INTO album_genres (album_id, genre_id)
+                        SELECT DISTINCT al.id, g.id
+                        FROM tracks_staging s
+                        JOIN albums al ON al.name = s.album_name AND al.library_id = s.library_id
+                        CROSS JOIN LATERAL unnest(string_to_array(s.genre_names, ',')) AS gn
+                        JOIN genres g ON g.name = gn
+                        ON CONFLICT DO NOTHING
+                        RETURNING album_id, genre_id
+                    ),
+                    deltas AS (
+                        SELECT uh.user_id, np.genre_id, COUNT(*) AS n
+                        FROM new_pairs np
+                        JOIN tracks t ON t.album_id = np.album_id
+                        JOIN user_history uh ON uh.track_id = t.id
+                        GROUP BY uh.user_id, np.genre_id
+                    ),
+                    marked AS (
+                        INSERT INTO top_genres_dirty (user_id)
+                        SELECT DISTINCT user_id FROM deltas
+                        ON CONFLICT DO NOTHING
+                    )
+                    INSERT INTO user_genre_counts (user_id, genre_id, count)
+                    SELECT user_id, genre_id, n FROM deltas
+                    ON CONFLICT (user_id, genre_id) DO UPDATE SET count = user_genre_counts.count + EXCLUDED.count
                 """)
 
                 # 7. Denormalization: update album.track_ids
@@ -944,6 +1609,7 @@ class PostgresRepository(BaseRepository):
                 """)
 
                 conn.commit()
+                self._invalidate_counts()
                 cur.execute("SET synchronous_commit TO ON")
         finally:
             self._put_conn(conn)
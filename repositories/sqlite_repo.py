@@ -1,24 +1,85 @@
 # /repositories/sqlite_repo.py
+import csv
 import logging
 import uuid
+from itertools import islice
+from array import array
 from datetime import datetime
 from typing import List
-from sqlalchemy import create_engine, select, delete, func, desc
-from sqlalchemy.orm import sessionmaker, joinedload
+from sqlalchemy import create_engine, event, select, delete, insert, update, func, desc, text, tuple_, table, column
+from sqlalchemy.orm import sessionmaker, joinedload, selectinload
 from repositories.base import BaseRepository
-from repositories.models import Base, User, Artist, Album, Track, Genre, Playlist, Library, RegistrationToken, UserHistory, PlaylistTrack, album_artists, album_genres, user_like_tracks, user_like_albums, user_like_artists, user_like_playlists
+from repositories.like_cache import LikeCache
+from repositories.genre_index import sample_ids
+from repositories.models import Base, User, Artist, Album, Track, Genre, Playlist, Library, RegistrationToken, UserHistory, UserGenreCount, JobWatermark, TopGenresDirty, BucketPolicyCheck, PlaylistTrack, album_artists, album_genres, user_like_tracks, user_like_albums, user_like_artists, user_like_playlists
 from passlib.context import CryptContext
 
 logger = logging.getLogger(__name__)
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+STREAM_BATCH = 1000 # rows buffered per yield_per batch by the iter_* methods
+HISTORY_LIMIT = 200 # plays kept per user
+
+STAGING_BATCH = 5000 # rows per executemany in copy_to_staging
+STAGING_COLUMNS = ["artist_name", "album_name", "genre_names", "title", "duration", "album_track", "path", "bucket",
+                   "cover", "cover_small", "cover_bucket", "date", "library_id"]
+
+# Temp tables of delete_tracks_not_in
+scan_paths = table("scan_paths", column("path"))
+stale_tracks = table("stale_tracks", column("id"), column("album_id"))
+
 class SqliteRepository(BaseRepository):
     def __init__(self, db_url="sqlite:///./database.db"):
         self.engine = create_engine(db_url, connect_args={"check_same_thread": False})
+        event.listen(self.engine, "connect", self._set_pragmas)
         Base.metadata.create_all(self.engine)
         self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        self.like_cache = LikeCache()
+        self._counts = {} # model -> cached COUNT(*), reset by _invalidate_counts
+        self._album_ids = None # sorted album ids for sample_albums, reset by _invalidate_counts
+        self._initialize_indexes()
+        self._initialize_staging()
         self._initialize_admin()
 
+    @staticmethod
+    def _set_pragmas(dbapi_conn, _):
+        # WAL : les lectures ne bloquent pas pendant l'import d'un scan, un fsync par commit suffit
+        cursor = dbapi_conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    def _initialize_indexes(self):
+        # create_all ne crée pas les index sur des tables déjà existantes
+        with self.engine.begin() as conn:
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_albums_name_id ON albums(name, id)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_artists_name_id ON artists(name, id)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_album_genres_genre_album ON album_genres(genre_id, album_id)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_album_artists_album_artist ON album_artists(album_id, artist_id)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_tracks_path ON tracks(path)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_user_history_user_track ON user_history(user_id, track_id)"))
+
+    def _initialize_staging(self):
+        # Même colonnes que tracks_staging côté PostgreSQL
+        with self.engine.begin() as conn:
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS tracks_staging (
+                    artist_name TEXT,
+                    album_name TEXT,
+                    genre_names TEXT,
+                    title TEXT,
+                    duration TEXT,
+                    album_track INTEGER,
+                    path TEXT,
+                    bucket TEXT,
+                    cover TEXT,
+                    cover_small TEXT,
+                    cover_bucket TEXT,
+                    date TEXT,
+                    library_id INTEGER
+                )
+            """))
+
     def _initialize_admin(self):
         with self.SessionLocal() as session:
             admin = session.query(User).filter(User.role == "admin").first()
@@ -123,11 +184,81 @@ class SqliteRepository(BaseRepository):
             user = session.query(User).filter(User.id == int(user_id)).first()
             return self._to_dict(user)
 
+    def get_user_principal(self, user_id: str):
+        with self.SessionLocal() as session:
+            row = session.query(User.id, User.username, User.role).filter(User.id == int(user_id)).first()
+            if not row:
+                return None
+            return {"id": str(row.id), "username": row.username, "role": row.role}
+
+    def get_user_likes(self, user_id: str):
+        cached = self.like_cache.get(user_id)
+        if cached is not None:
+            return cached
+        generation = self.like_cache.generation(user_id)
+        uid = int(user_id)
+        with self.SessionLocal() as session:
+            return self.like_cache.put(user_id, {
+                "track": list(session.scalars(select(user_like_tracks.c.track_id).where(user_like_tracks.c.user_id == uid))),
+                "album": list(session.scalars(select(user_like_albums.c.album_id).where(user_like_albums.c.user_id == uid))),
+                "artist": list(session.scalars(select(user_like_artists.c.artist_id).where(user_like_artists.c.user_id == uid))),
+                "playlist": list(session.scalars(select(user_like_playlists.c.playlist_id).where(user_like_playlists.c.user_id == uid)))
+            }, generation)
+
+    def get_user_history(self, user_id: str):
+        with self.SessionLocal() as session:
+            return list(session.scalars(
+                select(UserHistory.track_id)
+                .where(UserHistory.user_id == int(user_id))
+                .order_by(UserHistory.timestamp.desc())
+            ))
+
+    def get_user_top_genres(self, user_id: str):
+        with self.SessionLocal() as session:
+            top_genres = session.scalar(select(User.top_genres).where(User.id == int(user_id)))
+            return top_genres or []
+
     def get_album(self, album_id: int):
         with self.SessionLocal() as session:
             album = session.query(Album).filter(Album.id == album_id).first()
             return self._to_dict(album)
 
+    def get_album_detail(self, album_id: int):
+        with self.SessionLocal() as session:
+            album = (
+                session.query(Album)
+                .options(
+                    selectinload(Album.artists),
+                    selectinload(Album.genres),
+                    selectinload(Album.tracks).joinedload(Track.artist)
+                )
+                .filter(Album.id == album_id)
+                .first()
+            )
+            if not album:
+                return None
+            tracks = sorted(album.tracks, key=lambda t: (t.album_track is None, t.album_track or 0, t.id))
+            return {
+                "id": album.id,
+                "name": album.name,
+                "cover": album.cover,
+                "coverSmall": album.coverSmall,
+                "coverBucket": album.coverBucket,
+                "date": album.date,
+                "library_id": album.library_id,
+                "artists": [{"id": a.id, "name": a.name} for a in sorted(album.artists, key=lambda a: a.id)],
+                "genres": [{"id": g.id, "name": g.name} for g in sorted(album.genres, key=lambda g: g.id)],
+                "tracks": [{
+                    "id": t.id,
+                    "title": t.title,
+                    "duration": t.duration,
+                    "artistId": t.artist_id,
+                    "artistName": t.artist.name if t.artist else None,
+                    "albumId": t.album_id,
+                    "albumTrack": t.album_track
+                } for t in tracks]
+            }
+
     def get_track(self, track_id: int):
         with self.SessionLocal() as session:
             track = session.query(Track).filter(Track.id == track_id).first()
@@ -154,6 +285,52 @@ class SqliteRepository(BaseRepository):
             playlist = session.query(Playlist).filter(Playlist.id == playlist_id).first()
             return self._to_dict(playlist)
 
+    def get_tracks_enriched(self, track_ids: List[int]):
+        if not track_ids:
+            return []
+        with self.SessionLocal() as session:
+            by_id = {}
+            unique_ids = list(dict.fromkeys(int(tid) for tid in track_ids))
+            # SQLite caps the number of bound parameters per statement
+            for i in range(0, len(unique_ids), 500):
+                chunk = unique_ids[i:i + 500]
+                rows = (
+                    session.query(Track, Album.name, Artist.name, Album.cover, Album.coverSmall, Album.coverBucket)
+                    .outerjoin(Album, Album.id == Track.album_id)
+                    .outerjoin(Artist, Artist.id == Track.artist_id)
+                    .filter(Track.id.in_(chunk))
+                    .all()
+                )
+                for track, album_name, artist_name, cover, cover_small, cover_bucket in rows:
+                    d = self._to_dict(track)
+                    d.update({
+                        "albumName": album_name,
+                        "artistName": artist_name,
+                        "cover": cover,
+                        "coverSmall": cover_small,
+                        "coverBucket": cover_bucket
+                    })
+                    by_id[track.id] = d
+            return [dict(by_id[int(tid)]) for tid in track_ids if int(tid) in by_id]
+
+    def get_track_locations(self, track_ids: List[int]):
+        if not track_ids:
+            return []
+        with self.SessionLocal() as session:
+            by_id = {}
+            unique_ids = list(dict.fromkeys(int(tid) for tid in track_ids))
+            for i in range(0, len(unique_ids), 500):
+                chunk = unique_ids[i:i + 500]
+                rows = (
+                    session.query(Track.id, Track.path, Track.bucket, func.coalesce(Track.library_id, Album.library_id))
+                    .outerjoin(Album, Album.id == Track.album_id)
+                    .filter(Track.id.in_(chunk))
+                    .all()
+                )
+                for track_id, path, bucket, library_id in rows:
+                    by_id[track_id] = {"id": track_id, "path": path, "bucket": bucket, "library_id": library_id}
+            return [dict(by_id[int(tid)]) for tid in track_ids if int(tid) in by_id]
+
     def all_albums(self):
         with self.SessionLocal() as session:
             albums = session.query(Album).all()
@@ -164,6 +341,155 @@ class SqliteRepository(BaseRepository):
             artists = session.query(Artist).all()
             return [self._to_dict(a) for a in artists]
 
+    def _albums_query(self, session, after=None):
+        primary_artist = (
+            select(func.min(album_artists.c.artist_id))
+            .where(album_artists.c.album_id == Album.id)
+            .correlate(Album)
+            .scalar_subquery()
+        )
+        query = (
+            session.query(Album, Artist.id, Artist.name)
+            .outerjoin(Artist, Artist.id == primary_artist)
+            .order_by(Album.name, Album.id)
+        )
+        if after:
+            query = query.filter(tuple_(Album.name, Album.id) > tuple_(after[0], int(after[1])))
+        return query
+
+    def _album_row(self, album, artist_id, artist_name):
+        return {
+            "id": album.id,
+            "name": album.name,
+            "artistId": artist_id,
+            "artistName": artist_name,
+            "cover": album.cover,
+            "coverSmall": album.coverSmall,
+            "coverBucket": album.coverBucket,
+            "date": album.date,
+            "library_id": album.library_id
+        }
+
+    def _artists_query(self, session, after=None):
+        query = session.query(Artist).order_by(Artist.name, Artist.id)
+        if after:
+            query = query.filter(tuple_(Artist.name, Artist.id) > tuple_(after[0], int(after[1])))
+        return query
+
+    def albums_page(self, limit: int = None, after: tuple = None):
+        with self.SessionLocal() as session:
+            query = self._albums_query(session, after)
+            if limit:
+                query = query.limit(limit)
+            return [self._album_row(*row) for row in query.all()]
+
+    def artists_page(self, limit: int = None, after: tuple = None):
+        with self.SessionLocal() as session:
+            query = self._artists_query(session, after)
+            if limit:
+                query = query.limit(limit)
+            return [self._to_dict(a) for a in query.all()]
+
+    def iter_albums(self, after: tuple = None):
+        with self.SessionLocal() as session:
+            for row in self._albums_query(session, after).yield_per(STREAM_BATCH):
+                yield self._album_row(*row)
+
+    def iter_artists(self, after: tuple = None):
+        with self.SessionLocal() as session:
+            for a in self._artists_query(session, after).yield_per(STREAM_BATCH):
+                yield self._to_dict(a)
+
+    def iter_users(self):
+        with self.SessionLocal() as session:
+            query = (
+                session.query(User)
+                .options(
+                    selectinload(User.history),
+                    selectinload(User.liked_tracks),
+                    selectinload(User.liked_albums),
+                    selectinload(User.liked_artists),
+                    selectinload(User.liked_playlists)
+                )
+                .order_by(User.id)
+                .yield_per(STREAM_BATCH)
+            )
+            for u in query:
+                yield self._to_dict(u)
+
+    def albums_by_ids(self, album_ids: List[int]):
+        by_id = {}
+        unique_ids = list(dict.fromkeys(int(a) for a in album_ids))
+        with self.SessionLocal() as session:
+            for i in range(0, len(unique_ids), 500):
+                chunk = unique_ids[i:i + 500]
+                for row in self._albums_query(session).filter(Album.id.in_(chunk)):
+                    by_id[row[0].id] = self._album_row(*row)
+        return [dict(by_id[int(aid)]) for aid in album_ids if int(aid) in by_id]
+
+    def albums_by_genre(self, genre_ids: List[int], mode: str = "all", limit: int = None, random: bool = True):
+        genre_ids = list(dict.fromkeys(int(g) for g in genre_ids))
+        if not genre_ids:
+            return []
+        query = select(album_genres.c.album_id).where(album_genres.c.genre_id.in_(genre_ids)).group_by(album_genres.c.album_id)
+        if mode == "all":
+            query = query.having(func.count(func.distinct(album_genres.c.genre_id)) == len(genre_ids))
+        query = query.order_by(func.random() if random else album_genres.c.album_id)
+        if limit:
+            query = query.limit(limit)
+        with self.SessionLocal() as session:
+            return list(session.execute(query).scalars())
+
+    def album_genre_pairs(self):
+        with self.SessionLocal() as session:
+            query = select(album_genres.c.genre_id, album_genres.c.album_id).order_by(album_genres.c.genre_id, album_genres.c.album_id)
+            for genre_id, album_id in session.execute(query).yield_per(STREAM_BATCH):
+                yield genre_id, album_id
+
+    def sample_albums(self, n: int, include_genres: List[int] = None, exclude_ids=()):
+        if include_genres:
+            ids = self.albums_by_genre(include_genres, mode="any", random=False)
+        else:
+            if self._album_ids is None:
+                with self.SessionLocal() as session:
+                    self._album_ids = array("q", session.execute(select(Album.id).order_by(Album.id)).scalars())
+            ids = self._album_ids
+        return sample_ids([ids], n, set(exclude_ids))
+
+    def random_track_per_album(self, album_ids: List[int]):
+        if not album_ids:
+            return []
+        picked = {}
+        unique_ids = list(dict.fromkeys(int(a) for a in album_ids))
+        with self.SessionLocal() as session:
+            for i in range(0, len(unique_ids), 500):
+                chunk = unique_ids[i:i + 500]
+                # Ordre aléatoire puis première piste vue par album
+                rows = session.execute(
+                    select(Track.album_id, Track.id).where(Track.album_id.in_(chunk)).order_by(func.random())
+                )
+                for album_id, track_id in rows:
+                    picked.setdefault(album_id, track_id)
+        return [picked[int(aid)] for aid in album_ids if int(aid) in picked]
+
+    def _cached_count(self, model):
+        count = self._counts.get(model)
+        if count is None:
+            with self.SessionLocal() as session:
+                count = session.query(func.count(model.id)).scalar()
+            self._counts[model] = count
+        return count
+
+    def _invalidate_counts(self):
+        self._counts = {}
+        self._album_ids = None
+
+    def count_albums(self):
+        return self._cached_count(Album)
+
+    def count_artists(self):
+        return self._cached_count(Artist)
+
     def all_genres(self):
         with self.SessionLocal() as session:
             genres = session.query(Genre).all()
@@ -240,6 +566,7 @@ class SqliteRepository(BaseRepository):
                     target_list.remove(obj)
             
             session.commit()
+        self.like_cache.set_like(user_id, obj_type, obj_id, like)
 
     def get_user_by_username(self, username: str):
         with self.SessionLocal() as session:
@@ -252,6 +579,7 @@ class SqliteRepository(BaseRepository):
             if playlist:
                 session.delete(playlist)
                 session.commit()
+                self.like_cache.drop_object("playlist", playlist_id)
 
     def create_registration_token(self) -> str:
         with self.SessionLocal() as session:
@@ -276,6 +604,25 @@ class SqliteRepository(BaseRepository):
             libraries = session.query(Library).all()
             return [self._to_dict(lib) for lib in libraries]
 
+    def get_bucket_policy_checks(self):
+        with self.SessionLocal() as session:
+            return {
+                check.library_id: {
+                    "library_id": check.library_id,
+                    "config_hash": check.config_hash,
+                    "status": check.status,
+                    "checked_at": check.checked_at
+                }
+                for check in session.query(BucketPolicyCheck).all()
+            }
+
+    def save_bucket_policy_check(self, library_id: int, config_hash: str, status: str):
+        with self.SessionLocal() as session:
+            session.merge(BucketPolicyCheck(
+                library_id=library_id, config_hash=config_hash, status=status, checked_at=datetime.utcnow()
+            ))
+            session.commit()
+
     def update_library(self, library_id: int, library_data: dict):
         with self.SessionLocal() as session:
             lib = session.query(Library).filter(Library.id == library_id).first()
@@ -307,38 +654,76 @@ class SqliteRepository(BaseRepository):
             session.query(Track).filter(Track.library_id == library_id).delete(synchronize_session='fetch')
             session.query(Album).filter(Album.library_id == library_id).delete(synchronize_session='fetch')
             session.query(Artist).filter(Artist.library_id == library_id).delete(synchronize_session='fetch')
+            session.query(BucketPolicyCheck).filter(BucketPolicyCheck.library_id == library_id).delete()
 
             session.delete(library)
             session.commit()
+            self._invalidate_counts()
             logger.info(f"Library with ID {library_id} and its associated data deleted.")
             return True
 
     def update_user_top_genres(self):
+        """Refresh users.top_genres from the user_genre_counts counters.
+
+        Only users queued in top_genres_dirty by the counter writers are recomputed; the first run (no
+        top_genres_backfill marker) rebuilds every counter from the whole history.
+        """
         with self.SessionLocal() as session:
-            users = session.query(User).all()
-            for user in users:
-                genre_counts = {}
-                history_tracks = session.query(Track).join(UserHistory).filter(UserHistory.user_id == user.id).all()
-                for track in history_tracks:
-                    album = track.album
-                    if album:
-                        for genre in album.genres:
-                            genre_counts[genre.id] = genre_counts.get(genre.id, 0) + 1
-
-                sorted_genres = sorted(genre_counts.items(), key=lambda x: x[1], reverse=True)[:10]
-
-                top_genres_data = []
-                for g_id, count in sorted_genres:
-                    genre = session.query(Genre).filter(Genre.id == g_id).first()
-                    if genre:
-                        top_genres_data.append({
-                            "id": genre.id,
-                            "name": genre.name,
-                            "count": count
-                        })
-
-                user.top_genres = top_genres_data
+            if session.get(JobWatermark, "top_genres_backfill") is None:
+                session.query(UserGenreCount).delete()
+                session.execute(insert(UserGenreCount).from_select(
+                    ["user_id", "genre_id", "count"],
+                    select(UserHistory.user_id, album_genres.c.genre_id, func.count())
+                    .join(Track, Track.id == UserHistory.track_id)
+                    .join(album_genres, album_genres.c.album_id == Track.album_id)
+                    .group_by(UserHistory.user_id, album_genres.c.genre_id)
+                ))
+                user_ids = [uid for (uid,) in session.query(User.id)]
+                session.add(JobWatermark(name="top_genres_backfill", value=0))
+            else:
+                # Users deleted since they were marked are skipped
+                user_ids = [uid for (uid,) in session.query(TopGenresDirty.user_id).join(User, User.id == TopGenresDirty.user_id)]
+            session.query(TopGenresDirty).delete()
+
+            top_genres = {uid: [] for uid in user_ids}
+            for i in range(0, len(user_ids), 500):
+                rows = (
+                    session.query(UserGenreCount.user_id, Genre.id, Genre.name, UserGenreCount.count)
+                    .join(Genre, Genre.id == UserGenreCount.genre_id)
+                    .filter(UserGenreCount.user_id.in_(user_ids[i:i + 500]), UserGenreCount.count > 0)
+                    .order_by(UserGenreCount.user_id, UserGenreCount.count.desc(), Genre.id)
+                )
+                for uid, gid, name, count in rows:
+                    if len(top_genres[uid]) < 10:
+                        top_genres[uid].append({"id": gid, "name": name, "count": count})
+
+            if top_genres:
+                session.execute(update(User), [{"id": uid, "top_genres": g} for uid, g in top_genres.items()])
             session.commit()
+            logger.info(f"Top genres refreshed for {len(user_ids)} users.")
+
+    def _history_genre_ids(self, session, track_ids):
+        """Genre ids of the tracks' albums, one entry per (track, genre)."""
+        return [gid for (gid,) in session.execute(
+            select(album_genres.c.genre_id)
+            .join(Track, Track.album_id == album_genres.c.album_id)
+            .where(Track.id.in_(track_ids))
+        )]
+
+    def _apply_genre_deltas(self, session, user_id, deltas):
+        if any(deltas.values()):
+            session.merge(TopGenresDirty(user_id=user_id))
+        for gid, delta in deltas.items():
+            if not delta:
+                continue
+            counter = session.get(UserGenreCount, (user_id, gid))
+            if counter is None:
+                if delta > 0:
+                    session.add(UserGenreCount(user_id=user_id, genre_id=gid, count=delta))
+                continue
+            counter.count = (counter.count or 0) + delta
+            if counter.count <= 0:
+                session.delete(counter)
     
     def get_user_all(self):
         with self.SessionLocal() as session:
@@ -384,25 +769,59 @@ class SqliteRepository(BaseRepository):
             raise KeyError("USER_NOT_FOUND")
 
     def add_track_to_history(self, user_id: str, track_id: int):
+        self.add_tracks_to_history([(user_id, track_id, datetime.utcnow())])
+
+    def add_tracks_to_history(self, events):
+        """Write buffered plays, (user_id, track_id, played_at UTC) in play order, in one transaction."""
+        plays_by_user = {}
+        for user_id, track_id, played_at in events:
+            plays = plays_by_user.setdefault(int(user_id), {})
+            plays.pop(int(track_id), None)
+            plays[int(track_id)] = played_at
+        if not plays_by_user:
+            return
         with self.SessionLocal() as session:
-            # Check if entry already exists to update timestamp (move to front)
-            session.query(UserHistory).filter(
-                UserHistory.user_id == int(user_id), 
-                UserHistory.track_id == track_id
-            ).delete()
-            
-            new_history = UserHistory(user_id=int(user_id), track_id=track_id)
-            session.add(new_history)
-            
-            # Limit history to 200 items per user
-            history_entries = session.query(UserHistory).filter(
-                UserHistory.user_id == int(user_id)
-            ).order_by(UserHistory.timestamp.desc()).all()
-            
-            if len(history_entries) > 200:
-                for old_entry in history_entries[200:]:
-                    session.delete(old_entry)
-            
+            known_users = set(session.scalars(select(User.id).where(User.id.in_(list(plays_by_user)))))
+            for user_id, plays in plays_by_user.items():
+                if user_id not in known_users:
+                    continue
+                track_ids = list(plays)
+                known_tracks = set(session.scalars(select(Track.id).where(Track.id.in_(track_ids))))
+                existing = {
+                    h.track_id: h for h in session.query(UserHistory).filter(
+                        UserHistory.user_id == user_id, UserHistory.track_id.in_(track_ids)
+                    )
+                }
+                added = []
+                for track_id, played_at in plays.items():
+                    if track_id not in known_tracks:
+                        continue
+                    # A replay only moves the track to the front
+                    if track_id in existing:
+                        existing[track_id].timestamp = played_at
+                    else:
+                        session.add(UserHistory(user_id=user_id, track_id=track_id, timestamp=played_at))
+                        added.append(track_id)
+                session.flush()
+
+                evicted = session.execute(
+                    select(UserHistory.id, UserHistory.track_id)
+                    .where(UserHistory.user_id == user_id)
+                    .order_by(UserHistory.timestamp.desc())
+                    .offset(HISTORY_LIMIT)
+                ).all()
+                if evicted:
+                    session.execute(delete(UserHistory).where(UserHistory.id.in_([h_id for h_id, _ in evicted])))
+
+                # Counters follow the history window
+                deltas = {}
+                if added:
+                    for gid in self._history_genre_ids(session, added):
+                        deltas[gid] = deltas.get(gid, 0) + 1
+                if evicted:
+                    for gid in self._history_genre_ids(session, [t for _, t in evicted]):
+                        deltas[gid] = deltas.get(gid, 0) - 1
+                self._apply_genre_deltas(session, user_id, deltas)
             session.commit()
 
     def delete_user(self, user_id: str):
@@ -413,6 +832,7 @@ class SqliteRepository(BaseRepository):
             
             # Delete playlists owned by the user
             user_playlists = session.query(Playlist).filter(Playlist.owner_id == int(user_id)).all()
+            playlist_ids = [pl.id for pl in user_playlists]
             for pl in user_playlists:
                 # Clean up playlist associations
                 session.query(PlaylistTrack).filter(PlaylistTrack.playlist_id == pl.id).delete()
@@ -426,10 +846,14 @@ class SqliteRepository(BaseRepository):
             session.execute(user_like_playlists.delete().where(user_like_playlists.c.user_id == int(user_id)))
             
             # history is handled by cascade="all, delete-orphan" in User model
+            session.query(UserGenreCount).filter(UserGenreCount.user_id == int(user_id)).delete()
             
             session.delete(user)
             session.commit()
-            return True
+        self.like_cache.drop_user(user_id)
+        for pid in playlist_ids:
+            self.like_cache.drop_object("playlist", pid)
+        return True
             
     # Methods for scanning
     def ensure_genre(self, name):
@@ -448,6 +872,7 @@ class SqliteRepository(BaseRepository):
                 artist = Artist(name=name, image=image, bucket=bucket, library_id=library_id)
                 session.add(artist)
                 session.commit()
+                self._invalidate_counts()
             elif image and not artist.image: # On ne met à jour que si l'image actuelle est vide
                 artist.image = image
                 if bucket:
@@ -471,6 +896,7 @@ class SqliteRepository(BaseRepository):
                             album.genres.append(genre)
                 session.add(album)
                 session.commit()
+                self._invalidate_counts()
             return album.id
 
     def add_track(self, title, duration, artist_id, album_id, album_track, path, bucket, library_id):
@@ -493,6 +919,146 @@ class SqliteRepository(BaseRepository):
                 return track.id
             return existing.id
 
+    def copy_to_staging(self, file_obj, truncate=True):
+        """Load tab-separated rows (the PostgreSQL COPY format) into tracks_staging with executemany."""
+        insert_sql = text(f"INSERT INTO tracks_staging ({', '.join(STAGING_COLUMNS)}) VALUES ({', '.join(':' + c for c in STAGING_COLUMNS)})")
+        rows = (
+            {c: (v if v != "" else None) for c, v in zip(STAGING_COLUMNS, values)}
+            for values in csv.reader(file_obj, delimiter="\t")
+        )
+        with self.engine.begin() as conn:
+            if truncate:
+                conn.execute(text("DELETE FROM tracks_staging"))
+            while True:
+                batch = list(islice(rows, STAGING_BATCH))
+                if not batch:
+                    break
+                conn.execute(insert_sql, batch)
+
+    def bulk_import_from_staging(self):
+        """Set-based import of tracks_staging, in one transaction.
+
+        Same matching rules as ensure_genre/ensure_artist/ensure_album/add_track: artists by name, albums by
+        name and artist, tracks by path and album.
+        """
+        with self.engine.begin() as conn:
+            # 1. Genres
+            conn.execute(text("""
+                WITH RECURSIVE split(name, rest) AS (
+                    SELECT '', genre_names || ',' FROM tracks_staging WHERE genre_names IS NOT NULL
+                    UNION ALL
+                    SELECT trim(substr(rest, 1, instr(rest, ',') - 1)), substr(rest, instr(rest, ',') + 1)
+                    FROM split WHERE rest <> ''
+                )
+                INSERT OR IGNORE INTO genres (name)
+                SELECT DISTINCT name FROM split WHERE name <> ''
+            """))
+
+            # 2. Artists
+            conn.execute(text("""
+                INSERT INTO artists (name, image, library_id)
+                SELECT s.artist_name, '', MIN(s.library_id)
+                FROM tracks_staging s
+                WHERE s.artist_name IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM artists a WHERE a.name = s.artist_name)
+                GROUP BY s.artist_name
+            """))
+
+            # 3. Albums: (name, artist) pairs of the scan, resolved to existing albums or given new ids
+            conn.execute(text("DROP TABLE IF EXISTS temp.staging_albums"))
+            conn.execute(text("""
+                CREATE TEMP TABLE staging_albums AS
+                SELECT s.album_name AS name, a.id AS artist_id, NULL AS album_id,
+                       MIN(s.cover) AS cover, MIN(s.cover_small) AS cover_small, MIN(s.cover_bucket) AS cover_bucket,
+                       MIN(s.date) AS date, MIN(s.library_id) AS library_id
+                FROM tracks_staging s
+                JOIN artists a ON a.id = (SELECT MIN(id) FROM artists WHERE name = s.artist_name)
+                WHERE s.album_name IS NOT NULL
+                GROUP BY s.album_name, a.id
+            """))
+            conn.execute(text("""
+                UPDATE staging_albums
+                SET album_id = (
+                    SELECT MIN(al.id) FROM albums al
+                    JOIN album_artists aa ON aa.album_id = al.id
+                    WHERE al.name = staging_albums.name AND aa.artist_id = staging_albums.artist_id
+                )
+            """))
+            conn.execute(text("""
+                UPDATE staging_albums
+                SET album_id = (SELECT COALESCE(MAX(id), 0) FROM albums) + rowid
+                WHERE album_id IS NULL
+            """))
+            conn.execute(text("""
+                INSERT INTO albums (id, name, cover, coverSmall, coverBucket, date, library_id)
+                SELECT sa.album_id, sa.name, sa.cover, sa.cover_small, sa.cover_bucket, sa.date, sa.library_id
+                FROM staging_albums sa
+                WHERE NOT EXISTS (SELECT 1 FROM albums al WHERE al.id = sa.album_id)
+            """))
+
+            # 4. Junctions: album_artists, album_genres
+            conn.execute(text("""
+                INSERT INTO album_artists (album_id, artist_id)
+                SELECT sa.album_id, sa.artist_id FROM staging_albums sa
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM album_artists aa WHERE aa.album_id = sa.album_id AND aa.artist_id = sa.artist_id
+                )
+            """))
+            conn.execute(text("DROP TABLE IF EXISTS temp.new_album_genres"))
+            conn.execute(text("DROP TABLE IF EXISTS temp.genre_deltas"))
+            conn.execute(text("""
+                CREATE TEMP TABLE new_album_genres AS
+                WITH RECURSIVE split(album_name, artist_name, name, rest) AS (
+                    SELECT album_name, artist_name, '', genre_names || ',' FROM tracks_staging WHERE genre_names IS NOT NULL
+                    UNION ALL
+                    SELECT album_name, artist_name, trim(substr(rest, 1, instr(rest, ',') - 1)), substr(rest, instr(rest, ',') + 1)
+                    FROM split WHERE rest <> ''
+                ),
+                pairs AS (
+                    SELECT DISTINCT sa.album_id, g.id AS genre_id
+                    FROM split sp
+                    JOIN artists a ON a.id = (SELECT MIN(id) FROM artists WHERE name = sp.artist_name)
+                    JOIN staging_albums sa ON sa.name = sp.album_name AND sa.artist_id = a.id
+                    JOIN genres g ON g.name = sp.name
+                    WHERE sp.name <> ''
+                )
+                SELECT p.album_id, p.genre_id FROM pairs p
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM album_genres ag WHERE ag.album_id = p.album_id AND ag.genre_id = p.genre_id
+                )
+            """))
+            conn.execute(text("INSERT INTO album_genres (album_id, genre_id) SELECT album_id, genre_id FROM new_album_genres"))
+            # Un genre ajouté à un album déjà écouté compte pour les lectures présentes dans l'historique
+            conn.execute(text("""
+                CREATE TEMP TABLE genre_deltas AS
+                SELECT uh.user_id, n.genre_id, COUNT(*) AS n
+                FROM new_album_genres n
+                JOIN tracks t ON t.album_id = n.album_id
+                JOIN user_history uh ON uh.track_id = t.id
+                GROUP BY uh.user_id, n.genre_id
+            """))
+            conn.execute(text("""
+                INSERT INTO user_genre_counts (user_id, genre_id, count)
+                SELECT user_id, genre_id, n FROM genre_deltas WHERE true
+                ON CONFLICT (user_id, genre_id) DO UPDATE SET count = count + excluded.count
+            """))
+            conn.execute(text("INSERT OR IGNORE INTO top_genres_dirty (user_id) SELECT DISTINCT user_id FROM genre_deltas"))
+            conn.execute(text("DROP TABLE temp.genre_deltas"))
+            conn.execute(text("DROP TABLE temp.new_album_genres"))
+
+            # 5. Tracks
+            conn.execute(text("""
+                INSERT INTO tracks (title, duration, artist_id, album_id, album_track, path, bucket, library_id)
+                SELECT s.title, s.duration, sa.artist_id, sa.album_id, s.album_track, s.path, s.bucket, s.library_id
+                FROM tracks_staging s
+                JOIN staging_albums sa
+                  ON sa.name = s.album_name
+                 AND sa.artist_id = (SELECT MIN(id) FROM artists WHERE name = s.artist_name)
+                WHERE NOT EXISTS (SELECT 1 FROM tracks t WHERE t.path = s.path AND t.album_id = sa.album_id)
+            """))
+            conn.execute(text("DROP TABLE temp.staging_albums"))
+        self._invalidate_counts()
+
     def update_artist(self, artist_id, data):
         with self.SessionLocal() as session:
             artist = session.query(Artist).filter(Artist.id == artist_id).first()
@@ -515,6 +1081,68 @@ class SqliteRepository(BaseRepository):
             session.query(Track).filter(Track.path == path, Track.library_id == library_id).delete()
             session.commit()
 
+    def delete_tracks_not_in(self, library_id: int, scanned_paths):
+        """Delete the library's tracks missing from scanned_paths in one transaction.
+
+        The paths go to a temp table and the stale tracks are found by anti-join; their playlist entries,
+        likes and history rows (with the genre counters) go with them, as do the albums left without tracks.
+        Returns the number of tracks deleted.
+        """
+        with self.SessionLocal() as session:
+            session.execute(text("CREATE TEMP TABLE IF NOT EXISTS scan_paths (path TEXT PRIMARY KEY)"))
+            session.execute(text("CREATE TEMP TABLE IF NOT EXISTS stale_tracks (id INTEGER PRIMARY KEY, album_id INTEGER)"))
+            session.execute(delete(scan_paths))
+            session.execute(delete(stale_tracks))
+            paths = [{"path": p} for p in set(scanned_paths)]
+            if paths:
+                session.execute(insert(scan_paths), paths)
+            session.execute(insert(stale_tracks).from_select(
+                ["id", "album_id"],
+                select(Track.id, Track.album_id).where(
+                    Track.library_id == library_id,
+                    Track.path.not_in(select(scan_paths.c.path))
+                )
+            ))
+            removed = session.execute(select(func.count()).select_from(stale_tracks)).scalar()
+
+            if removed:
+                stale_ids = select(stale_tracks.c.id)
+                # History rows going away no longer count in the genre counters
+                deltas = {}
+                for user_id, genre_id, n in session.execute(
+                    select(UserHistory.user_id, album_genres.c.genre_id, func.count())
+                    .join(stale_tracks, stale_tracks.c.id == UserHistory.track_id)
+                    .join(album_genres, album_genres.c.album_id == stale_tracks.c.album_id)
+                    .group_by(UserHistory.user_id, album_genres.c.genre_id)
+                ):
+                    deltas.setdefault(user_id, {})[genre_id] = -n
+                for user_id, user_deltas in deltas.items():
+                    self._apply_genre_deltas(session, user_id, user_deltas)
+                session.flush()
+
+                bulk = {"synchronize_session": False}
+                session.execute(delete(PlaylistTrack).where(PlaylistTrack.track_id.in_(stale_ids)), execution_options=bulk)
+                session.execute(delete(user_like_tracks).where(user_like_tracks.c.track_id.in_(stale_ids)))
+                session.execute(delete(UserHistory).where(UserHistory.track_id.in_(stale_ids)), execution_options=bulk)
+                session.execute(delete(Track).where(Track.id.in_(stale_ids)), execution_options=bulk)
+
+                emptied = select(stale_tracks.c.album_id).where(
+                    stale_tracks.c.album_id.is_not(None),
+                    ~select(Track.id).where(Track.album_id == stale_tracks.c.album_id).exists()
+                )
+                session.execute(delete(user_like_albums).where(user_like_albums.c.album_id.in_(emptied)))
+                session.execute(delete(album_artists).where(album_artists.c.album_id.in_(emptied)))
+                session.execute(delete(album_genres).where(album_genres.c.album_id.in_(emptied)))
+                session.execute(delete(Album).where(Album.id.in_(emptied)), execution_options=bulk)
+            session.commit()
+
+        if removed:
+            self._invalidate_counts()
+            # Likes on deleted tracks/albums: cached sets are reloaded on next access
+            self.like_cache.clear()
+            logger.info(f"Removed {removed} stale tracks from library {library_id}.")
+        return removed
+
     def search(self, query: str):
         q = f"%{query.lower()}%"
         with self.SessionLocal() as session:
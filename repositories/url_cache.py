@@ -0,0 +1,70 @@
+# /repositories/url_cache.py
+import threading
+import time
+from collections import OrderedDict
+
+
+class PresignedUrlCache:
+    """Bounded LRU of presigned URLs keyed by (library_id, bucket, path).
+
+    An entry is served until `margin` seconds before its signature expires, so a client always gets
+    a URL that stays valid for at least that long. clear() starts a new generation: a URL signed from
+    a generation read before the clear (i.e. with the old credentials) is neither stored nor served.
+    """
+
+    def __init__(self, max_entries=20000, margin=300):
+        self.max_entries = max_entries
+        self.margin = margin
+        self._urls = OrderedDict() # key -> (url, reusable_until monotonic, generation)
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._urls.get(key)
+            if entry is not None and entry[1] > now and entry[2] == self._generation:
+                self._urls.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._urls[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, url, expires_in, generation=None):
+        # Courtes expirations : on garde au moins la moitié de la durée de validité en réserve
+        reusable_for = expires_in - min(self.margin, expires_in / 2)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                # Signé avant un changement d'identifiants : ne pas le resservir
+                return
+            self._urls[key] = (url, time.monotonic() + reusable_for, self._generation)
+            self._urls.move_to_end(key)
+            while len(self._urls) > self.max_entries:
+                self._urls.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._urls.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._urls),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / total, 4) if total else None
+            }
@@ -0,0 +1,166 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ("queued", "running")
+MAX_FINISHED_JOBS = 50 # finished jobs kept for the status endpoint
+
+
+class ScanConflict(Exception):
+    """A library of the request is already being scanned by another job."""
+
+
+class ScanJob:
+    """State of one background scan, updated by the worker thread and read by the status endpoint."""
+
+    def __init__(self, library_ids, mode):
+        self.id = uuid.uuid4().hex
+        self.library_ids = list(library_ids)
+        self.mode = mode
+        self.status = "queued"
+        self.created_at = datetime.utcnow()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.result = None
+        self.current_library = None
+        self.libraries_done = 0
+        self.rows_ingested = 0
+        self.scan_stats = {} # live counters of the library being scanned (see iter_scan_batches)
+        self.totals = {"listed": 0, "read": 0, "carried": 0, "bytes_fetched": 0}
+        self.cancel_event = threading.Event()
+        self._started = None
+
+    def start_library(self, library_id):
+        self.current_library = library_id
+        self.scan_stats = {}
+
+    def finish_library(self):
+        for key in self.totals:
+            self.totals[key] += self.scan_stats.get(key, 0)
+        self.scan_stats = {}
+        self.libraries_done += 1
+
+    def _eta_seconds(self, files_done, listed, listing_done):
+        # Estimable une fois le listing terminé, au débit observé depuis le début du job
+        if not listing_done or not files_done or self._started is None:
+            return None
+        rate = files_done / max(time.monotonic() - self._started, 1e-6)
+        return round(max(listed - files_done, 0) / rate, 1)
+
+    def to_dict(self):
+        live = self.scan_stats
+        listed = self.totals["listed"] + live.get("listed", 0)
+        files_read = self.totals["read"] + live.get("read", 0)
+        files_carried = self.totals["carried"] + live.get("carried", 0)
+        eta = None
+        if self.status == "running":
+            eta = self._eta_seconds(files_read + files_carried, listed, live.get("listing_done", False))
+        return {
+            "id": self.id,
+            "status": self.status,
+            "mode": self.mode,
+            "library_ids": self.library_ids,
+            "current_library": self.current_library,
+            "libraries_done": self.libraries_done,
+            "progress": {
+                "keys_listed": listed,
+                "files_read": files_read,
+                "files_unchanged": files_carried,
+                "bytes_fetched": self.totals["bytes_fetched"] + live.get("bytes_fetched", 0),
+                "rows_ingested": self.rows_ingested,
+                "eta_seconds": eta
+            },
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+class ScanJobManager:
+    """Runs scans one job at a time on a single worker thread, in submission order.
+
+    Jobs share the repository's staging table (copy_to_staging truncates it, bulk_import_from_staging imports
+    all of it), so two scans must never overlap; later jobs stay "queued" until the worker takes them.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+
+    def submit(self, library_ids, mode, run):
+        """Create a job and queue run(job) on the worker; ScanConflict if a library is already queued or being scanned."""
+        with self._lock:
+            busy = {
+                lib_id
+                for job in self._jobs.values() if job.status in ACTIVE_STATUSES
+                for lib_id in job.library_ids
+            } & set(library_ids)
+            if busy:
+                raise ScanConflict(sorted(busy))
+            job = ScanJob(library_ids, mode)
+            self._jobs[job.id] = job
+            self._prune()
+            self._queue.put((job, run))
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work, name="scan-worker", daemon=True)
+                self._worker.start()
+        return job
+
+    def _work(self):
+        while True:
+            job, run = self._queue.get()
+            with self._lock:
+                # Annulé avant d'avoir démarré : cancel() l'a déjà marqué "cancelled"
+                if job.cancel_event.is_set():
+                    continue
+                job.status = "running"
+            self._run(job, run)
+
+    def _run(self, job, run):
+        job.started_at = datetime.utcnow()
+        job._started = time.monotonic()
+        try:
+            job.result = run(job)
+            job.status = "cancelled" if job.cancel_event.is_set() else "completed"
+        except Exception as e:
+            logger.exception(f"Scan job {job.id} failed")
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = datetime.utcnow()
+            job.current_library = None
+
+    def _prune(self):
+        finished = [j for j in self._jobs.values() if j.status not in ACTIVE_STATUSES]
+        for job in sorted(finished, key=lambda j: j.created_at)[:-MAX_FINISHED_JOBS]:
+            del self._jobs[job.id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: j.created_at, reverse=True)
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job.cancel_event.set()
+            if job.status == "queued":
+                # Jamais démarré : ses bibliothèques sont libérées tout de suite
+                job.status = "cancelled"
+                job.finished_at = datetime.utcnow()
+        return job